@@ -0,0 +1,173 @@
+"""
+asyncio 数据获取接口
+供异步服务调用：阻塞的下载在工作池中执行，写库和读库在专用线程中执行，事件循环不会被阻塞；
+同一进程可以同时处理多个请求，所有请求共享同一个并发上限，相同的下载只进行一次
+
+用法:
+    async with AsyncDataFetcher() as fetcher:
+        async for code, df in fetcher.fetch_many(['600519', '000001'], '2020-01-01'):
+            ...
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from config import FETCH_WORKERS
+from data_fetcher import DataFetcher, _fetch_worker, _init_fetch_worker
+from database import StockDatabase
+
+
+class AsyncDataFetcher:
+    """
+    DataFetcher 的异步封装
+    进度不使用回调，而是通过 progress() 返回的异步迭代器获取 (message, percent)
+    """
+
+    def __init__(self, db: StockDatabase = None, provider=None, max_concurrency: int = FETCH_WORKERS,
+                 use_processes: bool = True):
+        """
+        Args:
+            db: 数据库
+            provider: 行情数据源，默认按配置创建
+            max_concurrency: 同时进行的下载数上限（所有请求共享）
+            use_processes: 是否在进程池中下载（baostock会话不能在线程间共享）
+        """
+        # 主进程中的DataFetcher只用于准备元数据，不访问行情接口
+        self.fetcher = DataFetcher(db=db, provider=provider)
+        self.db = self.fetcher.db
+        self.max_concurrency = max_concurrency
+        self.use_processes = use_processes
+        self._pool = None
+        # SQLite写入集中在一个线程中，避免多个请求争用写锁
+        self._db_executor = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._prepared = None
+        self._inflight = {}
+        self._subscribers = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _ensure_executors(self):
+        if self._pool is None:
+            executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self._pool = executor_class(max_workers=self.max_concurrency, initializer=_init_fetch_worker,
+                                        initargs=(self.db, self.fetcher.provider))
+            self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-fetcher-db')
+
+    async def close(self):
+        """关闭工作池并结束所有进度迭代器"""
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+        self._subscribers.clear()
+        pool, db_executor = self._pool, self._db_executor
+        self._pool = self._db_executor = None
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, pool.shutdown)
+            await loop.run_in_executor(None, db_executor.shutdown)
+
+    async def progress(self):
+        """
+        进度的异步迭代器，产生 (message, percent)，close() 后结束
+        只收到开始迭代之后发生的进度
+        """
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._subscribers.discard(queue)
+
+    def _report_progress(self, message: str, percent: int):
+        for queue in self._subscribers:
+            queue.put_nowait((message, percent))
+
+    async def _run_db(self, func, *args):
+        self._ensure_executors()
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, func, *args)
+
+    async def _prepare(self):
+        """下载前准备好证券主表和交易日历（多个请求只准备一次）"""
+        if self._prepared is None:
+            self._prepared = asyncio.ensure_future(self._run_db(self._prepare_metadata))
+        try:
+            await self._prepared
+        except Exception:
+            # 下次请求重新准备
+            self._prepared = None
+            raise
+
+    def _prepare_metadata(self):
+        self.fetcher._ensure_security_master()
+        self.fetcher._ensure_trade_calendar()
+
+    def _save_and_load(self, normalized_code: str, df, start_date: str, end_date: str):
+        """保存新数据并读取请求的区间，返回 (DataFrame, 新增条数, 更新条数)"""
+        inserted = updated = 0
+        if not df.empty:
+            inserted, updated = self.db.save_stock_data(df, normalized_code)
+        return self.db.get_stock_data(normalized_code, start_date, end_date), inserted, updated
+
+    async def _download(self, stock_code: str, start_date: str, end_date: str, force_update: bool) -> tuple:
+        async with self._semaphore:
+            self._ensure_executors()
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._pool, _fetch_worker, stock_code, start_date, end_date, force_update)
+
+        _, normalized_code, stock_name, df, error = result
+        if error is not None:
+            return normalized_code, stock_name, None, 0, 0, error
+        data, inserted, updated = await self._run_db(self._save_and_load, normalized_code, df, start_date, end_date)
+        return normalized_code, stock_name, data, inserted, updated, None
+
+    async def fetch_stock(self, stock_code: str, start_date: str = None, end_date: str = None,
+                          force_update: bool = False) -> tuple:
+        """
+        获取一只股票的数据
+
+        Returns:
+            (标准化代码, 股票名称, DataFrame, 新增条数, 更新条数, 错误信息)，失败时DataFrame为None
+        """
+        await self._prepare()
+        start_date, end_date = self.fetcher._default_range(start_date, end_date)
+
+        # 并发请求同一只股票同一区间时共用一次下载
+        key = (stock_code, start_date, end_date, force_update)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(stock_code, start_date, end_date, force_update))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 一个请求被取消时不影响共用这次下载的其他请求
+        return await asyncio.shield(task)
+
+    async def fetch_many(self, stock_codes: list, start_date: str = None, end_date: str = None,
+                         force_update: bool = False):
+        """
+        批量获取，按完成顺序产生 (标准化代码, DataFrame)
+        下载失败的股票DataFrame为None，失败原因见进度消息；
+        提前结束迭代时不再等待剩余结果（已开始的下载仍会完成并入库）
+        """
+        total = len(stock_codes)
+        if not total:
+            return
+        tasks = [asyncio.ensure_future(self.fetch_stock(code, start_date, end_date, force_update))
+                 for code in stock_codes]
+        self._report_progress(f"开始批量获取 {total} 只股票...", 0)
+        try:
+            for done, next_result in enumerate(asyncio.as_completed(tasks), 1):
+                normalized_code, stock_name, df, inserted, updated, error = await next_result
+                status = f"失败: {error}" if error else f"新增 {inserted} 条，更新 {updated} 条"
+                self._report_progress(f"[{done}/{total}] {normalized_code} ({stock_name}) {status}",
+                                      int(done / total * 100))
+                yield normalized_code, df
+        finally:
+            for task in tasks:
+                task.cancel()
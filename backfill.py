@@ -0,0 +1,257 @@
+"""
+全市场历史数据回填
+将 股票 × 日期区间 拆分为工作单元，完成情况记录在 backfill_units 表中，
+中断后重新运行会从未完成的单元继续；失败的单元按指数退避重试
+用法: python backfill.py --start 2015-01-01 [--end 2024-12-31] [--workers 4] [--codes sh.600000 ...]
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from config import (BACKFILL_CHUNK_YEARS, BACKFILL_MAX_ATTEMPTS, BACKFILL_RETRY_BASE_SECONDS,
+                    BACKFILL_WORKERS, TRADE_CALENDAR_START)
+from data_fetcher import DataFetcher
+from database import StockDatabase, open_database
+
+# 回填工作进程（或线程）中复用的DataFetcher，线程池模式下每个线程各有一个
+_backfill_state = threading.local()
+
+
+def _init_backfill_worker(db, provider):
+    _backfill_state.fetcher = DataFetcher(db=db, provider=provider)
+
+
+def _backfill_worker(code: str, start_date: str, end_date: str) -> tuple:
+    """
+    下载一个工作单元
+
+    Returns:
+        (code, start_date, end_date, DataFrame, 错误信息)
+    """
+    fetcher = _backfill_state.fetcher
+    try:
+        if not fetcher.login():
+            raise ConnectionError("连接失败")
+        return code, start_date, end_date, fetcher._download(code, start_date, end_date), None
+    except Exception as e:
+        # 会话可能已失效，下一个单元重新登录
+        fetcher._logged_in = False
+        return code, start_date, end_date, None, str(e)
+
+
+def split_range(start_date: str, end_date: str, years: int = BACKFILL_CHUNK_YEARS) -> list:
+    """按自然年切分日期区间，返回 [(开始, 结束), ...]"""
+    chunks = []
+    year = int(start_date[:4])
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        year += years
+        chunk_end = min(f'{year - 1}-12-31', end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = f'{year}-01-01'
+    return chunks
+
+
+class BackfillJob:
+    """
+    可断点续传的回填任务
+    同一 job 名称下的工作单元只规划一次，重复运行只处理未完成的单元
+    """
+
+    def __init__(self, start_date: str, end_date: str = None, job: str = None, db: StockDatabase = None,
+                 provider=None, workers: int = BACKFILL_WORKERS, use_processes: bool = True,
+                 max_attempts: int = BACKFILL_MAX_ATTEMPTS, retry_base: float = BACKFILL_RETRY_BASE_SECONDS,
+                 progress_callback=None):
+        """
+        Args:
+            start_date: 回填开始日期
+            end_date: 回填结束日期，默认今天
+            job: 任务名称，默认为 "开始~结束"
+            db: 数据库
+            provider: 行情数据源
+            workers: 并行下载数
+            use_processes: 是否使用进程池（baostock会话不能在线程间共享）
+            max_attempts: 每个单元最多尝试次数
+            retry_base: 首次重试间隔（秒），之后每次翻倍
+            progress_callback: 进度回调 (message, percent)
+        """
+        self.start_date = max(start_date, TRADE_CALENDAR_START)
+        self.end_date = end_date or datetime.now().strftime('%Y-%m-%d')
+        self.job = job or f'{self.start_date}~{self.end_date}'
+        self.db = db or open_database()
+        self.fetcher = DataFetcher(db=self.db, provider=provider)
+        self.workers = workers
+        self.use_processes = use_processes
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.progress_callback = progress_callback or (lambda message, percent: print(message))
+
+    def plan(self, codes: list = None, include_delisted: bool = False) -> int:
+        """
+        规划工作单元（已存在的单元保持原状态）
+
+        Args:
+            codes: 股票代码，默认为证券主表中的全部A股
+            include_delisted: 是否包含已退市股票
+
+        Returns:
+            该任务的工作单元总数
+        """
+        self.fetcher._ensure_security_master()
+        conn = self.db.get_connection()
+        if codes is None:
+            securities = conn.execute(f'''
+                SELECT code, ipo_date, out_date FROM security_master
+                WHERE type = '1' {'' if include_delisted else "AND status = '1'"}
+                ORDER BY code
+            ''').fetchall()
+        else:
+            known = {row[0]: row for row in conn.execute('SELECT code, ipo_date, out_date FROM security_master')}
+            securities = [known.get(code, (code, None, None)) for code in codes]
+
+        units = []
+        for code, ipo_date, out_date in securities:
+            # 只回填上市期间
+            start = max(self.start_date, ipo_date or self.start_date)
+            end = min(self.end_date, out_date or self.end_date)
+            units.extend((self.job, code, chunk_start, chunk_end) for chunk_start, chunk_end in split_range(start, end))
+
+        with conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO backfill_units (job, code, start_date, end_date) VALUES (?, ?, ?, ?)
+            ''', units)
+        return conn.execute('SELECT COUNT(*) FROM backfill_units WHERE job = ?', (self.job,)).fetchone()[0]
+
+    def status(self) -> dict:
+        """各状态的单元数和已写入行数，如 {'done': (单元数, 行数), 'pending': ...}"""
+        rows = self.db.get_connection().execute('''
+            SELECT status, COUNT(*), COALESCE(SUM(rows), 0) FROM backfill_units WHERE job = ? GROUP BY status
+        ''', (self.job,)).fetchall()
+        return {status: (count, total_rows) for status, count, total_rows in rows}
+
+    def _runnable_units(self, now: float) -> list:
+        return self.db.get_connection().execute('''
+            SELECT code, start_date, end_date FROM backfill_units
+            WHERE job = ? AND status = 'pending' AND (next_retry IS NULL OR next_retry <= ?)
+            ORDER BY code, start_date
+        ''', (self.job, now)).fetchall()
+
+    def _next_retry(self):
+        """等待重试的单元中最早的重试时间，没有时返回None"""
+        return self.db.get_connection().execute('''
+            SELECT MIN(next_retry) FROM backfill_units WHERE job = ? AND status = 'pending'
+        ''', (self.job,)).fetchone()[0]
+
+    def _finish(self, code: str, start_date: str, df, error: str):
+        """保存一个单元的结果并记录检查点"""
+        conn = self.db.get_connection()
+        if error is None:
+            if not df.empty:
+                self.db.save_stock_data(df, code)
+            with conn:
+                conn.execute('''
+                    UPDATE backfill_units SET status = 'done', attempts = attempts + 1, rows = ?,
+                        next_retry = NULL, last_error = NULL, finished_at = ?
+                    WHERE job = ? AND code = ? AND start_date = ?
+                ''', (len(df), time.time(), self.job, code, start_date))
+            return len(df)
+
+        attempts = conn.execute('''
+            SELECT attempts FROM backfill_units WHERE job = ? AND code = ? AND start_date = ?
+        ''', (self.job, code, start_date)).fetchone()[0] + 1
+        status = 'failed' if attempts >= self.max_attempts else 'pending'
+        with conn:
+            conn.execute('''
+                UPDATE backfill_units SET status = ?, attempts = ?, next_retry = ?, last_error = ?
+                WHERE job = ? AND code = ? AND start_date = ?
+            ''', (status, attempts, time.time() + self.retry_base * 2 ** (attempts - 1), error,
+                  self.job, code, start_date))
+        return 0
+
+    def run(self, max_units: int = None) -> dict:
+        """
+        运行回填直到所有单元完成或达到重试上限
+
+        Args:
+            max_units: 本次最多处理的单元数（None表示不限），用于分批运行
+
+        Returns:
+            status() 的结果
+        """
+        summary = self.status()
+        total_units = sum(count for count, _ in summary.values())
+        done = summary.get('done', (0, 0))[0]
+        started = time.perf_counter()
+        processed = total_rows = 0
+
+        def report(result):
+            nonlocal done, processed, total_rows
+            code, start_date, end_date, df, error = result
+            rows = self._finish(code, start_date, df, error)
+            processed += 1
+            total_rows += rows
+            if error is None:
+                done += 1
+            rate = total_rows / max(time.perf_counter() - started, 1e-9)
+            status = f"{rows} 条" if error is None else f"失败: {error}"
+            self.progress_callback(f"[{done}/{total_units}] {code} {start_date}~{end_date}: {status}，"
+                                   f"{rate:.0f} 行/秒", int(done / total_units * 100))
+
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.workers, initializer=_init_backfill_worker,
+                            initargs=(self.db, self.fetcher.provider)) as executor:
+            while max_units is None or processed < max_units:
+                units = self._runnable_units(time.time())
+                if not units:
+                    # 只剩等待重试的单元时睡到最早的重试时间
+                    next_retry = self._next_retry()
+                    if next_retry is None:
+                        break
+                    time.sleep(max(next_retry - time.time(), 0))
+                    continue
+                if max_units is not None:
+                    units = units[:max_units - processed]
+
+                # 限制在途单元数，完成的结果立即写库并释放内存
+                pending = set()
+                for unit in units:
+                    pending.add(executor.submit(_backfill_worker, *unit))
+                    if len(pending) >= self.workers * 2:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            report(future.result())
+                for future in pending:
+                    report(future.result())
+
+        self.fetcher.logout()
+        summary = self.status()
+        elapsed = time.perf_counter() - started
+        self.progress_callback(f"回填结束: 完成 {done}/{total_units} 个单元，失败 {summary.get('failed', (0, 0))[0]} 个，"
+                               f"本次写入 {total_rows} 行，平均 {total_rows / max(elapsed, 1e-9):.0f} 行/秒", 100)
+        return summary
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='全市场历史数据回填（可断点续传）')
+    parser.add_argument('--start', required=True, help='开始日期')
+    parser.add_argument('--end', default=None, help='结束日期，默认今天')
+    parser.add_argument('--job', default=None, help='任务名称，默认为 开始~结束')
+    parser.add_argument('--codes', nargs='+', default=None, help='只回填指定股票')
+    parser.add_argument('--include-delisted', action='store_true', help='包含已退市股票')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='并行进程数')
+    parser.add_argument('--status', action='store_true', help='只显示任务进度')
+    args = parser.parse_args()
+
+    job = BackfillJob(args.start, args.end, job=args.job, workers=args.workers)
+    if not args.status:
+        print(f"任务 {job.job}: 共 {job.plan(args.codes, args.include_delisted)} 个工作单元")
+        job.run()
+    for status, (count, rows) in sorted(job.status().items()):
+        print(f"{status}: {count} 个单元, {rows} 行")
+
+
+if __name__ == "__main__":
+    main()
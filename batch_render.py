@@ -0,0 +1,153 @@
+"""
+无界面批量渲染估值图
+使用 Agg 后端在进程池中渲染自选股的三栏估值图（股价、估值、估值百分位），写入 PNG/SVG 文件，
+不导入 tkinter，可在没有显示器的服务器上定时运行
+用法: python batch_render.py [--output reports] [--codes sh.600000 ...] [--types PE PB] [--formats png svg]
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# 导入中文字体配置
+import font_config
+from chart_layout import draw_panels
+from config import DEFAULT_YEARS, REPORT_DPI, REPORT_FIGSIZE, REPORT_OUTPUT_DIR, REPORT_WORKERS
+from database import StockDatabase, open_database
+from percentile_cache import PercentileCache
+from valuation_calculator import ValuationCalculator
+
+
+class ChartRenderer:
+    """复用同一个 Figure 依次渲染多只股票，每只股票只清空子图重新绘制"""
+
+    def __init__(self, figsize: tuple = REPORT_FIGSIZE, dpi: int = REPORT_DPI):
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.axes = [self.fig.add_subplot(311), self.fig.add_subplot(312), self.fig.add_subplot(313)]
+
+    def render(self, df, stock_code: str, stock_name: str, valuation_type: str, paths: list):
+        """绘制并按扩展名保存到每个路径"""
+        for ax in self.axes:
+            ax.clear()
+        draw_panels(self.axes, df, stock_code, stock_name, valuation_type)
+        self.fig.tight_layout()
+        for path in paths:
+            self.fig.savefig(path)
+
+
+def valuation_frame(cache: PercentileCache, stock_code: str, start: str, end: str, valuation_type: str):
+    """区间估值百分位，与界面共用持久化缓存（同一区间算出全部估值类型）"""
+    result = cache.get_range_percentiles(stock_code, start, end)
+    if result.empty:
+        return result
+    return ValuationCalculator.select_valuation(result, valuation_type)
+
+
+# 渲染进程（或线程）中复用的百分位缓存和 Figure，线程池模式下每个线程各有一个
+_worker_state = threading.local()
+
+
+def _init_render_worker(db):
+    _worker_state.cache = PercentileCache(db)
+    _worker_state.renderer = ChartRenderer()
+
+
+def _render_worker(stock_code: str, stock_name: str, start: str, end: str, valuation_types: list,
+                   formats: list, output_dir: str) -> tuple:
+    """
+    渲染一只股票的全部估值类型
+
+    Returns:
+        (股票代码, 写入的文件列表, 错误信息)
+    """
+    cache, renderer = _worker_state.cache, _worker_state.renderer
+    written = []
+    try:
+        for valuation_type in valuation_types:
+            df = valuation_frame(cache, stock_code, start, end, valuation_type)
+            if df.empty:
+                return stock_code, written, "本地没有数据"
+            paths = [os.path.join(output_dir, f'{stock_code}_{valuation_type}.{fmt}') for fmt in formats]
+            renderer.render(df, stock_code, stock_name, valuation_type, paths)
+            written.extend(paths)
+        return stock_code, written, None
+    except Exception as e:
+        return stock_code, written, str(e)
+
+
+def render_charts(stocks: list = None, output_dir: str = None, start: str = None, end: str = None,
+                  valuation_types: list = ('PE',), formats: list = ('png',), workers: int = REPORT_WORKERS,
+                  use_processes: bool = True, db: StockDatabase = None, progress=print) -> list:
+    """
+    批量渲染估值图（只读取本地数据，不联网）
+
+    Args:
+        stocks: [(代码, 名称), ...]，默认为全部自选股
+        output_dir: 输出目录
+        start: 开始日期，默认为 DEFAULT_YEARS 年前
+        end: 结束日期，默认今天
+        valuation_types: 估值类型，每种一张图
+        formats: 文件格式（png、svg 等 matplotlib 支持的格式）
+        workers: 并行进程数
+        use_processes: 是否使用进程池
+        db: 数据库
+        progress: 进度输出函数
+
+    Returns:
+        [(股票代码, 写入的文件列表, 错误信息), ...]，顺序与完成顺序一致
+    """
+    db = db or open_database()
+    stocks = stocks if stocks is not None else db.get_stock_memory()
+    output_dir = output_dir or REPORT_OUTPUT_DIR
+    end = end or datetime.now().strftime('%Y-%m-%d')
+    start = start or (datetime.now() - timedelta(days=365 * DEFAULT_YEARS)).strftime('%Y-%m-%d')
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers, initializer=_init_render_worker, initargs=(db,)) as executor:
+        futures = [executor.submit(_render_worker, code, name or code, start, end, list(valuation_types),
+                                   list(formats), output_dir)
+                   for code, name in stocks]
+        for done, future in enumerate(as_completed(futures), 1):
+            code, written, error = future.result()
+            results.append((code, written, error))
+            if progress:
+                status = f"失败: {error}" if error else f"{len(written)} 个文件"
+                progress(f"[{done}/{len(futures)}] {code}: {status}")
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='批量渲染自选股估值图')
+    parser.add_argument('--output', default=None, help='输出目录')
+    parser.add_argument('--codes', nargs='+', default=None, help='股票代码，默认为全部自选股')
+    parser.add_argument('--start', default=None, help='开始日期')
+    parser.add_argument('--end', default=None, help='结束日期')
+    parser.add_argument('--types', nargs='+', default=['PE'], help='估值类型')
+    parser.add_argument('--formats', nargs='+', default=['png'], help='文件格式')
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS, help='并行进程数')
+    args = parser.parse_args()
+
+    db = open_database()
+    stocks = None
+    if args.codes:
+        stocks = []
+        for code in args.codes:
+            security = db.get_security(code)
+            stocks.append((code, security[1] if security else code))
+
+    results = render_charts(stocks, args.output, args.start, args.end, args.types, args.formats, args.workers,
+                            db=db)
+    failed = sum(1 for _, _, error in results if error)
+    print(f"渲染完成: {len(results) - failed} 只成功，{failed} 只失败")
+
+
+if __name__ == "__main__":
+    main()
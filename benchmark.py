@@ -0,0 +1,327 @@
+"""
+性能基准测试
+用法: python benchmark.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def _timeit(func, repeat=3):
+    """返回多次运行中的最短耗时（秒）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _make_frame(rows: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    pe = rng.uniform(8, 40, rows)
+    pe[rng.random(rows) < 0.05] = np.nan
+    return pd.DataFrame({
+        'date': pd.date_range('2000-01-01', periods=rows, freq='D'),
+        'close': rng.uniform(5, 50, rows),
+        'peTTM': pe,
+        'pbMRQ': rng.uniform(0.5, 5, rows),
+    })
+
+
+def _naive_expanding(df: pd.DataFrame, value_col: str):
+    """原逐行实现，作为对照"""
+    df = df.copy()
+    df['percentile'] = np.nan
+    for i in range(len(df)):
+        current_value = df.loc[i, value_col]
+        if pd.isna(current_value):
+            continue
+        historical_values = df.loc[:i, value_col].dropna().values
+        if len(historical_values) > 1:
+            df.loc[i, 'percentile'] = (historical_values < current_value).sum() / (len(historical_values) - 1) * 100
+    return df
+
+
+def bench_expanding_percentile(rows: int = 10000):
+    """扩展窗口百分位：逐行循环 vs 百分位引擎"""
+    from valuation_calculator import ValuationCalculator
+
+    df = _make_frame(rows)
+    calculator = ValuationCalculator(df, 'PE')
+
+    naive = _timeit(lambda: _naive_expanding(calculator.df, 'peTTM'), repeat=1)
+    engine = _timeit(calculator.calculate_percentile)
+    print(f"扩展窗口百分位 ({rows} 行): 逐行 {naive:.3f}s, 引擎 {engine * 1000:.2f}ms, "
+          f"加速 {naive / engine:.0f}x")
+
+
+def bench_range_percentile(rows: int = 10000):
+    """区间百分位：逐行循环 vs 排序+二分查找"""
+    from valuation_calculator import ValuationCalculator
+
+    df = _make_frame(rows)
+    calculator = ValuationCalculator(df, 'PE')
+
+    def naive():
+        df_copy = calculator.df.copy()
+        df_copy['percentile'] = np.nan
+        all_values = df_copy['peTTM'].dropna().values
+        for i in range(len(df_copy)):
+            current_value = df_copy.loc[i, 'peTTM']
+            if pd.isna(current_value):
+                continue
+            count_less = (all_values < current_value).sum()
+            df_copy.loc[i, 'percentile'] = count_less / (len(all_values) - 1) * 100
+
+    naive_time = _timeit(naive, repeat=1)
+    engine = _timeit(calculator.calculate_percentile_in_range)
+    print(f"区间百分位 ({rows} 行): 逐行 {naive_time:.3f}s, 向量化 {engine * 1000:.2f}ms, "
+          f"加速 {naive_time / engine:.0f}x")
+
+
+def bench_rolling_percentile(rows: int = 10000, window: str = '5年'):
+    """滚动窗口百分位：分块有序列表"""
+    from valuation_calculator import ValuationCalculator
+
+    calculator = ValuationCalculator(_make_frame(rows), 'PE')
+    elapsed = _timeit(lambda: calculator.calculate_rolling_percentile(window))
+    print(f"滚动窗口百分位 ({rows} 行, 窗口{window}): {elapsed * 1000:.2f}ms")
+
+
+def bench_screener(stocks: int = 500, rows: int = 2400):
+    """全市场筛选：按股票数量统计耗时"""
+    import os
+    import tempfile
+    from database import StockDatabase
+    from screener import ValuationScreener
+
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(end='2024-06-28', periods=rows).strftime('%Y-%m-%d').tolist()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = StockDatabase(os.path.join(tmp, 'bench.db'))
+        conn = db.get_connection()
+        for i in range(stocks):
+            code = f'sz.{i:06d}'
+            values = rng.uniform(1, 50, (rows, 4)).tolist()
+            conn.executemany(
+                'INSERT INTO stock_history (date, code, close, peTTM, pbMRQ, psTTM, pcfNcfTTM) VALUES (?, ?, 1, ?, ?, ?, ?)',
+                [(date, code, *row) for date, row in zip(dates, values)])
+        conn.commit()
+
+        elapsed = _timeit(lambda: ValuationScreener(db).screen('PE', '5年'), repeat=1)
+        print(f"全市场筛选 ({stocks} 只 x {rows} 行): {elapsed:.2f}s")
+
+
+def _naive_save(db, df: pd.DataFrame, stock_code: str):
+    """原逐行写入实现，作为对照"""
+    from database import STOCK_HISTORY_COLUMNS
+
+    conn = db.get_connection()
+    df = df.copy()
+    df['code'] = stock_code
+    existing_columns = [col for col in STOCK_HISTORY_COLUMNS if col in df.columns]
+    for _, row in df[existing_columns].iterrows():
+        placeholders = ', '.join(['?' for _ in existing_columns])
+        cursor = conn.cursor()
+        cursor.execute(f"INSERT OR REPLACE INTO stock_history ({', '.join(existing_columns)}) "
+                       f"VALUES ({placeholders})", tuple(row))
+    conn.commit()
+
+
+def bench_save_stock_data(rows: int = 2400):
+    """写入一只股票10年日线：逐行 execute vs executemany"""
+    import os
+    import tempfile
+    from database import StockDatabase
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'date': pd.bdate_range(end='2024-06-28', periods=rows).strftime('%Y-%m-%d'),
+        'open': rng.uniform(5, 50, rows), 'high': rng.uniform(5, 50, rows),
+        'low': rng.uniform(5, 50, rows), 'close': rng.uniform(5, 50, rows),
+        'preclose': rng.uniform(5, 50, rows), 'volume': rng.uniform(1e5, 1e7, rows),
+        'amount': rng.uniform(1e6, 1e9, rows), 'adjustflag': '3', 'turn': rng.uniform(0, 5, rows),
+        'tradestatus': '1', 'pctChg': rng.uniform(-10, 10, rows), 'isST': '0',
+        'peTTM': rng.uniform(5, 40, rows), 'pbMRQ': rng.uniform(0.5, 5, rows),
+        'psTTM': rng.uniform(0.5, 10, rows), 'pcfNcfTTM': rng.uniform(-20, 60, rows),
+    })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = StockDatabase(os.path.join(tmp, 'bench.db'))
+        codes = iter(range(100))
+
+        # 每次写入新代码（新增路径），再对同一代码重复写入（替换路径）
+        naive_insert = _timeit(lambda: _naive_save(db, df, f'sh.{next(codes)}'))
+        bulk_insert = _timeit(lambda: db.save_stock_data(df, f'sh.{next(codes)}'))
+        naive_replace = _timeit(lambda: _naive_save(db, df, 'sh.0'))
+        bulk_replace = _timeit(lambda: db.save_stock_data(df, 'sh.0'))
+
+    print(f"保存日线新增 ({rows} 行): 逐行 {naive_insert * 1000:.1f}ms, 批量 {bulk_insert * 1000:.1f}ms, "
+          f"加速 {naive_insert / bulk_insert:.1f}x")
+    print(f"保存日线替换 ({rows} 行): 逐行 {naive_replace * 1000:.1f}ms, 批量 {bulk_replace * 1000:.1f}ms, "
+          f"加速 {naive_replace / bulk_replace:.1f}x")
+
+
+def bench_get_stock_data(rows: int = 2400):
+    """读取一只股票10年日线：SQLite行存储 vs 列式存储"""
+    import os
+    import tempfile
+    from columnar_store import ColumnarStockStore
+    from database import StockDatabase
+    from valuation_calculator import ValuationCalculator
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'date': pd.bdate_range(end='2024-06-28', periods=rows).strftime('%Y-%m-%d'),
+        'close': rng.uniform(5, 50, rows), 'volume': rng.uniform(1e5, 1e7, rows),
+        'adjustflag': '3', 'tradestatus': '1', 'isST': '0',
+        'peTTM': rng.uniform(5, 40, rows), 'pbMRQ': rng.uniform(0.5, 5, rows),
+        'psTTM': rng.uniform(0.5, 10, rows), 'pcfNcfTTM': rng.uniform(-20, 60, rows),
+    })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = StockDatabase(os.path.join(tmp, 'bench.db'))
+        store = ColumnarStockStore(os.path.join(tmp, 'columns'), db_path=os.path.join(tmp, 'meta.db'))
+        db.save_stock_data(df, 'sh.600000')
+        store.save_stock_data(df, 'sh.600000')
+
+        row_read = _timeit(lambda: db.get_stock_data('sh.600000'), repeat=5)
+        column_read = _timeit(lambda: store.get_stock_data('sh.600000'), repeat=5)
+        # 读取后构造计算器，包含日期和数值列的类型转换
+        row_time = _timeit(lambda: ValuationCalculator(db.get_stock_data('sh.600000'), 'PE'), repeat=5)
+        column_time = _timeit(lambda: ValuationCalculator(store.get_stock_data('sh.600000'), 'PE'), repeat=5)
+
+    print(f"读取日线 ({rows} 行): SQLite {row_read * 1000:.1f}ms, 列式 {column_read * 1000:.1f}ms, "
+          f"加速 {row_read / column_read:.1f}x")
+    print(f"读取日线并准备计算 ({rows} 行): SQLite {row_time * 1000:.1f}ms, 列式 {column_time * 1000:.1f}ms, "
+          f"加速 {row_time / column_time:.1f}x")
+
+
+def _write_replay_data(data_dir: str, stocks: int, rows: int):
+    """生成回放数据源使用的录制文件"""
+    import os
+    from config import STOCK_FIELDS
+    from data_provider import write_recording
+
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(end='2024-06-28', periods=rows).strftime('%Y-%m-%d').tolist()
+    fields = STOCK_FIELDS.split(',')
+    codes = [f'sz.{i:06d}' for i in range(stocks)]
+    for code in codes:
+        values = rng.uniform(1, 50, (rows, len(fields))).round(4).astype(str).tolist()
+        history = [[{'date': date, 'code': code, 'adjustflag': '3', 'tradestatus': '1', 'isST': '0'}.get(field, value)
+                    for field, value in zip(fields, row)] for date, row in zip(dates, values)]
+        write_recording(os.path.join(data_dir, 'history', f'{code}.json'), fields, history)
+
+    write_recording(os.path.join(data_dir, 'stock_basic.json'),
+                    ['code', 'code_name', 'ipoDate', 'outDate', 'type', 'status'],
+                    [[code, code, '2000-01-04', '', '1', '1'] for code in codes])
+    calendar = pd.date_range('1990-12-19', f'{pd.Timestamp.now().year}-12-31')
+    write_recording(os.path.join(data_dir, 'trade_dates.json'), ['calendar_date', 'is_trading_day'],
+                    [[day.strftime('%Y-%m-%d'), '1' if day.weekday() < 5 else '0'] for day in calendar])
+    return codes, dates
+
+
+def bench_ingest(stocks: int = 40, rows: int = 2400, latency: float = 0.05):
+    """下载入库吞吐：离线回放数据源，模拟每次查询的网络延迟"""
+    import os
+    import tempfile
+    from data_fetcher import DataFetcher
+    from data_provider import ReplayProvider
+    from database import StockDatabase
+
+    with tempfile.TemporaryDirectory() as tmp:
+        codes, dates = _write_replay_data(os.path.join(tmp, 'replay'), stocks, rows)
+        provider = ReplayProvider(os.path.join(tmp, 'replay'), latency=latency)
+
+        def run(name, workers):
+            fetcher = DataFetcher(db=StockDatabase(os.path.join(tmp, f'{name}.db')), provider=provider)
+            fetcher.load_security_master()
+            elapsed = _timeit(lambda: fetcher.fetch_many(codes, dates[0], dates[-1], max_workers=workers), repeat=1)
+            # 第二次全部命中本地数据，不再查询
+            cached = _timeit(lambda: fetcher.fetch_many(codes, dates[0], dates[-1], max_workers=workers), repeat=1)
+            return elapsed, cached
+
+        serial, _ = run('serial', 1)
+        parallel, cached = run('parallel', 8)
+
+    print(f"下载入库 ({stocks} 只 x {rows} 行, 延迟{latency * 1000:.0f}ms): 1进程 {stocks * rows / serial:.0f} 行/秒, "
+          f"8进程 {stocks * rows / parallel:.0f} 行/秒, 本地命中 {cached * 1000:.0f}ms")
+
+
+def bench_hover(rows: int = 2500, moves: int = 50):
+    """悬停更新：整图重绘 vs 十字线blitting（Agg画布，不含屏幕刷新）"""
+    import matplotlib.dates as mdates
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from chart_view import HoverCrosshair
+
+    fig = Figure(figsize=(12, 10), dpi=100)
+    axes = [fig.add_subplot(311), fig.add_subplot(312), fig.add_subplot(313)]
+    canvas = FigureCanvasAgg(fig)
+    dates = pd.date_range('2015-01-01', periods=rows)
+    for ax in axes:
+        ax.plot(dates, np.random.default_rng(0).uniform(0, 100, rows))
+    crosshair = HoverCrosshair(canvas, axes)
+    crosshair.create_artists(mdates.date2num(dates[0]))
+    canvas.draw()
+    xs = mdates.date2num(dates[::rows // moves][:moves])
+
+    def redraw():
+        for x in xs:
+            crosshair.show(x, [50, 50, 50], '悬停')
+            canvas.draw()
+
+    def blit():
+        for x in xs:
+            crosshair.show(x, [50, 50, 50], '悬停')
+
+    full = _timeit(redraw, repeat=1) / moves
+    fast = _timeit(blit) / moves
+    print(f"悬停更新 ({rows} 点): 整图重绘 {full * 1000:.1f}ms/次, blitting {fast * 1000:.2f}ms/次, "
+          f"加速 {full / fast:.0f}x")
+
+
+def bench_plot_lod(rows: int = 7300):
+    """长序列绘制：逐点绘制 vs 按像素抽稀（三条曲线加一个填充，Agg画布）"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from chart_layout import DecimatedLine
+
+    dates = pd.date_range('2005-01-01', periods=rows)
+    values = np.random.default_rng(0).uniform(0, 100, rows)
+
+    def render(decimate: bool):
+        fig = Figure(figsize=(14, 10), dpi=100)
+        canvas = FigureCanvasAgg(fig)
+        for i in range(3):
+            ax = fig.add_subplot(3, 1, i + 1)
+            if decimate:
+                DecimatedLine(ax, dates, values, fill_kwargs=dict(alpha=0.3) if i == 2 else None)
+            else:
+                ax.plot(dates, values)
+                if i == 2:
+                    ax.fill_between(dates, 0, values, alpha=0.3)
+        canvas.draw()
+
+    full = _timeit(lambda: render(False))
+    lod = _timeit(lambda: render(True))
+    print(f"绘制长序列 ({rows} 点 x 3): 逐点 {full * 1000:.0f}ms, 抽稀 {lod * 1000:.0f}ms, 加速 {full / lod:.1f}x")
+
+
+def main():
+    bench_expanding_percentile()
+    bench_range_percentile()
+    bench_rolling_percentile()
+    bench_screener()
+    bench_save_stock_data()
+    bench_get_stock_data()
+    bench_ingest()
+    bench_hover()
+    bench_plot_lod()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+估值图表的三栏布局（股价、估值、估值百分位）和多股百分位对比图，不依赖任何界面库
+界面中的 ChartView 和无界面的批量渲染共用
+"""
+import matplotlib.dates as mdates
+import numpy as np
+import pandas as pd
+
+from config import VALUATION_TYPES
+
+# 各估值类型百分位曲线的颜色: (线条颜色, 填充颜色)
+VALUATION_COLORS = {
+    'PE': ('purple', 'purple'),
+    'PB': ('darkblue', 'blue'),
+    'PS': ('darkorange', 'orange'),
+    'PCF': ('teal', 'teal'),
+}
+
+# 抽稀时的最少列数（坐标轴尚未布局、宽度很小时使用）
+MIN_LOD_BUCKETS = 200
+
+
+def minmax_decimate(x_nums: np.ndarray, y: np.ndarray, x_min: float, x_max: float, buckets: int) -> np.ndarray:
+    """
+    按视图范围抽稀：把 [x_min, x_max] 等分为 buckets 列（通常为坐标轴的像素宽度），
+    每列只保留最小值和最大值所在的点，曲线的包络与逐点绘制相同
+
+    Args:
+        x_nums: 升序的x坐标（日期数字）
+        y: 对应的值，NaN所在的列保留一个NaN点，曲线在缺失处照常断开
+        x_min, x_max: 当前显示范围
+        buckets: 列数
+
+    Returns:
+        需要绘制的点的下标（升序），包含显示范围两侧各一个点，平移时曲线不会在边缘断开
+    """
+    lo = max(int(np.searchsorted(x_nums, x_min, side='left')) - 1, 0)
+    hi = min(int(np.searchsorted(x_nums, x_max, side='right')) + 1, len(x_nums))
+    if hi - lo <= 2 * buckets:
+        return np.arange(lo, hi)
+
+    xs, ys = x_nums[lo:hi], y[lo:hi]
+    edges = np.linspace(xs[0], xs[-1], buckets + 1)[1:-1]
+    # 每列第一个点的位置，去掉没有数据的列
+    starts = np.unique(np.concatenate([[0], np.searchsorted(xs, edges, side='left')]))
+    bucket_id = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(xs))))
+
+    keep = [[0, len(xs) - 1]]
+    nan = np.isnan(ys)
+    for reduce in (np.fmin, np.fmax):
+        # fmin/fmax 忽略NaN，全为NaN的列结果为NaN，不会命中任何点
+        extreme = reduce.reduceat(ys, starts)
+        hit = np.flatnonzero(ys == extreme[bucket_id])
+        keep.append(hit[np.unique(bucket_id[hit], return_index=True)[1]])
+    missing = np.flatnonzero(nan)
+    keep.append(missing[np.unique(bucket_id[missing], return_index=True)[1]])
+    return lo + np.unique(np.concatenate(keep))
+
+
+def fill_verts(x_nums: np.ndarray, y: np.ndarray) -> list:
+    """
+    曲线与0之间填充区域的多边形顶点，NaN处断开（与 fill_between 相同）
+    用于旧版 matplotlib 的 PolyCollection.set_verts，不必重新创建填充图元
+    """
+    valid = np.concatenate([[0], (~np.isnan(y)).astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(valid))
+    verts = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        xs, ys = x_nums[start:stop], y[start:stop]
+        verts.append(np.column_stack([np.concatenate([[xs[0]], xs, [xs[-1]]]), np.concatenate([[0], ys, [0]])]))
+    return verts
+
+
+class DecimatedLine:
+    """
+    按视图范围抽稀显示的曲线（可带到0的填充）
+    完整数据保存在对象中，坐标轴范围变化（缩放、平移）后调用 update() 重新抽稀，放大到足够细时显示全部点；
+    数据点不多于像素列数的两倍时不抽稀，始终绘制全部点，视图外的部分由裁剪隐藏，平移缩放时图元不变
+    """
+
+    def __init__(self, ax, dates, values, *plot_args, fill_kwargs: dict = None, **line_kwargs):
+        """
+        Args:
+            ax: 坐标轴
+            dates: 升序日期
+            values: 数值
+            plot_args, line_kwargs: 传给 ax.plot
+            fill_kwargs: 不为None时在曲线与0之间填充，传给 ax.fill_between
+        """
+        self.ax = ax
+        self.x = np.asarray(pd.to_datetime(dates).to_numpy(), dtype='datetime64[ns]')
+        self.x_nums = mdates.date2num(self.x)
+        self.y = np.asarray(values, dtype=float)
+        self.fill_kwargs = fill_kwargs
+        self.fill = None
+
+        self.indices = self._select(self.x_nums[0], self.x_nums[-1])
+        self.line, = ax.plot(self.x[self.indices], self.y[self.indices], *plot_args, **line_kwargs)
+        self._draw_fill()
+
+    def _select(self, x_min: float, x_max: float) -> np.ndarray:
+        buckets = max(int(self.ax.bbox.width), MIN_LOD_BUCKETS)
+        if len(self.x_nums) <= 2 * buckets:
+            return np.arange(len(self.x_nums))
+        return minmax_decimate(self.x_nums, self.y, x_min, x_max, buckets)
+
+    def _draw_fill(self):
+        """创建填充，之后只原地更新其顶点"""
+        if self.fill_kwargs is None:
+            return
+        x, y = self.x[self.indices], self.y[self.indices]
+        if self.fill is None:
+            self.fill = self.ax.fill_between(x, 0, y, **self.fill_kwargs)
+        elif hasattr(self.fill, 'set_data'):
+            # matplotlib >= 3.10 的 FillBetweenPolyCollection
+            self.fill.set_data(x, 0, y)
+        else:
+            self.fill.set_verts(fill_verts(self.x_nums[self.indices], y))
+
+    def set_series(self, dates, values):
+        """更换完整数据，图元保持不变"""
+        self.x = np.asarray(pd.to_datetime(dates).to_numpy(), dtype='datetime64[ns]')
+        self.x_nums = mdates.date2num(self.x)
+        self.y = np.asarray(values, dtype=float)
+        self.indices = None
+        self.update()
+
+    def remove(self):
+        """从坐标轴上删除曲线和填充"""
+        self.line.remove()
+        if self.fill is not None:
+            self.fill.remove()
+            self.fill = None
+
+    def update(self) -> bool:
+        """按当前显示范围重新抽稀，返回显示的点是否有变化"""
+        indices = self._select(*self.ax.get_xlim())
+        if np.array_equal(indices, self.indices):
+            return False
+        self.indices = indices
+        self.line.set_data(self.x[indices], self.y[indices])
+        self._draw_fill()
+        return True
+
+
+def panel_series(df: pd.DataFrame, valuation_type: str) -> tuple:
+    """三个子图曲线的数据：(日期, [收盘价, 估值, 百分位])"""
+    config = VALUATION_TYPES.get(valuation_type, VALUATION_TYPES['PE'])
+    output_col = config['output']
+    zeros = np.zeros(len(df))
+    valuation_values = df[output_col] if output_col in df.columns else zeros
+    percentiles = df.get(f'{output_col}_percentile', df.get('percentile', zeros))
+    return df['date'], [df['close'], valuation_values, percentiles]
+
+
+def draw_panels(axes: list, df: pd.DataFrame, stock_code: str, stock_name: str = None,
+                valuation_type: str = 'PE') -> list:
+    """
+    在三个（已清空的）子图上绘制股价、估值和估值百分位（含30%/70%阈值线）
+
+    Returns:
+        三条 DecimatedLine
+    """
+    ax1, ax2, ax3 = axes
+    lines = []
+    dates, (closes, valuation_values, percentiles) = panel_series(df, valuation_type)
+
+    config = VALUATION_TYPES.get(valuation_type, VALUATION_TYPES['PE'])
+    short_name = config['short_name']
+    valuation_value_title = f'{short_name}值走势'
+    valuation_percentile_title = f'{short_name}历史百分位'
+    valuation_value_label = f'{short_name}值'
+    valuation_percentile_label = f'{short_name}百分位'
+    line_color, fill_color = VALUATION_COLORS.get(valuation_type, VALUATION_COLORS['PE'])
+
+    # 第一个子图：绘制股价图
+    # 曲线按像素抽稀，见 DecimatedLine
+    lines.append(DecimatedLine(ax1, dates, closes, 'b-', linewidth=1.5, label='收盘价'))
+    # 显示股票代码和公司名
+    display_name = f'{stock_code} ({stock_name})' if stock_name and stock_name != stock_code else stock_code
+    ax1.set_title(f'{display_name} - 股价走势', fontsize=12, fontweight='bold')
+    ax1.set_ylabel('价格', fontsize=10)
+    ax1.grid(True, alpha=0.3)
+    ax1.legend(loc='upper left')
+
+    # 第二个子图：绘制PE/PB值图
+    lines.append(DecimatedLine(ax2, dates, valuation_values, color='green', linewidth=1.5,
+                               label=valuation_value_label))
+    ax2.set_title(valuation_value_title, fontsize=12)
+    ax2.set_ylabel(valuation_value_label, fontsize=10)
+    ax2.grid(True, alpha=0.3)
+    ax2.legend(loc='upper left')
+
+    # 第三个子图：绘制估值百分位图
+    lines.append(DecimatedLine(ax3, dates, percentiles, color=line_color, linewidth=1.5,
+                               label=valuation_percentile_label,
+                               fill_kwargs=dict(alpha=0.3, color=fill_color)))
+    ax3.axhline(y=30, color='green', linestyle='--', alpha=0.5, label='30% (低估)')
+    ax3.axhline(y=70, color='red', linestyle='--', alpha=0.5, label='70% (高估)')
+
+    ax3.set_title(valuation_percentile_title, fontsize=12)
+    ax3.set_xlabel('日期', fontsize=10)
+    ax3.set_ylabel('百分位 (%)', fontsize=10)
+    ax3.set_ylim(0, 100)
+    ax3.grid(True, alpha=0.3)
+    ax3.legend(loc='upper left')
+
+    for ax in axes:
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=6))
+        # 用 tick_params 设置旋转，坐标轴范围变化后新生成的刻度同样生效
+        ax.tick_params(axis='x', labelrotation=45)
+
+    return lines
+
+
+class ComparisonOverlay:
+    """
+    多只股票估值百分位的叠加图
+    每只股票一条 DecimatedLine，sync() 只为新增或数据变化的股票创建曲线、删除已移除股票的曲线，
+    其余曲线的图元保持不变
+    """
+
+    def __init__(self, ax, valuation_type: str = 'PE'):
+        """
+        Args:
+            ax: 已清空的坐标轴
+            valuation_type: 估值类型（用于标题）
+        """
+        self.ax = ax
+        self.valuation_type = valuation_type
+        self.lines = {}     # 代码 -> DecimatedLine
+        self._sources = {}  # 代码 -> 绘制该曲线的序列对象
+        self._colors = {}   # 代码 -> 颜色，加入后保持不变
+
+        short_name = VALUATION_TYPES.get(valuation_type, VALUATION_TYPES['PE'])['short_name']
+        ax.axhline(y=30, color='green', linestyle='--', alpha=0.5)
+        ax.axhline(y=70, color='red', linestyle='--', alpha=0.5)
+        ax.set_title(f'{short_name}历史百分位对比', fontsize=12, fontweight='bold')
+        ax.set_xlabel('日期', fontsize=10)
+        ax.set_ylabel('百分位 (%)', fontsize=10)
+        ax.set_ylim(0, 100)
+        ax.grid(True, alpha=0.3)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        ax.xaxis.set_major_locator(mdates.MonthLocator(interval=6))
+        ax.tick_params(axis='x', labelrotation=45)
+
+    def _color(self, code: str) -> str:
+        if code not in self._colors:
+            used = set(self._colors.values())
+            palette = [f'C{i}' for i in range(10)]
+            self._colors[code] = next((c for c in palette if c not in used), palette[len(self._colors) % 10])
+        return self._colors[code]
+
+    def sync(self, series: dict, names: dict) -> set:
+        """
+        使曲线与 series 一致
+
+        Args:
+            series: {代码: 以日期为索引的百分位序列}，见 PercentileComparison.series
+            names: {代码: 名称}
+
+        Returns:
+            重新绘制或删除的股票代码
+        """
+        changed = set()
+        for code in list(self.lines):
+            if series.get(code) is not self._sources[code]:
+                self.lines.pop(code).remove()
+                del self._sources[code]
+                changed.add(code)
+        for code in list(self._colors):
+            if code not in series:
+                del self._colors[code]
+
+        for code, values in series.items():
+            if code in self.lines or values.empty:
+                continue
+            name = names.get(code, code)
+            label = f'{code} ({name})' if name and name != code else code
+            self.lines[code] = DecimatedLine(self.ax, values.index, values.to_numpy(), color=self._color(code),
+                                             linewidth=1.5, label=label)
+            self._sources[code] = values
+            changed.add(code)
+
+        if changed:
+            # 图例按加入顺序排列
+            handles = [self.lines[code].line for code in series if code in self.lines]
+            if handles:
+                self.ax.legend(handles=handles, loc='upper left', fontsize=9)
+            elif self.ax.get_legend() is not None:
+                self.ax.get_legend().remove()
+        return changed
+
+    def x_range(self) -> tuple:
+        """全部曲线的日期范围（日期数字），没有曲线时返回None"""
+        if not self.lines:
+            return None
+        return (min(line.x_nums[0] for line in self.lines.values()),
+                max(line.x_nums[-1] for line in self.lines.values()))
@@ -1,14 +1,123 @@
-import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.figure import Figure
 import matplotlib.dates as mdates
 from datetime import datetime
 import tkinter as tk
 from tkinter import ttk
+import numpy as np
 import pandas as pd
 
 # 导入中文字体配置
 import font_config
+from chart_layout import ComparisonOverlay, draw_panels, panel_series
+from config import VALUATION_TYPES
+
+# 悬停时最近数据点与鼠标位置相差超过该天数则不显示
+HOVER_MAX_DAYS = 5
+
+# 滑块等连续操作时两次重绘的最小间隔（毫秒），期间的重绘请求合并
+REDRAW_INTERVAL_MS = 30
+
+# 显示范围两侧的留白（占数据范围的比例）
+VIEW_MARGIN = 0.05
+
+# 三个子图悬停注释框的 (填充色, 边框/箭头颜色)
+HOVER_STYLES = [('yellow', 'orange'), ('lightgreen', 'green'), ('lightblue', 'blue')]
+
+
+def nearest_index(date_nums: np.ndarray, x: float) -> int:
+    """在升序的日期数字数组中二分查找离 x 最近的位置"""
+    i = int(np.searchsorted(date_nums, x))
+    if i == 0:
+        return 0
+    if i == len(date_nums):
+        return i - 1
+    return i if date_nums[i] - x < x - date_nums[i - 1] else i - 1
+
+
+class HoverCrosshair:
+    """
+    悬停十字线
+    每个子图一条垂直线和一个注释框，均为常驻的动画图元：整图重绘后缓存背景，
+    鼠标移动时只恢复背景并重绘这些图元（blitting），不重绘坐标轴和曲线
+    """
+
+    def __init__(self, canvas, axes: list):
+        self.canvas = canvas
+        self.axes = axes
+        self.lines = []
+        self.annotations = []
+        self.background = None
+        self.visible = False
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def create_artists(self, x: float):
+        """
+        在子图上创建十字线图元（子图清空后需重新创建）
+
+        Args:
+            x: 初始位置，取数据范围内的值，避免垂直线改变坐标轴范围
+        """
+        self.lines = [ax.axvline(x=x, color='gray', linestyle='--', alpha=0.7, linewidth=1,
+                                 visible=False, animated=True)
+                      for ax in self.axes]
+        self.annotations = [
+            ax.annotate('', xy=(x, 0), xytext=(15, 15), textcoords='offset points',
+                        bbox=dict(boxstyle='round,pad=0.5', fc=face, alpha=0.9, ec=edge),
+                        fontsize=9, arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color=edge),
+                        visible=False, animated=True)
+            for ax, (face, edge) in zip(self.axes, HOVER_STYLES)
+        ]
+        self.visible = False
+
+    def _on_draw(self, event):
+        # 整图重绘（含窗口缩放）后重新缓存不含十字线的背景
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        if self.visible:
+            self._draw_artists()
+
+    def _draw_artists(self):
+        for ax, line, annotation in zip(self.axes, self.lines, self.annotations):
+            ax.draw_artist(line)
+            ax.draw_artist(annotation)
+
+    def _blit(self):
+        if self.background is None:
+            # 还没有完整绘制过，等待下一次重绘
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        if self.visible:
+            self._draw_artists()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+    def show(self, x: float, ys: list, text: str):
+        """在 x 处显示十字线，ys 为各子图注释箭头指向的y值"""
+        if not self.lines:
+            return
+        for line, annotation, y in zip(self.lines, self.annotations, ys):
+            line.set_xdata([x, x])
+            line.set_visible(True)
+            annotation.xy = (x, y)
+            annotation.set_text(text)
+            annotation.set_visible(True)
+        self.visible = True
+        self._blit()
+
+    def clear(self):
+        """子图清空时丢弃已失效的图元"""
+        self.lines = []
+        self.annotations = []
+        self.visible = False
+
+    def hide(self):
+        if not self.visible:
+            return
+        for artist in self.lines + self.annotations:
+            artist.set_visible(False)
+        self.visible = False
+        self._blit()
+
 
 class ChartView:
     def __init__(self, parent_frame):
@@ -18,6 +127,9 @@ class ChartView:
         self.ax1 = self.fig.add_subplot(311)  # 股价
         self.ax2 = self.fig.add_subplot(312)  # PE/PB值
         self.ax3 = self.fig.add_subplot(313)  # PE/PB百分位
+        # 对比模式下占满整个画布的百分位叠加图，与三个子图交替显示
+        self.ax_compare = self.fig.add_subplot(111)
+        self.ax_compare.set_visible(False)
 
         self.canvas = FigureCanvasTkAgg(self.fig, master=parent_frame)
         self.canvas.draw()
@@ -28,15 +140,26 @@ class ChartView:
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
         self.toolbar.pack(fill=tk.X)
 
-        # 垂直线
-        self.vline1 = None
-        self.vline2 = None
-        self.vline3 = None
-
-        # 注释框
-        self.annot1 = None
-        self.annot2 = None
-        self.annot3 = None
+        # 悬停十字线
+        self.crosshair = HoverCrosshair(self.canvas, [self.ax1, self.ax2, self.ax3])
+        self._date_nums = None
+        self._hover_values = None
+        self._hover_index = None
+
+        # 对比模式
+        self.compare_mode = False
+        self.compare_crosshair = HoverCrosshair(self.canvas, [self.ax_compare])
+        self._overlay = None
+        self._compare_names = {}
+        self._compare_nums = None
+        self._compare_values = None
+
+        # 按视图范围抽稀显示的曲线
+        self._lines = []
+        # 当前图元对应的 (股票代码, 名称, 估值类型)，相同时增量更新
+        self._structure = None
+        self._draw_pending = False
+        self._applied_layout = None
 
         self.data = None
         self.stock_code = ""
@@ -49,35 +172,32 @@ class ChartView:
     
     def _on_leave(self, event):
         """鼠标离开图表时清除悬停效果"""
-        self._clear_hover_elements()
-        self.canvas.draw_idle()
-    
-    def _clear_hover_elements(self):
-        """清除悬停元素"""
-        # 清除垂直线
-        if self.vline1:
-            self.vline1.remove()
-            self.vline1 = None
-        if self.vline2:
-            self.vline2.remove()
-            self.vline2 = None
-        if self.vline3:
-            self.vline3.remove()
-            self.vline3 = None
-
-        # 清除注释
-        if self.annot1:
-            self.annot1.remove()
-            self.annot1 = None
-        if self.annot2:
-            self.annot2.remove()
-            self.annot2 = None
-        if self.annot3:
-            self.annot3.remove()
-            self.annot3 = None
-    
+        self._hover_index = None
+        self.crosshair.hide()
+        self.compare_crosshair.hide()
+
+    def _prepare_hover(self, df):
+        """缓存悬停查找用的日期数字和各子图数值，鼠标移动时不再访问DataFrame"""
+        self._hover_index = None
+        if df is None or df.empty:
+            self._date_nums = None
+            return
+
+        config = VALUATION_TYPES.get(self.valuation_type, VALUATION_TYPES['PE'])
+        closes = df['close'].to_numpy(dtype=float)
+        output_col = config['output']
+        valuations = df[output_col].to_numpy(dtype=float) if output_col in df.columns else closes
+        percentile_col = f'{output_col}_percentile'
+        percentiles = (df[percentile_col].to_numpy(dtype=float) if percentile_col in df.columns
+                       else np.zeros(len(df)))
+        self._date_nums = mdates.date2num(pd.to_datetime(df['date']).to_numpy())
+        self._hover_values = (closes, valuations, percentiles)
+
     def _on_hover(self, event):
-        if self.data is None or self.data.empty:
+        if self.compare_mode:
+            self._on_compare_hover(event)
+            return
+        if self._date_nums is None:
             return
 
         if event.inaxes not in [self.ax1, self.ax2, self.ax3]:
@@ -87,186 +207,215 @@ class ChartView:
         if x is None:
             return
 
-        try:
-            # 将matplotlib的日期数字转换为datetime
-            x_date = mdates.num2date(x)
-            # 转换为naive datetime（去掉时区信息）以便比较
-            x_date = x_date.replace(tzinfo=None)
-        except:
+        # 找到最接近的数据点，距离太远不显示
+        i = nearest_index(self._date_nums, x)
+        if abs(self._date_nums[i] - x) > HOVER_MAX_DAYS:
             return
-
-        # 找到最接近的数据点
-        data_dates = pd.to_datetime(self.data['date'])
-        time_diffs = abs(data_dates - x_date)
-        closest_idx = time_diffs.idxmin()
-
-        # 如果距离太远，不显示
-        min_diff = time_diffs.min()
-        if min_diff.days > 5:  # 超过5天就不显示
+        if i == self._hover_index and self.crosshair.visible:
             return
+        self._hover_index = i
 
-        row = self.data.loc[closest_idx]
-
-        date_str = row['date'].strftime('%Y-%m-%d')
-        close = row['close']
-
-        # 根据估值类型获取对应的数据
-        if self.valuation_type == 'PE':
-            valuation_value = row.get('pe', close)
-            percentile = row.get('pe_percentile', 0)
-            valuation_label = "PE"
-        else:  # PB
-            valuation_value = row.get('pb', close)
-            percentile = row.get('pb_percentile', 0)
-            valuation_label = "PB"
+        close, valuation_value, percentile = (values[i] for values in self._hover_values)
+        x_num = self._date_nums[i]
+        date_str = mdates.num2date(x_num).strftime('%Y-%m-%d')
+        valuation_label = VALUATION_TYPES.get(self.valuation_type, VALUATION_TYPES['PE'])['short_name']
 
         # 获取当前数据点的y值
         y1 = close
         y2 = valuation_value if pd.notna(valuation_value) else 0
         y3 = percentile if pd.notna(percentile) else 0
 
-        # 获取鼠标所在的x坐标（matplotlib日期格式）
-        x_num = mdates.date2num(row['date'])
-
         info_text = f"日期: {date_str}\n股价: {close:.2f}\n{valuation_label}: {valuation_value:.2f}\n百分位: {percentile:.2f}%"
 
-        self._update_hover_display(x_num, y1, y2, y3, info_text)
-    
-    def _update_hover_display(self, x, y1, y2, y3, text):
-        """更新悬停显示效果"""
-        self._clear_hover_elements()
-
-        # 在第一个子图（股价）添加垂直线和注释
-        self.vline1 = self.ax1.axvline(x=x, color='gray', linestyle='--', alpha=0.7, linewidth=1)
-        self.annot1 = self.ax1.annotate(
-            text,
-            xy=(x, y1),
-            xytext=(15, 15),
-            textcoords='offset points',
-            bbox=dict(boxstyle='round,pad=0.5', fc='yellow', alpha=0.9, ec='orange'),
-            fontsize=9,
-            arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color='orange')
-        )
-
-        # 在第二个子图（PE/PB值）添加垂直线和注释
-        self.vline2 = self.ax2.axvline(x=x, color='gray', linestyle='--', alpha=0.7, linewidth=1)
-        self.annot2 = self.ax2.annotate(
-            text,
-            xy=(x, y2),
-            xytext=(15, 15),
-            textcoords='offset points',
-            bbox=dict(boxstyle='round,pad=0.5', fc='lightgreen', alpha=0.9, ec='green'),
-            fontsize=9,
-            arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color='green')
-        )
-
-        # 在第三个子图（百分位）添加垂直线和注释
-        self.vline3 = self.ax3.axvline(x=x, color='gray', linestyle='--', alpha=0.7, linewidth=1)
-        self.annot3 = self.ax3.annotate(
-            text,
-            xy=(x, y3),
-            xytext=(15, 15),
-            textcoords='offset points',
-            bbox=dict(boxstyle='round,pad=0.5', fc='lightblue', alpha=0.9, ec='blue'),
-            fontsize=9,
-            arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color='blue')
-        )
+        self.crosshair.show(x_num, [y1, y2, y3], info_text)
+
+    def _on_compare_hover(self, event):
+        """对比模式：显示鼠标所在交易日各股票的百分位"""
+        if self._compare_nums is None or not len(self._compare_nums) or event.inaxes is not self.ax_compare:
+            return
+        x = event.xdata
+        if x is None:
+            return
+
+        i = nearest_index(self._compare_nums, x)
+        if abs(self._compare_nums[i] - x) > HOVER_MAX_DAYS:
+            return
+        if i == self._hover_index and self.compare_crosshair.visible:
+            return
+        self._hover_index = i
+
+        x_num = self._compare_nums[i]
+        row = self._compare_values[i]
+        lines = [f"日期: {mdates.num2date(x_num).strftime('%Y-%m-%d')}"]
+        for (code, name), value in zip(self._compare_names.items(), row):
+            if not np.isnan(value):
+                lines.append(f"{name or code}: {value:.2f}%")
+        if len(lines) == 1:
+            return
+        self.compare_crosshair.show(x_num, [np.nanmean(row)], '\n'.join(lines))
+
+    def _set_compare_mode(self, enabled: bool):
+        """在三栏图和对比图之间切换（只切换坐标轴的可见性，各自的图元保留）"""
+        if enabled == self.compare_mode:
+            return
+        self.compare_mode = enabled
+        self._hover_index = None
+        self.crosshair.hide()
+        self.compare_crosshair.hide()
+        for ax in [self.ax1, self.ax2, self.ax3]:
+            ax.set_visible(not enabled)
+        self.ax_compare.set_visible(enabled)
+
+    def plot_comparison(self, series: dict, aligned, names: dict, valuation_type='PE') -> set:
+        """
+        绘制多只股票的百分位对比（见 comparison.PercentileComparison）
+        只重绘新增、移除或数据变化的股票的曲线，估值类型变化时重建整张图
+
+        Args:
+            series: {代码: 百分位序列}
+            aligned: 对齐到同一交易日索引的百分位（列为代码），用于悬停显示
+            names: {代码: 名称}
+
+        Returns:
+            重新绘制的股票代码
+        """
+        self._set_compare_mode(True)
+        if self._overlay is None or self._overlay.valuation_type != valuation_type:
+            self.compare_crosshair.clear()
+            self.ax_compare.clear()
+            self._overlay = ComparisonOverlay(self.ax_compare, valuation_type)
+            self.ax_compare.callbacks.connect('xlim_changed', self._on_xlim_changed)
+
+        changed = self._overlay.sync(series, names)
+        self.compare_crosshair.hide()
+        self._hover_index = None
+        self._compare_names = {code: names.get(code, code) for code in aligned.columns}
+        self._compare_nums = mdates.date2num(aligned.index.to_numpy())
+        self._compare_values = aligned.to_numpy(dtype=float)
+
+        x_range = self._overlay.x_range()
+        if changed and x_range:
+            x0, x1 = x_range
+            margin = max((x1 - x0) * VIEW_MARGIN, 1)
+            self.ax_compare.set_xlim(x0 - margin, x1 + margin)
+            if not self.compare_crosshair.lines:
+                self.compare_crosshair.create_artists(x0)
+        self._request_draw()
+        return changed
 
-        self.canvas.draw_idle()
-    
     def plot_data(self, df, stock_code, stock_name=None, start_date_idx=0, valuation_type='PE'):
+        """
+        绘制数据，start_date_idx 为显示范围的第一个数据点
+        同一股票、同一估值类型只在第一次绘制时创建图元，之后更换数据（如日期范围变化）只更新曲线数据，
+        移动滑块只改变坐标轴范围，重绘请求合并后统一执行
+        """
+        self._set_compare_mode(False)
+        structure = (stock_code, stock_name, valuation_type)
+        if self._lines and df is not None and not df.empty and structure == self._structure:
+            if df is not self.data:
+                self.data = df
+                self.crosshair.hide()
+                self._prepare_hover(df)
+                dates, values = panel_series(df, self.valuation_type)
+                for line, series in zip(self._lines, values):
+                    line.set_series(dates, series)
+            self._set_view(start_date_idx)
+            self._request_draw()
+            return
+
         self.data = df
         self.stock_code = stock_code
         self.stock_name = stock_name or stock_code
         self.valuation_type = valuation_type
+        self._structure = structure
+        self._prepare_hover(df)
 
-        # 清除之前的悬停元素
-        self._clear_hover_elements()
-
+        self.crosshair.clear()
+        self._lines = []
         self.ax1.clear()
         self.ax2.clear()
         self.ax3.clear()
 
         if df is None or df.empty:
+            self._structure = None
             self.ax1.text(0.5, 0.5, '无数据', ha='center', va='center', transform=self.ax1.transAxes)
-            self.canvas.draw()
+            self._request_draw()
             return
 
-        df_plot = df.iloc[start_date_idx:].copy()
-
-        if df_plot.empty:
-            df_plot = df.copy()
-
-        dates = df_plot['date']
-        closes = df_plot['close']
-
-        # 根据估值类型获取数据
-        if valuation_type == 'PE':
-            valuation_values = df_plot.get('pe', pd.Series([0]*len(df_plot)))
-            percentiles = df_plot.get('pe_percentile', df_plot.get('percentile', pd.Series([0]*len(df_plot))))
-            valuation_value_title = 'PE值走势'
-            valuation_percentile_title = 'PE历史百分位'
-            valuation_value_label = 'PE值'
-            valuation_percentile_label = 'PE百分位'
-            line_color = 'purple'
-            fill_color = 'purple'
-        else:  # PB
-            valuation_values = df_plot.get('pb', pd.Series([0]*len(df_plot)))
-            percentiles = df_plot.get('pb_percentile', df_plot.get('percentile', pd.Series([0]*len(df_plot))))
-            valuation_value_title = 'PB值走势'
-            valuation_percentile_title = 'PB历史百分位'
-            valuation_value_label = 'PB值'
-            valuation_percentile_label = 'PB百分位'
-            line_color = 'darkblue'
-            fill_color = 'blue'
-
-        # 第一个子图：绘制股价图
-        self.ax1.plot(dates, closes, 'b-', linewidth=1.5, label='收盘价')
-        # 显示股票代码和公司名
-        display_name = f'{stock_code} ({stock_name})' if stock_name and stock_name != stock_code else stock_code
-        self.ax1.set_title(f'{display_name} - 股价走势', fontsize=12, fontweight='bold')
-        self.ax1.set_ylabel('价格', fontsize=10)
-        self.ax1.grid(True, alpha=0.3)
-        self.ax1.legend(loc='upper left')
-
-        self.ax1.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        self.ax1.xaxis.set_major_locator(mdates.MonthLocator(interval=6))
-        plt.setp(self.ax1.xaxis.get_majorticklabels(), rotation=45)
-
-        # 第二个子图：绘制PE/PB值图
-        self.ax2.plot(dates, valuation_values, color='green', linewidth=1.5, label=valuation_value_label)
-        self.ax2.set_title(valuation_value_title, fontsize=12)
-        self.ax2.set_ylabel(valuation_value_label, fontsize=10)
-        self.ax2.grid(True, alpha=0.3)
-        self.ax2.legend(loc='upper left')
-
-        self.ax2.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        self.ax2.xaxis.set_major_locator(mdates.MonthLocator(interval=6))
-        plt.setp(self.ax2.xaxis.get_majorticklabels(), rotation=45)
-
-        # 第三个子图：绘制估值百分位图
-        self.ax3.plot(dates, percentiles, color=line_color, linewidth=1.5, label=valuation_percentile_label)
-        self.ax3.axhline(y=30, color='green', linestyle='--', alpha=0.5, label='30% (低估)')
-        self.ax3.axhline(y=70, color='red', linestyle='--', alpha=0.5, label='70% (高估)')
-        self.ax3.fill_between(dates, 0, percentiles, alpha=0.3, color=fill_color)
-
-        self.ax3.set_title(valuation_percentile_title, fontsize=12)
-        self.ax3.set_xlabel('日期', fontsize=10)
-        self.ax3.set_ylabel('百分位 (%)', fontsize=10)
-        self.ax3.set_ylim(0, 100)
-        self.ax3.grid(True, alpha=0.3)
-        self.ax3.legend(loc='upper left')
-
-        self.ax3.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        self.ax3.xaxis.set_major_locator(mdates.MonthLocator(interval=6))
-        plt.setp(self.ax3.xaxis.get_majorticklabels(), rotation=45)
-
-        self.fig.tight_layout()
-        self.canvas.draw()
+        # 曲线按像素抽稀，缩放/平移后重新抽稀（子图清空时回调也被清除，每次重新注册）
+        self._lines = draw_panels([self.ax1, self.ax2, self.ax3], df, stock_code, stock_name, valuation_type)
+
+        # 子图清空后重新创建十字线，初始位置取第一个数据点
+        self.crosshair.create_artists(self._date_nums[0])
+
+        self._set_view(start_date_idx)
+        for ax in [self.ax1, self.ax2, self.ax3]:
+            ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        self._request_draw()
+
+    def _set_view(self, start_idx: int):
+        """显示从 start_idx 到最后的数据：设置x范围，价格和估值子图的y范围按显示区间的数据调整"""
+        date_nums = self._date_nums
+        start_idx = min(max(start_idx, 0), len(date_nums) - 1)
+        x0, x1 = date_nums[start_idx], date_nums[-1]
+        margin = max((x1 - x0) * VIEW_MARGIN, 1)
+        for ax in [self.ax1, self.ax2, self.ax3]:
+            ax.set_xlim(x0 - margin, x1 + margin)
+
+        for line in self._lines[:2]:
+            ax, visible = line.ax, line.y[start_idx:]
+            if np.isnan(visible).all():
+                continue
+            y0, y1 = np.nanmin(visible), np.nanmax(visible)
+            margin = (y1 - y0) * VIEW_MARGIN or max(abs(y1) * VIEW_MARGIN, 1)
+            ax.set_ylim(y0 - margin, y1 + margin)
+
+    def _layout_key(self):
+        """影响子图布局的因素：画布大小、标题，以及决定刻度标签宽度的y轴数量级"""
+        axes = [self.ax_compare] if self.compare_mode else [self.ax1, self.ax2, self.ax3]
+        digits = tuple(len(f'{max(abs(v) for v in ax.get_ylim()):.0f}') for ax in axes)
+        titles = tuple(ax.get_title() for ax in axes)
+        return tuple(self.fig.get_size_inches()), titles, digits
+
+    def _request_draw(self):
+        """请求重绘，REDRAW_INTERVAL_MS 内的多次请求合并为一次"""
+        if self._draw_pending:
+            return
+        self._draw_pending = True
+        self.canvas.get_tk_widget().after(REDRAW_INTERVAL_MS, self._flush_draw)
+
+    def _flush_draw(self):
+        self._draw_pending = False
+        # 只有布局可能变化时才重新计算 tight_layout
+        layout_key = self._layout_key()
+        if layout_key != self._applied_layout:
+            self.fig.tight_layout()
+            self._applied_layout = layout_key
+            # 布局后坐标轴宽度变化，按实际像素宽度重新抽稀
+            self._update_lod()
+        self.canvas.draw_idle()
+
+    def _all_lines(self) -> list:
+        overlay_lines = list(self._overlay.lines.values()) if self._overlay else []
+        return self._lines + overlay_lines
+
+    def _on_xlim_changed(self, ax):
+        """坐标轴范围变化（滑块、工具栏缩放/平移）后重新抽稀该子图的曲线"""
+        for line in self._all_lines():
+            if line.ax is ax:
+                line.update()
+
+    def _update_lod(self):
+        for line in self._all_lines():
+            line.update()
 
     def clear(self):
-        self._clear_hover_elements()
+        self._set_compare_mode(False)
+        self._prepare_hover(None)
+        self.crosshair.clear()
+        self._lines = []
+        self._structure = None
         self.ax1.clear()
         self.ax2.clear()
         self.ax3.clear()
-        self.canvas.draw()
+        self._request_draw()
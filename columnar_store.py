@@ -0,0 +1,283 @@
+"""
+列式历史数据存储
+每只股票一个目录，每列一个 .npy 文件（日期按天存储，标志列为int8，数值列为float64），
+读取时直接内存映射，不需要逐行解析和类型转换，返回的DataFrame保持这些类型；
+每次写入生成一个新的版本子目录，再用 os.replace 原子替换指向当前版本的 CURRENT 文件；
+股票记忆、百分位缓存等元数据仍保存在 SQLite 中
+用法: python columnar_store.py --migrate   从 stock_data.db 迁移全部日线
+"""
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from config import COLUMNAR_DATA_DIR, COLUMNAR_MMAP
+from database import StockDatabase, STOCK_HISTORY_COLUMNS
+
+# 取值为小整数的标志列，缺失值存为 -1
+FLAG_COLUMNS = ['adjustflag', 'tradestatus', 'isST']
+FLAG_MISSING = -1
+
+# 其余列按 float64 存储（NaN 表示缺失）
+FLOAT_COLUMNS = [col for col in STOCK_HISTORY_COLUMNS if col not in ['date', 'code'] + FLAG_COLUMNS]
+
+# 股票目录中记录当前版本子目录名的文件
+CURRENT_FILE = 'CURRENT'
+
+# 读取期间当前版本被替换并清理时的重试次数
+READ_RETRIES = 3
+
+
+def current_version_dir(stock_dir: str):
+    """
+    股票当前版本的列文件目录，没有数据时返回None
+    没有 CURRENT 文件但目录中直接有列文件时为旧的平铺格式
+    """
+    try:
+        with open(os.path.join(stock_dir, CURRENT_FILE), encoding='utf-8') as f:
+            return os.path.join(stock_dir, f.read().strip())
+    except FileNotFoundError:
+        return stock_dir if os.path.isfile(os.path.join(stock_dir, 'date.npy')) else None
+
+
+def load_stock_columns(data_dir: str, stock_code: str, columns: list = None, mmap_mode: str = None) -> dict:
+    """
+    读取一只股票的列数组
+
+    Args:
+        data_dir: 列文件根目录
+        stock_code: 股票代码
+        columns: 需要的列（日期总会读取），None 表示全部
+        mmap_mode: 传给 np.load 的内存映射模式
+
+    Returns:
+        {列名: ndarray}，日期为 datetime64[D]；没有数据时返回空字典
+    """
+    stock_dir = os.path.join(data_dir, stock_code)
+    names = ['date'] + [col for col in FLOAT_COLUMNS + FLAG_COLUMNS if columns is None or col in columns]
+    for _ in range(READ_RETRIES):
+        version_dir = current_version_dir(stock_dir)
+        if version_dir is None:
+            return {}
+        try:
+            arrays = {}
+            for name in names:
+                path = os.path.join(version_dir, f'{name}.npy')
+                if os.path.isfile(path):
+                    arrays[name] = np.load(path, mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            continue
+        # 读取期间该版本被清理时部分列可能已不存在，按新的 CURRENT 重新读取
+        if 'date' in arrays and os.path.isdir(version_dir):
+            return arrays
+    raise RuntimeError(f"{stock_code} 的列文件在读取期间持续变化")
+
+
+def _missing(name: str, length: int) -> np.ndarray:
+    """某列在一侧数据中不存在时的缺失值填充"""
+    if name in FLAG_COLUMNS:
+        return np.full(length, FLAG_MISSING, dtype=np.int8)
+    return np.full(length, np.nan)
+
+
+class ColumnarStockStore(StockDatabase):
+    """
+    列式存储后端，接口与 StockDatabase 相同
+    stock_history 表不再使用，日线保存在 data_dir/<股票代码>/<版本>/<列名>.npy
+    """
+
+    def __init__(self, data_dir: str = None, db_path: str = None, mmap: bool = COLUMNAR_MMAP):
+        """
+        Args:
+            data_dir: 列文件根目录
+            db_path: 元数据SQLite路径
+            mmap: 是否以内存映射方式读取（Windows下映射中的文件无法被替换，默认关闭）
+        """
+        super().__init__(db_path)
+        self.data_dir = data_dir or COLUMNAR_DATA_DIR
+        self.mmap_mode = 'r' if mmap else None
+        self._write_lock = threading.Lock()
+        os.makedirs(self.data_dir, exist_ok=True)
+
+    def __reduce__(self):
+        return type(self), (self.data_dir, self.db_path, self.mmap_mode is not None)
+
+    def _stock_dir(self, stock_code: str) -> str:
+        return os.path.join(self.data_dir, stock_code)
+
+    def list_codes(self) -> list:
+        """已保存的股票代码"""
+        return sorted(name for name in os.listdir(self.data_dir)
+                      if current_version_dir(os.path.join(self.data_dir, name)) is not None)
+
+    def load_columns(self, stock_code: str, columns: list = None) -> dict:
+        """读取一只股票的列数组，见 load_stock_columns"""
+        return load_stock_columns(self.data_dir, stock_code, columns, self.mmap_mode)
+
+    @staticmethod
+    def _to_columns(df: pd.DataFrame) -> dict:
+        """将下载/查询得到的DataFrame转换为带类型的列数组"""
+        arrays = {'date': pd.to_datetime(df['date']).to_numpy().astype('datetime64[D]')}
+        for col in FLOAT_COLUMNS:
+            if col in df.columns:
+                arrays[col] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64)
+        for col in FLAG_COLUMNS:
+            if col in df.columns:
+                values = pd.to_numeric(df[col], errors='coerce')
+                arrays[col] = values.fillna(FLAG_MISSING).to_numpy().astype(np.int8)
+        return arrays
+
+    def _write_columns(self, stock_code: str, arrays: dict):
+        """
+        写入新的版本子目录，再原子替换 CURRENT 指向它
+        任何时刻都存在一个完整的当前版本，读取方不会看到写了一半或不存在的数据，
+        替换前崩溃时仍保留旧版本；上一个版本保留到下一次写入，正在读取它的一方不受影响
+        """
+        stock_dir = self._stock_dir(stock_code)
+        os.makedirs(stock_dir, exist_ok=True)
+        current = current_version_dir(stock_dir)
+        previous = os.path.basename(current) if current and current != stock_dir else None
+
+        number = int(previous[1:]) + 1 if previous else 1
+        while os.path.exists(os.path.join(stock_dir, f'v{number}')):
+            number += 1
+        version = f'v{number}'
+        version_dir = os.path.join(stock_dir, version)
+        os.makedirs(version_dir)
+        for name, values in arrays.items():
+            np.save(os.path.join(version_dir, f'{name}.npy'), values)
+
+        pointer = os.path.join(stock_dir, CURRENT_FILE + '.tmp')
+        with open(pointer, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(stock_dir, CURRENT_FILE))
+
+        # 清理更早的版本、未完成的写入和旧的平铺格式文件
+        for name in os.listdir(stock_dir):
+            path = os.path.join(stock_dir, name)
+            if name in (version, previous, CURRENT_FILE):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.npy'):
+                os.remove(path)
+
+    def save_stock_data(self, df: pd.DataFrame, stock_code: str) -> tuple:
+        """
+        合并保存股票数据（同一日期的旧数据被替换）
+
+        Returns:
+            (新增条数, 更新条数)
+        """
+        if df.empty:
+            return 0, 0
+
+        new = self._to_columns(df)
+        # 同一批数据中重复的日期只保留最后一行
+        dates, last_index = np.unique(new['date'][::-1], return_index=True)
+        new = {name: values[::-1][last_index] for name, values in new.items()}
+
+        with self._write_lock:
+            old = {name: np.array(values) for name, values in self.load_columns(stock_code).items()}
+            if not old:
+                inserted, updated = len(dates), 0
+                self._write_columns(stock_code, new)
+            else:
+                keep = ~np.isin(old['date'], dates)
+                updated = len(old['date']) - int(keep.sum())
+                inserted = len(dates) - updated
+
+                merged = {}
+                for name in set(old) | set(new):
+                    old_part = old[name][keep] if name in old else _missing(name, int(keep.sum()))
+                    new_part = new[name] if name in new else _missing(name, len(dates))
+                    merged[name] = np.concatenate([old_part, new_part])
+
+                order = np.argsort(merged['date'], kind='stable')
+                self._write_columns(stock_code, {name: values[order] for name, values in merged.items()})
+
+        # 与 SQLite 后端一致：新数据写入后让百分位缓存失效
+        with self.get_connection() as conn:
+            self._invalidate_percentiles(conn, stock_code, str(dates[0]))
+
+        return inserted, updated
+
+    def get_stock_data(self, stock_code: str, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        读取区间日线，列与 StockDatabase.get_stock_data 相同（没有 id 列），但保持列文件的类型：
+        date 为 datetime64，标志列为 int8（缺失为 FLAG_MISSING），其余为 float64；
+        需要数值的使用方（pd.to_datetime、pd.to_numeric）与SQLite后端的字符串结果用法相同
+        """
+        arrays = self.load_columns(stock_code)
+        if not arrays:
+            return pd.DataFrame(columns=STOCK_HISTORY_COLUMNS)
+
+        dates = arrays['date']
+        lo = np.searchsorted(dates, np.datetime64(start_date, 'D')) if start_date else 0
+        hi = np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right') if end_date else len(dates)
+
+        # 列数组按日期有序，区间筛选只是切片，切片直接作为列，不做逐行转换
+        length = hi - lo
+        columns = {}
+        for col in STOCK_HISTORY_COLUMNS:
+            if col == 'code':
+                columns[col] = np.full(length, stock_code, dtype=object)
+            elif col in arrays:
+                columns[col] = arrays[col][lo:hi]
+            else:
+                columns[col] = _missing(col, length)
+        return pd.DataFrame(columns, copy=False)
+
+    def get_last_update_date(self, stock_code: str) -> str:
+        dates = self.load_columns(stock_code, columns=[]).get('date')
+        if dates is None or len(dates) == 0:
+            return None
+        return str(dates[-1])
+
+    def delete_stock_data(self, stock_code: str):
+        with self._write_lock:
+            shutil.rmtree(self._stock_dir(stock_code), ignore_errors=True)
+        super().delete_stock_data(stock_code)
+
+
+def migrate_from_sqlite(db_path: str = None, data_dir: str = None, progress=print) -> int:
+    """
+    将 SQLite stock_history 中的全部日线迁移到列式存储
+
+    Returns:
+        迁移的股票数量
+    """
+    source = StockDatabase(db_path)
+    target = ColumnarStockStore(data_dir, db_path=db_path)
+    codes = [row[0] for row in source.get_connection().execute(
+        'SELECT DISTINCT code FROM stock_history ORDER BY code')]
+
+    for i, code in enumerate(codes, 1):
+        # SQLite中的数据已按日期排序且无重复，整体覆盖写入
+        df = source.get_stock_data(code)
+        target._write_columns(code, target._to_columns(df))
+        if progress:
+            progress(f"[{i}/{len(codes)}] {code}: {len(df)} 条")
+    return len(codes)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='列式历史数据存储')
+    parser.add_argument('--migrate', action='store_true', help='从SQLite数据库迁移全部日线')
+    parser.add_argument('--db', default=None, help='SQLite数据库路径')
+    parser.add_argument('--dir', default=None, help='列文件目录')
+    args = parser.parse_args()
+
+    if args.migrate:
+        count = migrate_from_sqlite(args.db, args.dir)
+        print(f"迁移完成，共 {count} 只股票")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
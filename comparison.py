@@ -0,0 +1,135 @@
+"""
+多只股票估值百分位对比
+各股票的区间百分位来自持久化缓存（与界面、批量渲染共用），按日期外连接对齐到同一交易日索引；
+加入或移除股票时只对齐变化的那一列，已有股票的序列对象保持不变
+"""
+import pandas as pd
+
+from config import VALUATION_TYPES
+from database import StockDatabase, open_database
+from percentile_cache import PercentileCache
+
+
+def percentile_series(frame: pd.DataFrame, valuation_type: str) -> pd.Series:
+    """从全部估值类型的百分位结果中取出一种，以日期为索引并去掉缺失值"""
+    config = VALUATION_TYPES.get(valuation_type, VALUATION_TYPES['PE'])
+    percentile_col = f"{config['output']}_percentile"
+    if frame.empty or percentile_col not in frame.columns:
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([], name='date'))
+    series = pd.Series(frame[percentile_col].to_numpy(dtype=float),
+                       index=pd.DatetimeIndex(pd.to_datetime(frame['date']), name='date'))
+    return series.dropna()
+
+
+def align_series(series: dict) -> pd.DataFrame:
+    """按日期外连接对齐，返回 日期 × 股票代码 的DataFrame，某只股票当天没有数据时为NaN"""
+    if not series:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='date'), dtype=float)
+    return pd.concat(series, axis=1, join='outer', sort=True)
+
+
+class PercentileComparison:
+    """
+    对比集合，按加入顺序保存各股票全部估值类型的区间百分位
+    load() 只读取数据，可在后台线程中调用；add()/remove() 修改集合，在界面线程中调用
+    """
+
+    def __init__(self, start_date: str, end_date: str, db: StockDatabase = None, cache: PercentileCache = None):
+        self.db = db or open_database()
+        self.cache = cache or PercentileCache(self.db)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.names = {}      # 代码 -> 名称，保持加入顺序
+        self._frames = {}    # 代码 -> 全部估值类型的百分位
+        self._series = {}    # 估值类型 -> {代码: 百分位序列}
+        self._aligned = {}   # 估值类型 -> 对齐后的DataFrame
+
+    @property
+    def codes(self) -> list:
+        return list(self.names)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def match(self, text: str):
+        """
+        在已加入的股票中查找输入的代码，支持带前缀的代码和裸代码（如 600519），找不到时返回None
+        只比较已加入的代码，不查询证券主表或服务器，可在界面线程中调用
+        """
+        text = text.strip().lower()
+        if text in self.names:
+            return text
+        matches = [code for code in self.names if code.split('.')[-1] == text]
+        return matches[0] if matches else None
+
+    @property
+    def unloaded(self) -> list:
+        """已加入但尚未加载当前区间数据的股票（如更换区间后）"""
+        return [code for code in self.names if code not in self._frames]
+
+    def load(self, code: str, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """读取一只股票全部估值类型的区间百分位（优先读取缓存）"""
+        return self.cache.get_range_percentiles(code, start_date or self.start_date, end_date or self.end_date)
+
+    def set_range(self, start_date: str, end_date: str) -> bool:
+        """
+        更换日期区间，已加载的数据作废（股票列表保留，需重新 load/add）
+
+        Returns:
+            区间是否变化
+        """
+        if (start_date, end_date) == (self.start_date, self.end_date):
+            return False
+        self.start_date, self.end_date = start_date, end_date
+        self._frames.clear()
+        self._series.clear()
+        self._aligned.clear()
+        return True
+
+    def add(self, code: str, name: str, frame: pd.DataFrame):
+        """加入（或替换）一只股票，只把这一列对齐到已有结果上"""
+        if code in self._frames:
+            self._drop(code)
+        self.names[code] = name or code
+        self._frames[code] = frame
+        for valuation_type, series in self._series.items():
+            series[code] = percentile_series(frame, valuation_type)
+            if valuation_type in self._aligned:
+                aligned = self._aligned[valuation_type]
+                self._aligned[valuation_type] = aligned.join(series[code].rename(code), how='outer', sort=True)
+
+    def remove(self, code: str):
+        """移除一只股票"""
+        if code in self._frames:
+            self._drop(code)
+        self.names.pop(code, None)
+
+    def _drop(self, code: str):
+        del self._frames[code]
+        for valuation_type, series in self._series.items():
+            series.pop(code, None)
+            if valuation_type in self._aligned:
+                # 去掉只有这只股票有数据的日期
+                aligned = self._aligned[valuation_type].drop(columns=code)
+                self._aligned[valuation_type] = aligned.dropna(how='all')
+
+    def series(self, valuation_type: str) -> dict:
+        """
+        各股票的百分位序列 {代码: Series}，按加入顺序
+        数据未变化的股票每次返回同一个对象，绘图时据此判断哪些曲线需要更新
+        """
+        if valuation_type not in self._series:
+            self._series[valuation_type] = {code: percentile_series(frame, valuation_type)
+                                            for code, frame in self._frames.items()}
+        series = self._series[valuation_type]
+        return {code: series[code] for code in self.names if code in series}
+
+    def aligned(self, valuation_type: str) -> pd.DataFrame:
+        """对齐到同一交易日索引的百分位，列为股票代码（按加入顺序）"""
+        if valuation_type not in self._aligned:
+            self._aligned[valuation_type] = align_series(self.series(valuation_type))
+        aligned = self._aligned[valuation_type]
+        return aligned[[code for code in self.names if code in aligned.columns]]
@@ -3,8 +3,70 @@ import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'stock_data.db')
 
+# SQLite连接参数，每个新连接创建时设置
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',        # 写入时不阻塞读取
+    'synchronous': 'NORMAL',      # WAL模式下NORMAL即可保证数据一致
+    'cache_size': -65536,         # 页缓存64MB（负数单位为KB）
+    'mmap_size': 268435456,       # 256MB内存映射读取
+    'temp_store': 'MEMORY',
+}
+
+# 日线存储后端: 'sqlite' 使用 stock_history 表，'columnar' 使用按列的 .npy 文件
+STORAGE_BACKEND = 'sqlite'
+COLUMNAR_DATA_DIR = os.path.join(BASE_DIR, 'stock_columns')
+# 列文件内存映射读取（Windows下映射中的文件不能被替换，因此关闭）
+COLUMNAR_MMAP = os.name != 'nt'
+
 DEFAULT_YEARS = 10
 
+# 批量下载的并行进程数
+FETCH_WORKERS = 4
+
+# 自选股后台预取：并行下载数、失败后首次重试间隔和最长重试间隔（秒）
+PREFETCH_WORKERS = 2
+PREFETCH_RETRY_BASE_SECONDS = 300
+PREFETCH_RETRY_MAX_SECONDS = 6 * 3600
+
+# 全市场回填：每个工作单元的年数、并行进程数、失败重试次数和首次重试间隔（秒）
+BACKFILL_CHUNK_YEARS = 1
+BACKFILL_WORKERS = 4
+BACKFILL_MAX_ATTEMPTS = 5
+BACKFILL_RETRY_BASE_SECONDS = 30
+
+# 批量渲染估值图：输出目录、并行进程数、图片尺寸（英寸）和分辨率
+REPORT_OUTPUT_DIR = os.path.join(BASE_DIR, 'reports')
+REPORT_WORKERS = 4
+REPORT_FIGSIZE = (12, 10)
+REPORT_DPI = 100
+
+# 下载时每接收多少行写入一次数据库
+INGEST_CHUNK_ROWS = 500
+
+# 证券主表超过该天数后重新从baostock全量加载
+SECURITY_MASTER_MAX_AGE_DAYS = 7
+
+# 行情数据源: 'baostock' 在线查询，'replay' 回放 REPLAY_DATA_DIR 中录制的数据（离线测试、压测）
+DATA_PROVIDER = 'baostock'
+REPLAY_DATA_DIR = os.path.join(BASE_DIR, 'replay_data')
+# 回放时每次查询的模拟延迟（秒）
+REPLAY_LATENCY = 0.0
+
+# baostock访问：每个进程每秒请求数上限和允许的突发请求数，
+# 网络错误或会话失效时的重试次数和首次重试间隔（秒，之后每次翻倍并加随机抖动）
+PROVIDER_RATE_LIMIT = 20.0
+PROVIDER_BURST = 10
+PROVIDER_MAX_RETRIES = 4
+PROVIDER_RETRY_BASE_SECONDS = 0.5
+
+# 交易日历起始日期（沪市开市）
+TRADE_CALENDAR_START = '1990-12-19'
+# 当日日线数据可以下载的时间（收盘后数据入库需要一段时间）
+DATA_READY_TIME = '17:30'
+
+# 百分位结果缓存最多保留的条目数（按最近访问时间淘汰）
+PERCENTILE_CACHE_MAX_ENTRIES = 200
+
 STOCK_FIELDS = "date,code,open,high,low,close,preclose,volume,amount,adjustflag,turn,tradestatus,pctChg,isST,peTTM,pbMRQ,psTTM,pcfNcfTTM"
 
 # 时间范围配置
@@ -17,11 +79,14 @@ TIME_RANGES = {
 }
 
 # 估值类型配置
+# column: 数据库中的字段名; output: 计算结果中的输出列前缀（如 pe / pe_percentile）
 VALUATION_TYPES = {
     'PE': {
         'name': '市盈率',
         'short_name': 'PE',
         'description': '股价/每股收益',
+        'column': 'peTTM',
+        'output': 'pe',
         'low_threshold': 30,   # 低估阈值
         'high_threshold': 70   # 高估阈值
     },
@@ -29,7 +94,27 @@ VALUATION_TYPES = {
         'name': '市净率',
         'short_name': 'PB',
         'description': '股价/每股净资产',
+        'column': 'pbMRQ',
+        'output': 'pb',
+        'low_threshold': 30,
+        'high_threshold': 70
+    },
+    'PS': {
+        'name': '市销率',
+        'short_name': 'PS',
+        'description': '股价/每股营业收入',
+        'column': 'psTTM',
+        'output': 'ps',
+        'low_threshold': 30,
+        'high_threshold': 70
+    },
+    'PCF': {
+        'name': '市现率',
+        'short_name': 'PCF',
+        'description': '股价/每股现金流',
+        'column': 'pcfNcfTTM',
+        'output': 'pcf',
         'low_threshold': 30,
         'high_threshold': 70
     }
-}
\ No newline at end of file
+}
@@ -1,16 +1,71 @@
-import baostock as bs
+import threading
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from database import StockDatabase
-from config import STOCK_FIELDS, DEFAULT_YEARS
+from database import open_database
+from data_provider import create_provider
+from config import (STOCK_FIELDS, DEFAULT_YEARS, FETCH_WORKERS, INGEST_CHUNK_ROWS, SECURITY_MASTER_MAX_AGE_DAYS,
+                    TRADE_CALENDAR_START, DATA_READY_TIME)
+
+
+class FetchError(Exception):
+    """行情服务返回错误"""
+
+
+# 需要转换为数值的字段
+NUMERIC_COLUMNS = ['open', 'high', 'low', 'close', 'preclose', 'volume',
+                   'amount', 'turn', 'pctChg', 'peTTM', 'pbMRQ', 'psTTM', 'pcfNcfTTM']
+
+# 批量下载工作进程（或线程）中复用的DataFetcher（每个工作者登录一次）
+# 线程池模式下每个线程各有一个，并发的多个工作池也互不覆盖
+_worker_state = threading.local()
+
+
+def _init_fetch_worker(db, provider):
+    _worker_state.fetcher = DataFetcher(db=db, provider=provider)
+
+
+def _prepare_fetch_worker():
+    """在工作者中准备好证券主表和交易日历，之后的下载直接读取"""
+    fetcher = _worker_state.fetcher
+    fetcher._ensure_security_master()
+    fetcher._ensure_trade_calendar()
+
+
+def _fetch_worker(stock_code: str, start_date: str, end_date: str, force_update: bool) -> tuple:
+    """
+    批量下载的工作函数，只下载不写库（写入统一在主进程进行）
+
+    Returns:
+        (输入代码, 标准化代码, 股票名称, 新数据DataFrame, 错误信息)
+    """
+    fetcher = _worker_state.fetcher
+    try:
+        normalized_code = fetcher.try_normalize_stock_code(stock_code)
+        stock_name = fetcher.get_stock_name(normalized_code)
+        start_date, end_date, cached = fetcher._resolve_fetch_range(normalized_code, start_date, end_date, force_update)
+        if cached is not None:
+            return stock_code, normalized_code, stock_name, pd.DataFrame(), None
+        if not fetcher.login():
+            return stock_code, normalized_code, stock_name, pd.DataFrame(), "连接失败"
+        return stock_code, normalized_code, stock_name, fetcher._download(normalized_code, start_date, end_date), None
+    except Exception as e:
+        return stock_code, stock_code, stock_code, pd.DataFrame(), str(e)
 
 
 class DataFetcher:
-    def __init__(self, progress_callback=None):
-        self.db = StockDatabase()
+    def __init__(self, progress_callback=None, db=None, provider=None):
+        self.db = db or open_database()
+        # 行情数据源，默认按 config.DATA_PROVIDER 创建
+        self.provider = provider or create_provider()
         self._logged_in = False
         self.progress_callback = progress_callback  # 进度回调函数
         self._stock_name_cache = {}  # 缓存股票名称
+        self._missing_securities = set()  # 本次会话中服务器确认不存在的代码，不再重复查询
+        self._security_master_checked = False
+        self._calendar_checked = False
+        self._calendar_ready = False
+        self.chunk_rows = INGEST_CHUNK_ROWS  # 下载时每块的行数
     
     def set_progress_callback(self, callback):
         """设置进度回调函数"""
@@ -24,7 +79,7 @@ class DataFetcher:
     def login(self):
         if not self._logged_in:
             self._report_progress("正在连接Baostock服务器...", 5)
-            lg = bs.login()
+            lg = self.provider.login()
             if lg.error_code == '0':
                 self._logged_in = True
                 self._report_progress("连接成功", 10)
@@ -36,8 +91,9 @@ class DataFetcher:
     
     def logout(self):
         if self._logged_in:
-            bs.logout()
+            self.provider.logout()
             self._logged_in = False
+        self._missing_securities.clear()
     
     def normalize_stock_code(self, code: str) -> str:
         """
@@ -64,10 +120,126 @@ class DataFetcher:
             # 无法识别的代码，默认尝试沪市，后续会验证是否存在
             return f'sh.{code}'
 
+    def load_security_master(self) -> bool:
+        """
+        从baostock全量加载证券列表到证券主表（一次查询）
+
+        Returns:
+            是否加载成功
+        """
+        self._security_master_checked = True
+        if not self.login():
+            return False
+
+        self._report_progress("正在更新证券列表...", 5)
+        self._missing_securities.clear()
+        rs = self.provider.query_stock_basic()
+        rows = []
+        while (rs.error_code == '0') & rs.next():
+            rows.append(rs.get_row_data()[:6])
+
+        if rs.error_code != '0' or not rows:
+            return False
+        self.db.save_securities(rows)
+        return True
+
+    def _ensure_security_master(self):
+        """证券主表为空或过期时重新加载，每个会话只检查一次"""
+        if self._security_master_checked:
+            return
+        self._security_master_checked = True
+
+        verified_date = self.db.get_security_master_date()
+        if verified_date:
+            age = datetime.now() - datetime.strptime(verified_date, '%Y-%m-%d')
+            if age.days <= SECURITY_MASTER_MAX_AGE_DAYS:
+                return
+        self.load_security_master()
+
+    def _query_security(self, stock_code: str):
+        """
+        单独查询一只证券并写入证券主表（证券主表中没有时使用）
+        服务器确认不存在的代码记录在本次会话中，输错的代码重试或再取名称时不再联网
+
+        Returns:
+            (code, name, ipo_date, out_date, type, status)，不存在时返回None
+        """
+        if stock_code in self._missing_securities or not self.login():
+            return None
+        rs = self.provider.query_stock_basic(code=stock_code)
+        if rs.error_code == '0' and rs.next():
+            row = rs.get_row_data()[:6]
+            self.db.save_securities([row])
+            return row
+        if rs.error_code == '0':
+            self._missing_securities.add(stock_code)
+        return None
+
+    def load_trade_calendar(self) -> bool:
+        """
+        从baostock加载交易日历（开市至今年年底）
+
+        Returns:
+            是否加载成功
+        """
+        if not self.login():
+            return False
+
+        self._report_progress("正在更新交易日历...", 5)
+        rs = self.provider.query_trade_dates(start_date=TRADE_CALENDAR_START, end_date=f'{datetime.now().year}-12-31')
+        rows = []
+        while (rs.error_code == '0') & rs.next():
+            rows.append(rs.get_row_data()[:2])
+
+        if rs.error_code != '0' or not rows:
+            return False
+        self.db.save_trade_dates([(date, is_trading == '1') for date, is_trading in rows])
+        return True
+
+    def _ensure_trade_calendar(self) -> bool:
+        """交易日历未覆盖今天时重新加载（通常每年一次），每个会话只检查一次"""
+        if not self._calendar_checked:
+            self._calendar_checked = True
+            _, last_date = self.db.get_trade_calendar_range()
+            if last_date and last_date >= datetime.now().strftime('%Y-%m-%d'):
+                self._calendar_ready = True
+            else:
+                self._calendar_ready = self.load_trade_calendar()
+        return self._calendar_ready
+
+    def is_trading_day(self, date: str) -> bool:
+        """判断是否为交易日，交易日历不可用时只排除周末"""
+        if self._ensure_trade_calendar():
+            is_trading = self.db.is_trade_date(date)
+            if is_trading is not None:
+                return is_trading
+        return datetime.strptime(date, '%Y-%m-%d').weekday() < 5
+
+    def latest_available_date(self, end_date: str) -> str:
+        """
+        截至 end_date 服务器上可能存在日线的最后一个交易日
+        今天在 DATA_READY_TIME 之前当天数据尚未入库，按昨天计算
+        """
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        cutoff = min(end_date, today)
+        if cutoff == today and now.strftime('%H:%M') < DATA_READY_TIME:
+            cutoff = (now - timedelta(days=1)).strftime('%Y-%m-%d')
+
+        if self._ensure_trade_calendar():
+            last_trade_date = self.db.get_last_trade_date(cutoff)
+            if last_trade_date:
+                return last_trade_date
+
+        day = datetime.strptime(cutoff, '%Y-%m-%d')
+        while day.weekday() >= 5:
+            day -= timedelta(days=1)
+        return day.strftime('%Y-%m-%d')
+
     def try_normalize_stock_code(self, code: str) -> str:
         """
         尝试标准化股票代码，如果沪市不存在则尝试深市
-        用于处理无法确定市场的裸代码
+        用于处理无法确定市场的裸代码；优先查本地证券主表，查不到时才向服务器核实
         """
         code = code.strip().lower()
 
@@ -78,21 +250,21 @@ class DataFetcher:
         # 根据规则先尝试确定的市场
         normalized = self.normalize_stock_code(code)
 
-        # 验证股票是否存在
-        if self.login():
-            rs = bs.query_stock_basic(code=normalized)
-            if rs.error_code == '0' and rs.next():
+        self._ensure_security_master()
+        matches = self.db.find_securities(code)
+        if matches:
+            codes = [row[0] for row in matches]
+            if normalized in codes:
                 return normalized
+            # 同一数字代码同时对应指数和股票时（如000001），优先股票
+            stocks = [row[0] for row in matches if row[2] == '1']
+            return (stocks or codes)[0]
 
-            # 如果不存在，尝试另一个市场
-            if normalized.startswith('sh.'):
-                alternative = f'sz.{code}'
-            else:
-                alternative = f'sh.{code}'
-
-            rs = bs.query_stock_basic(code=alternative)
-            if rs.error_code == '0' and rs.next():
-                return alternative
+        # 证券主表中没有（如新上市），向服务器核实两个市场
+        alternative = f'sz.{code}' if normalized.startswith('sh.') else f'sh.{code}'
+        for candidate in (normalized, alternative):
+            if self._query_security(candidate):
+                return candidate
 
         return normalized
     
@@ -101,30 +273,27 @@ class DataFetcher:
         获取股票中文名称
         支持裸股票代码输入，自动匹配市场
         """
-        # 尝试标准化并验证股票代码
         normalized_code = self.try_normalize_stock_code(stock_code)
 
         # 先检查缓存
         if normalized_code in self._stock_name_cache:
             return self._stock_name_cache[normalized_code]
 
-        if not self.login():
-            return stock_code
-
         try:
-            # 使用query_stock_basic获取股票基本信息
-            rs = bs.query_stock_basic(code=normalized_code)
-
-            if rs.error_code == '0' and rs.next():
-                data = rs.get_row_data()
-                # 返回股票名称（code_name字段）
-                stock_name = data[1] if len(data) > 1 and data[1] else stock_code
-                self._stock_name_cache[normalized_code] = stock_name
-                return stock_name
+            security = self.db.get_security(normalized_code)
+            if security is not None:
+                name = security[1]
+            else:
+                row = self._query_security(normalized_code)
+                name = row[1] if row else None
         except Exception as e:
             print(f"获取股票名称失败: {e}")
+            return stock_code
 
-        return stock_code
+        if not name:
+            return stock_code
+        self._stock_name_cache[normalized_code] = name
+        return name
     
     def fetch_stock_data(self, stock_code: str, start_date: str = None, end_date: str = None, 
                          force_update: bool = False) -> tuple:
@@ -138,9 +307,48 @@ class DataFetcher:
 
         # 获取股票名称
         self._report_progress("正在获取股票信息...", 2)
-        stock_name = self.get_stock_name(stock_code)
+        stock_name = self.get_stock_name(normalized_code)
         self._report_progress(f"股票: {stock_name}", 3)
         
+        self._report_progress(f"准备获取 {normalized_code} ({stock_name}) 的数据...", 0)
+        
+        start_date, end_date = self._default_range(start_date, end_date)
+        fetch_start, end_date, cached = self._resolve_fetch_range(normalized_code, start_date, end_date, force_update)
+        if cached is not None:
+            self._report_progress(f"使用本地缓存数据 ({len(cached)} 条)", 100)
+            return cached, stock_name
+        
+        if not self.login():
+            return pd.DataFrame(), stock_name
+        
+        # 边接收边按块写入数据库，不在内存中保留整段下载结果
+        inserted = updated = 0
+        try:
+            for chunk in self._iter_chunks(normalized_code, fetch_start, end_date):
+                chunk_inserted, chunk_updated = self.db.save_stock_data(chunk, normalized_code)
+                inserted += chunk_inserted
+                updated += chunk_updated
+        except FetchError as e:
+            self._report_progress(str(e), 0)
+            return pd.DataFrame(), stock_name
+        
+        if inserted + updated == 0:
+            return pd.DataFrame(), stock_name
+        
+        self._report_progress(f"已保存：新增 {inserted} 条，更新 {updated} 条", 90)
+        self.db.save_stock_memory(normalized_code, stock_name)
+        
+        # 只返回请求的区间
+        self._report_progress("正在加载数据...", 95)
+        result = self.db.get_stock_data(normalized_code, start_date, end_date)
+        
+        self._report_progress(f"数据获取完成！共 {len(result)} 条", 100)
+        
+        return result, stock_name
+    
+    @staticmethod
+    def _default_range(start_date: str, end_date: str) -> tuple:
+        """未指定时结束日期为今天，开始日期为 DEFAULT_YEARS 年前"""
         if end_date is None:
             end_date = datetime.now().strftime('%Y-%m-%d')
         
@@ -148,26 +356,45 @@ class DataFetcher:
             start = datetime.now() - timedelta(days=365 * DEFAULT_YEARS)
             start_date = start.strftime('%Y-%m-%d')
         
-        self._report_progress(f"准备获取 {normalized_code} ({stock_name}) 的数据...", 0)
+        return start_date, end_date
+    
+    def _resolve_fetch_range(self, normalized_code: str, start_date: str, end_date: str,
+                             force_update: bool = False):
+        """
+        根据本地数据和交易日历确定需要下载的区间
+        
+        Returns:
+            (开始日期, 结束日期, 本地数据)，本地数据已包含截至结束日期的最后一个交易日时，
+            第三项为该区间的本地数据，否则为None
+        """
+        start_date, end_date = self._default_range(start_date, end_date)
         
         if not force_update:
-            existing_data = self.db.get_stock_data(normalized_code, start_date, end_date)
             last_update = self.db.get_last_update_date(normalized_code)
             
-            if not existing_data.empty and last_update and last_update >= end_date:
-                self._report_progress(f"使用本地缓存数据 ({len(existing_data)} 条)", 100)
-                return existing_data, stock_name
-            
-            if last_update and last_update < end_date:
+            # 结束日期之前已没有新的交易日（节假日、周末或当日数据尚未入库）时不需要联网
+            if last_update and (last_update >= end_date or last_update >= self.latest_available_date(end_date)):
+                existing_data = self.db.get_stock_data(normalized_code, start_date, end_date)
+                if not existing_data.empty:
+                    return start_date, end_date, existing_data
+            elif last_update:
                 start_date = (datetime.strptime(last_update, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
                 self._report_progress(f"本地数据截止到 {last_update}，需要更新", 15)
         
-        if not self.login():
-            return pd.DataFrame(), stock_name
+        return start_date, end_date, None
+    
+    def _iter_chunks(self, normalized_code: str, start_date: str, end_date: str):
+        """
+        下载日线，每接收 self.chunk_rows 行转换为一个数值化的DataFrame（调用前需已登录）
+        查询失败、或 next() 分页获取后续数据时出错（如会话中途失效）时抛出 FetchError，
+        已返回的块仍然有效，但结果不完整
         
-        self._report_progress(f"正在下载 {normalized_code} ({stock_name}) 从 {start_date} 到 {end_date} 的数据...", 20)
+        Yields:
+            DataFrame，列为 STOCK_FIELDS
+        """
+        self._report_progress(f"正在下载 {normalized_code} 从 {start_date} 到 {end_date} 的数据...", 20)
         
-        rs = bs.query_history_k_data_plus(
+        rs = self.provider.query_history_k_data_plus(
             normalized_code,
             STOCK_FIELDS,
             start_date=start_date,
@@ -177,45 +404,94 @@ class DataFetcher:
         )
         
         if rs.error_code != '0':
-            self._report_progress(f"查询失败: {rs.error_msg}", 0)
-            return pd.DataFrame(), stock_name
+            raise FetchError(f"查询失败: {rs.error_msg}")
         
-        data_list = []
+        rows = []
         total_count = 0
-        batch_size = 100
         
         self._report_progress("正在接收数据...", 30)
         
         while (rs.error_code == '0') & rs.next():
-            data_list.append(rs.get_row_data())
-            total_count += 1
+            rows.append(rs.get_row_data())
             
-            # 每100条更新一次进度
-            if total_count % batch_size == 0:
-                progress = min(30 + int(total_count / 10), 70)
-                self._report_progress(f"已接收 {total_count} 条数据...", progress)
+            if len(rows) >= self.chunk_rows:
+                total_count += len(rows)
+                yield self._to_frame(rows, rs.fields)
+                rows = []
+                progress = min(30 + int(total_count / 10), 85)
+                self._report_progress(f"已接收并保存 {total_count} 条数据...", progress)
         
-        if not data_list:
-            self._report_progress("未获取到数据", 0)
-            return pd.DataFrame(), stock_name
+        if rows:
+            total_count += len(rows)
+            yield self._to_frame(rows, rs.fields)
         
-        self._report_progress(f"接收到 {len(data_list)} 条数据，正在处理...", 75)
-        
-        df = pd.DataFrame(data_list, columns=rs.fields)
+        if rs.error_code != '0':
+            raise FetchError(f"接收数据中断（已接收 {total_count} 条）: {rs.error_msg}")
         
-        numeric_columns = ['open', 'high', 'low', 'close', 'preclose', 'volume',
-                          'amount', 'turn', 'pctChg', 'peTTM', 'pbMRQ', 'psTTM', 'pcfNcfTTM']
-        for col in numeric_columns:
+        if total_count == 0:
+            self._report_progress("未获取到数据", 0)
+    
+    @staticmethod
+    def _to_frame(rows: list, fields: list) -> pd.DataFrame:
+        """将一块字符串行转换为DataFrame，数值列转为float"""
+        df = pd.DataFrame(rows, columns=fields)
+        for col in NUMERIC_COLUMNS:
             if col in df.columns:
                 df[col] = pd.to_numeric(df[col], errors='coerce')
+        return df
+    
+    def _download(self, normalized_code: str, start_date: str, end_date: str) -> pd.DataFrame:
+        """下载日线并转换数值列（调用前需已登录）"""
+        chunks = list(self._iter_chunks(normalized_code, start_date, end_date))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    
+    def fetch_many(self, stock_codes: list, start_date: str = None, end_date: str = None,
+                   force_update: bool = False, max_workers: int = FETCH_WORKERS,
+                   use_processes: bool = True, remember: bool = True) -> list:
+        """
+        批量获取多只股票数据
+        下载在工作池中并行进行，每完成一只立即写入数据库，通过 progress_callback 报告总体进度
         
-        self._report_progress("正在保存到本地数据库...", 85)
-        self.db.save_stock_data(df, normalized_code)
-        self.db.save_stock_memory(normalized_code, stock_name)
+        Args:
+            stock_codes: 股票代码列表（支持裸代码）
+            start_date: 开始日期
+            end_date: 结束日期
+            force_update: 是否忽略本地数据重新下载
+            max_workers: 并行数
+            use_processes: 是否使用进程池（baostock使用全局会话，不能在线程间共享）
+            remember: 是否把股票写入"最近使用"列表，后台预取等非用户操作应传False，以免打乱列表顺序
         
-        self._report_progress("正在加载完整数据...", 95)
-        full_data = self.db.get_stock_data(normalized_code)
+        Returns:
+            [(标准化代码, 股票名称, 新增条数, 更新条数, 错误信息), ...]，顺序与完成顺序一致
+        """
+        if not stock_codes:
+            return []
         
-        self._report_progress(f"数据获取完成！共 {len(full_data)} 条", 100)
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        total = len(stock_codes)
+        results = []
+        self._report_progress(f"开始批量获取 {total} 只股票...", 0)
+        
+        with executor_class(max_workers=max_workers, initializer=_init_fetch_worker,
+                            initargs=(self.db, self.provider)) as executor:
+            # 先由一个工作者准备好证券主表和交易日历，其余下载直接读取，不再各自查询；
+            # 调用方不访问行情接口（baostock会话是进程全局的，调用方可能是界面进程中的后台线程）
+            executor.submit(_prepare_fetch_worker).result()
+            futures = [executor.submit(_fetch_worker, code, start_date, end_date, force_update)
+                       for code in stock_codes]
+            
+            for done, future in enumerate(as_completed(futures), 1):
+                code, normalized_code, stock_name, df, error = future.result()
+                inserted = updated = 0
+                if error is None and not df.empty:
+                    inserted, updated = self.db.save_stock_data(df, normalized_code)
+                    if remember:
+                        self.db.save_stock_memory(normalized_code, stock_name)
+                    self._stock_name_cache[normalized_code] = stock_name
+                
+                results.append((normalized_code, stock_name, inserted, updated, error))
+                status = f"失败: {error}" if error else f"新增 {inserted} 条，更新 {updated} 条"
+                self._report_progress(f"[{done}/{total}] {normalized_code} ({stock_name}) {status}",
+                                      int(done / total * 100))
         
-        return full_data, stock_name
+        return results
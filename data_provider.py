@@ -0,0 +1,508 @@
+"""
+行情数据源
+DataFetcher 通过数据源访问行情服务，接口与 baostock 模块相同（login、query_history_k_data_plus 等，
+返回带 error_code/fields/next()/get_row_data() 的结果集）。
+在线访问经过 ResilientProvider：限制请求速率，会话失效时自动重新登录，网络错误按带抖动的指数退避重试。
+除 baostock 外提供离线回放数据源：读取事先录制到磁盘的结果集，可配置延迟，
+用于在没有网络的环境中测试和压测下载入库流程
+
+用法: python data_provider.py --record 目录 --codes sh.600000 sz.000001 [--start 2015-01-01]
+"""
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from config import (DATA_PROVIDER, PROVIDER_BURST, PROVIDER_MAX_RETRIES, PROVIDER_RATE_LIMIT,
+                    PROVIDER_RETRY_BASE_SECONDS, REPLAY_DATA_DIR, REPLAY_LATENCY)
+
+# baostock 错误码：未登录（会话过期或连接重建后需要重新登录）
+SESSION_ERROR_CODES = {'10001001'}
+# 网络错误（10002xxx），连接已不可用，需要重新登录后重试
+NETWORK_ERROR_PREFIX = '10002'
+
+
+def _retryable(error_code: str) -> bool:
+    """会话失效或网络错误，重新登录后可以重试"""
+    return error_code in SESSION_ERROR_CODES or error_code.startswith(NETWORK_ERROR_PREFIX)
+
+
+class ResultSet:
+    """内存中的结果集，接口与 baostock 的 ResultData 相同"""
+
+    def __init__(self, rows: list = None, fields: list = None, error_code: str = '0', error_msg: str = 'success'):
+        self._rows = rows or []
+        self._index = -1
+        self.fields = fields or []
+        self.error_code = error_code
+        self.error_msg = error_msg
+
+    def next(self) -> bool:
+        self._index += 1
+        return self._index < len(self._rows)
+
+    def get_row_data(self) -> list:
+        return self._rows[self._index]
+
+
+class DataProvider(ABC):
+    """数据源基类，方法签名与 baostock 模块一致；不需要登录的数据源可沿用默认的 login/logout"""
+
+    def login(self):
+        return ResultSet()
+
+    def logout(self):
+        return ResultSet()
+
+    @abstractmethod
+    def query_history_k_data_plus(self, code, fields, start_date=None, end_date=None,
+                                  frequency='d', adjustflag='3'):
+        """日线查询"""
+
+    @abstractmethod
+    def query_stock_basic(self, code=''):
+        """证券基本资料查询，code 为空时返回全部证券"""
+
+    @abstractmethod
+    def query_trade_dates(self, start_date=None, end_date=None):
+        """交易日历查询"""
+
+
+class BaostockProvider(DataProvider):
+    """baostock 在线数据源"""
+
+    def __init__(self, module=None):
+        """
+        Args:
+            module: baostock 模块或接口相同的替代对象，默认导入 baostock
+        """
+        if module is None:
+            import baostock as module
+        self.bs = module
+
+    def __reduce__(self):
+        # 传给子进程时在子进程中重新导入模块
+        return type(self), ()
+
+    def login(self):
+        return self.bs.login()
+
+    def logout(self):
+        return self.bs.logout()
+
+    def query_history_k_data_plus(self, code, fields, start_date=None, end_date=None,
+                                  frequency='d', adjustflag='3'):
+        return self.bs.query_history_k_data_plus(code, fields, start_date=start_date, end_date=end_date,
+                                                 frequency=frequency, adjustflag=adjustflag)
+
+    def query_stock_basic(self, code=''):
+        return self.bs.query_stock_basic(code=code) if code else self.bs.query_stock_basic()
+
+    def query_trade_dates(self, start_date=None, end_date=None):
+        return self.bs.query_trade_dates(start_date=start_date, end_date=end_date)
+
+
+class ReplayProvider(DataProvider):
+    """
+    离线回放数据源
+    目录结构：
+        history/<code>.json   {"fields": [...], "rows": [[...], ...]}，按日期排序的完整日线
+        stock_basic.json      {"fields": [...], "rows": [...]}
+        trade_dates.json      {"fields": [...], "rows": [...]}
+    日线按请求的日期区间截取，因此增量更新与在线数据源行为一致
+    """
+
+    def __init__(self, data_dir: str = None, latency: float = REPLAY_LATENCY, row_latency: float = 0.0):
+        """
+        Args:
+            data_dir: 录制数据目录
+            latency: 每次查询的固定延迟（秒），模拟网络往返
+            row_latency: 每返回一行的额外延迟（秒），模拟传输时间
+        """
+        self.data_dir = data_dir or REPLAY_DATA_DIR
+        self.latency = latency
+        self.row_latency = row_latency
+        self._cache = {}
+
+    def __reduce__(self):
+        return type(self), (self.data_dir, self.latency, self.row_latency)
+
+    def _load(self, relative_path: str):
+        """读取录制文件（进程内缓存），不存在时返回None"""
+        if relative_path not in self._cache:
+            path = os.path.join(self.data_dir, relative_path)
+            if not os.path.isfile(path):
+                return None
+            with open(path, encoding='utf-8') as f:
+                self._cache[relative_path] = json.load(f)
+        return self._cache[relative_path]
+
+    def _respond(self, rows: list, fields: list) -> ResultSet:
+        delay = self.latency + self.row_latency * len(rows)
+        if delay > 0:
+            time.sleep(delay)
+        return ResultSet(rows, fields)
+
+    def query_history_k_data_plus(self, code, fields, start_date=None, end_date=None,
+                                  frequency='d', adjustflag='3'):
+        recorded = self._load(os.path.join('history', f'{code}.json'))
+        if recorded is None:
+            return ResultSet(error_code='10004011', error_msg=f'没有录制 {code} 的日线')
+
+        requested = fields.split(',') if isinstance(fields, str) else list(fields)
+        positions = [recorded['fields'].index(field) for field in requested]
+        date_index = recorded['fields'].index('date')
+        rows = [[row[i] for i in positions] for row in recorded['rows']
+                if (not start_date or row[date_index] >= start_date)
+                and (not end_date or row[date_index] <= end_date)]
+        return self._respond(rows, requested)
+
+    def query_stock_basic(self, code=''):
+        recorded = self._load('stock_basic.json')
+        if recorded is None:
+            return ResultSet(error_code='10004011', error_msg='没有录制证券列表')
+        rows = [row for row in recorded['rows'] if not code or row[0] == code]
+        return self._respond(rows, recorded['fields'])
+
+    def query_trade_dates(self, start_date=None, end_date=None):
+        recorded = self._load('trade_dates.json')
+        if recorded is None:
+            return ResultSet(error_code='10004011', error_msg='没有录制交易日历')
+        rows = [row for row in recorded['rows']
+                if (not start_date or row[0] >= start_date) and (not end_date or row[0] <= end_date)]
+        return self._respond(rows, recorded['fields'])
+
+
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 个请求，最多连续突发 capacity 个"""
+
+    def __init__(self, rate: float, capacity: int, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，没有可用令牌时等待"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            # 令牌不足时预支，等待补足的时间后返回，后来的请求依次排在后面
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+
+
+class ResilientProvider(DataProvider):
+    """
+    带会话保持的数据源包装
+    - 每次查询前从令牌桶取令牌，持续下载时速率平稳，不会压垮服务器
+    - 返回"未登录"或网络错误码、或抛出网络异常时，重新登录并按带抖动的指数退避重试
+    - 返回的结果集在 next() 分页获取后续数据出错时同样重新登录，从已收到的位置之后继续
+    - 其他错误（如代码不存在）直接返回给调用方
+    限速状态按进程独立，进程池中每个子进程各自限速
+    """
+
+    def __init__(self, provider: DataProvider, rate: float = PROVIDER_RATE_LIMIT, burst: int = PROVIDER_BURST,
+                 max_retries: int = PROVIDER_MAX_RETRIES, retry_base: float = PROVIDER_RETRY_BASE_SECONDS,
+                 sleep=time.sleep):
+        """
+        Args:
+            provider: 实际数据源
+            rate: 每秒请求数上限（<=0 表示不限速）
+            burst: 允许连续突发的请求数
+            max_retries: 每次查询的最大重试次数
+            retry_base: 首次重试的平均等待（秒）
+            sleep: 等待函数（测试时可替换）
+        """
+        self.provider = provider
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self._sleep = sleep
+        self._bucket = TokenBucket(rate, burst, sleep=sleep)
+        self._session_lock = threading.Lock()
+        self._session = 0  # 每次成功登录加一，避免多个线程对同一次失效重复登录
+        self.relogins = 0
+        self.retries = 0
+
+    def __reduce__(self):
+        return type(self), (self.provider, self.rate, self.burst, self.max_retries, self.retry_base)
+
+    def login(self):
+        with self._session_lock:
+            lg = self.provider.login()
+            if lg.error_code == '0':
+                self._session += 1
+            return lg
+
+    def logout(self):
+        return self.provider.logout()
+
+    def _relogin(self, session: int):
+        with self._session_lock:
+            if self._session != session:
+                return  # 其他线程已经重新登录
+            try:
+                if self.provider.login().error_code == '0':
+                    self._session += 1
+                    self.relogins += 1
+            except Exception:
+                pass
+
+    def _backoff(self, attempt: int, session: int):
+        """第 attempt 次重试前等待并重新登录"""
+        self.retries += 1
+        # 完全抖动：在 [0, base*2^n] 内随机等待，避免多个进程同时重试
+        self._sleep(random.uniform(0, self.retry_base * 2 ** attempt))
+        self._relogin(session)
+
+    def _call(self, method: str, *args, **kwargs):
+        """查询并包装结果集，查询本身失败时返回原结果集"""
+        session = self._session
+        rs = self._query(method, *args, **kwargs)
+        if rs.error_code != '0':
+            return rs
+        return _ResumingResultSet(self, rs, session, method, args, kwargs)
+
+    def _query(self, method: str, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            session = self._session
+            try:
+                rs = getattr(self.provider, method)(*args, **kwargs)
+            except (OSError, EOFError):
+                # ConnectionError、socket.timeout 等
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if not _retryable(rs.error_code) or attempt == self.max_retries:
+                    return rs
+
+            self._backoff(attempt, session)
+
+    def query_history_k_data_plus(self, code, fields, start_date=None, end_date=None,
+                                  frequency='d', adjustflag='3'):
+        return self._call('query_history_k_data_plus', code, fields, start_date=start_date, end_date=end_date,
+                          frequency=frequency, adjustflag=adjustflag)
+
+    def query_stock_basic(self, code=''):
+        return self._call('query_stock_basic', code)
+
+    def query_trade_dates(self, start_date=None, end_date=None):
+        return self._call('query_trade_dates', start_date=start_date, end_date=end_date)
+
+
+class _ResumingResultSet:
+    """
+    ResilientProvider 返回的结果集
+    baostock 在 next() 中分页获取后续数据，此时会话失效或网络中断不会经过查询时的重试；
+    出错后按同样的退避重新登录并重新查询：日线从最后收到的日期开始查询并跳过已收到的日期，
+    其他查询跳过已收到的行数。重试次数用完或遇到其他错误时，错误码照常留给调用方
+    """
+
+    def __init__(self, owner: ResilientProvider, rs, session: int, method: str, args: tuple, kwargs: dict):
+        self._owner = owner
+        self._rs = rs
+        self._session = session
+        self._method = method
+        self._args = args
+        self._kwargs = kwargs
+        self._row = None
+        self._received = 0       # 已返回给调用方的行数
+        self._last_date = None   # 日线已返回的最后日期
+        self._skip_rows = 0      # 重新查询后需要跳过的行数
+        self._attempts = 0
+
+    @property
+    def error_code(self):
+        return self._rs.error_code
+
+    @property
+    def error_msg(self):
+        return self._rs.error_msg
+
+    @property
+    def fields(self):
+        return self._rs.fields
+
+    def get_row_data(self) -> list:
+        return self._row
+
+    def _date_index(self):
+        fields = list(self._rs.fields)
+        if self._method == 'query_history_k_data_plus' and 'date' in fields:
+            return fields.index('date')
+        return None
+
+    def next(self) -> bool:
+        while True:
+            try:
+                if self._rs.next():
+                    row = self._rs.get_row_data()
+                    if self._skip_rows:
+                        self._skip_rows -= 1
+                        continue
+                    date_index = self._date_index()
+                    if date_index is not None:
+                        if self._last_date is not None and row[date_index] <= self._last_date:
+                            continue
+                        self._last_date = row[date_index]
+                    self._row = row
+                    self._received += 1
+                    return True
+            except (OSError, EOFError):
+                if self._attempts >= self._owner.max_retries:
+                    raise
+            else:
+                if self._rs.error_code == '0' or not _retryable(self._rs.error_code):
+                    return False
+                if self._attempts >= self._owner.max_retries:
+                    return False
+
+            self._owner._backoff(self._attempts, self._session)
+            self._attempts += 1
+            self._resume()
+
+    def _resume(self):
+        """重新查询，从已收到的位置之后继续"""
+        kwargs = dict(self._kwargs)
+        if self._last_date is not None:
+            kwargs['start_date'] = self._last_date
+            self._skip_rows = 0
+        else:
+            self._skip_rows = self._received
+        self._session = self._owner._session
+        self._rs = self._owner._query(self._method, *self._args, **kwargs)
+
+
+def _read_all(rs) -> tuple:
+    rows = []
+    while (rs.error_code == '0') & rs.next():
+        rows.append(rs.get_row_data())
+    return rows, list(rs.fields)
+
+
+def write_recording(path: str, fields: list, rows: list):
+    """写入一个录制文件（先写临时文件再替换）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'fields': fields, 'rows': rows}, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+class RecordingProvider(DataProvider):
+    """
+    录制数据源：转发到实际数据源，同时把结果按 ReplayProvider 的目录结构写入磁盘
+    同一股票多次下载的日线按日期合并
+    """
+
+    def __init__(self, provider: DataProvider, data_dir: str):
+        self.provider = provider
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return type(self), (self.provider, self.data_dir)
+
+    def login(self):
+        return self.provider.login()
+
+    def logout(self):
+        return self.provider.logout()
+
+    def query_history_k_data_plus(self, code, fields, start_date=None, end_date=None,
+                                  frequency='d', adjustflag='3'):
+        rs = self.provider.query_history_k_data_plus(code, fields, start_date=start_date, end_date=end_date,
+                                                     frequency=frequency, adjustflag=adjustflag)
+        if rs.error_code != '0':
+            return rs
+        rows, fields = _read_all(rs)
+
+        self._merge(os.path.join('history', f'{code}.json'), fields, rows, fields.index('date'))
+        return ResultSet(rows, fields)
+
+    def query_stock_basic(self, code=''):
+        rs = self.provider.query_stock_basic(code)
+        if rs.error_code != '0':
+            return rs
+        rows, fields = _read_all(rs)
+        self._merge('stock_basic.json', fields, rows, 0)
+        return ResultSet(rows, fields)
+
+    def query_trade_dates(self, start_date=None, end_date=None):
+        rs = self.provider.query_trade_dates(start_date, end_date)
+        if rs.error_code != '0':
+            return rs
+        rows, fields = _read_all(rs)
+        self._merge('trade_dates.json', fields, rows, 0)
+        return ResultSet(rows, fields)
+
+    def _merge(self, relative_path: str, fields: list, rows: list, key_index: int):
+        """与已录制的内容按键（日期或代码）合并后写回，结果按键排序"""
+        path = os.path.join(self.data_dir, relative_path)
+        with self._lock:
+            merged = {}
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    recorded = json.load(f)
+                if recorded['fields'] == fields:
+                    merged = {row[key_index]: row for row in recorded['rows']}
+            merged.update({row[key_index]: row for row in rows})
+            write_recording(path, fields, [merged[key] for key in sorted(merged)])
+
+
+def create_provider(name: str = None) -> DataProvider:
+    """
+    按配置创建数据源
+
+    Args:
+        name: 'baostock' 或 'replay'，默认使用 config.DATA_PROVIDER
+    """
+    name = name or DATA_PROVIDER
+    if name == 'baostock':
+        return ResilientProvider(BaostockProvider())
+    if name == 'replay':
+        return ReplayProvider()
+    raise ValueError(f"不支持的数据源: {name}")
+
+
+def main():
+    import argparse
+    from data_fetcher import DataFetcher
+    from database import StockDatabase
+
+    parser = argparse.ArgumentParser(description='录制baostock数据用于离线回放')
+    parser.add_argument('--record', required=True, help='录制目录')
+    parser.add_argument('--codes', nargs='+', required=True, help='股票代码')
+    parser.add_argument('--start', default=None, help='开始日期')
+    parser.add_argument('--end', default=None, help='结束日期')
+    args = parser.parse_args()
+
+    provider = RecordingProvider(ResilientProvider(BaostockProvider()), args.record)
+    # 使用临时数据库，确保每只股票都完整下载一次
+    with tempfile.TemporaryDirectory() as tmp:
+        fetcher = DataFetcher(progress_callback=lambda message, percent: print(message),
+                              db=StockDatabase(os.path.join(tmp, 'record.db')), provider=provider)
+        fetcher.load_security_master()
+        fetcher.load_trade_calendar()
+        for code in args.codes:
+            fetcher.fetch_stock_data(code, args.start, args.end, force_update=True)
+        fetcher.logout()
+    print(f"录制完成: {args.record}")
+
+
+if __name__ == "__main__":
+    main()
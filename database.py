@@ -1,15 +1,132 @@
+import atexit
+import os
 import sqlite3
+import threading
+import weakref
 import pandas as pd
 from datetime import datetime
-from config import DB_PATH
+from config import DB_PATH, SQLITE_PRAGMAS, STORAGE_BACKEND
+
+# stock_history 中可由 save_stock_data 写入的列
+STOCK_HISTORY_COLUMNS = ['date', 'code', 'open', 'high', 'low', 'close', 'preclose',
+                         'volume', 'amount', 'adjustflag', 'turn', 'tradestatus', 'pctChg', 'isST',
+                         'peTTM', 'pbMRQ', 'psTTM', 'pcfNcfTTM']
+
+
+def _close_connection(conn: sqlite3.Connection):
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+class _ConnectionHolder:
+    """
+    线程本地存储中保存连接的对象，线程结束时随线程本地数据一起释放，
+    由 weakref.finalize 关闭其中的连接
+    """
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+class ConnectionManager:
+    """
+    SQLite连接管理器
+    同一数据库文件在进程内共享一个管理器，每个线程复用自己的长连接，线程结束时连接随之关闭；
+    连接开启WAL模式，读取不会被正在写入的线程阻塞
+    """
+    _managers = {}
+    _managers_lock = threading.Lock()
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.schema_ready = False
+        self.schema_lock = threading.Lock()
+        self._reset()
+    
+    def _reset(self):
+        """初始化线程本地存储（fork出的子进程不能沿用父进程的连接）"""
+        self._pid = os.getpid()
+        self._local = threading.local()
+        # 只弱引用各线程的连接，已结束线程的条目自动消失
+        self._holders = weakref.WeakSet()
+        self._holders_lock = threading.Lock()
+    
+    @classmethod
+    def for_path(cls, db_path: str) -> 'ConnectionManager':
+        """获取数据库文件对应的共享管理器"""
+        key = os.path.abspath(db_path)
+        with cls._managers_lock:
+            if key not in cls._managers:
+                cls._managers[key] = cls(key)
+            return cls._managers[key]
+    
+    def connection(self) -> sqlite3.Connection:
+        """返回当前线程的连接，首次调用时创建"""
+        if self._pid != os.getpid():
+            self._reset()
+        
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            # SQL文本不变的语句只编译一次，由连接的语句缓存复用；
+            # 连接只在创建它的线程中使用，关闭可能发生在回收线程本地数据的线程或退出时的主线程
+            conn = sqlite3.connect(self.db_path, timeout=30, cached_statements=256, check_same_thread=False)
+            for name, value in SQLITE_PRAGMAS.items():
+                conn.execute(f'PRAGMA {name} = {value}')
+            holder = _ConnectionHolder(conn)
+            weakref.finalize(holder, _close_connection, conn)
+            self._local.holder = holder
+            with self._holders_lock:
+                self._holders.add(holder)
+        return holder.conn
+    
+    @property
+    def open_connections(self) -> int:
+        """本进程中仍在使用的连接数"""
+        with self._holders_lock:
+            return len(self._holders)
+    
+    def close_all(self):
+        """关闭本进程中由该管理器创建、尚未关闭的全部连接"""
+        if self._pid != os.getpid():
+            return
+        with self._holders_lock:
+            for holder in list(self._holders):
+                _close_connection(holder.conn)
+            self._holders.clear()
+        self._local = threading.local()
+    
+    @classmethod
+    def close_all_managers(cls):
+        with cls._managers_lock:
+            for manager in cls._managers.values():
+                manager.close_all()
+
+
+# 进程退出时关闭连接，SQLite会把WAL文件合并回数据库
+atexit.register(ConnectionManager.close_all_managers)
+
 
 class StockDatabase:
-    def __init__(self):
-        self.db_path = DB_PATH
-        self.init_database()
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or DB_PATH
+        self._manager = ConnectionManager.for_path(self.db_path)
+        
+        # 表结构在每个进程中只初始化一次
+        with self._manager.schema_lock:
+            if not self._manager.schema_ready:
+                self.init_database()
+                self._manager.schema_ready = True
+    
+    def __reduce__(self):
+        # 传给子进程时只传路径，子进程自己建立连接
+        return type(self), (self.db_path,)
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        """返回当前线程的共享连接，调用方不要关闭"""
+        return self._manager.connection()
     
     def init_database(self):
         conn = self.get_connection()
@@ -55,40 +172,168 @@ class StockDatabase:
             ON stock_history(code, date)
         ''')
         
+        # 证券主表：代码、市场、名称、上市状态，用于离线完成代码标准化和名称查询
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS security_master (
+                code TEXT PRIMARY KEY,
+                symbol TEXT NOT NULL,
+                market TEXT NOT NULL,
+                name TEXT,
+                ipo_date TEXT,
+                out_date TEXT,
+                type TEXT,
+                status TEXT,
+                verified_date TEXT NOT NULL
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_security_master_symbol
+            ON security_master(symbol)
+        ''')
+        
+        # 全市场回填的工作单元（股票 × 日期区间）及完成情况，时间为Unix时间戳
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS backfill_units (
+                job TEXT NOT NULL,
+                code TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                rows INTEGER,
+                next_retry REAL,
+                last_error TEXT,
+                finished_at REAL,
+                PRIMARY KEY (job, code, start_date)
+            )
+        ''')
+        
+        # 自选股后台预取状态，时间为Unix时间戳
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS prefetch_status (
+                code TEXT PRIMARY KEY,
+                last_success REAL,
+                last_attempt REAL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                next_retry REAL,
+                last_error TEXT
+            )
+        ''')
+        
+        # 交易日历，is_trading 为1表示交易日
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trade_calendar (
+                date TEXT PRIMARY KEY,
+                is_trading INTEGER NOT NULL
+            )
+        ''')
+        
+        # 百分位计算结果缓存，last_data_date 为计算时该股票在 stock_history 中的最新日期
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS percentile_cache (
+                code TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                window_key TEXT NOT NULL,
+                last_data_date TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (code, metric, window_key, last_data_date)
+            )
+        ''')
+        
+        # 扩展窗口百分位的增量状态（有序值数组 + 最后处理的日期）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS percentile_state (
+                code TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                last_date TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (code, metric)
+            )
+        ''')
+        
+        # 增量状态已输出的逐日扩展窗口百分位，追加新交易日时只插入新行
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS percentile_rows (
+                code TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                date TEXT NOT NULL,
+                percentile REAL,
+                PRIMARY KEY (code, metric, date)
+            ) WITHOUT ROWID
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_percentile_cache_access
+            ON percentile_cache(last_access)
+        ''')
+        
         conn.commit()
-        conn.close()
     
-    def save_stock_data(self, df: pd.DataFrame, stock_code: str):
+    def save_stock_data(self, df: pd.DataFrame, stock_code: str) -> tuple:
+        """
+        批量保存股票数据（INSERT OR REPLACE，同一日期的旧数据被替换）
+        所有行在一个事务中通过 executemany 写入
+
+        Returns:
+            (新增条数, 更新条数)
+        """
         if df.empty:
-            return
-        
-        conn = self.get_connection()
+            return 0, 0
         
         df = df.copy()
         df['code'] = stock_code
         
-        columns = ['date', 'code', 'open', 'high', 'low', 'close', 'preclose',
-                   'volume', 'amount', 'adjustflag', 'turn', 'tradestatus', 'pctChg', 'isST',
-                   'peTTM', 'pbMRQ', 'psTTM', 'pcfNcfTTM']
-        
-        existing_columns = [col for col in columns if col in df.columns]
+        existing_columns = [col for col in STOCK_HISTORY_COLUMNS if col in df.columns]
         df_to_save = df[existing_columns]
         
-        for _, row in df_to_save.iterrows():
-            try:
-                placeholders = ', '.join(['?' for _ in existing_columns])
-                columns_str = ', '.join(existing_columns)
-                
-                cursor = conn.cursor()
-                cursor.execute(f'''
-                    INSERT OR REPLACE INTO stock_history ({columns_str})
-                    VALUES ({placeholders})
-                ''', tuple(row))
-            except Exception as e:
-                print(f"Error saving row: {e}")
+        # 按列转换为Python对象后按行打包，NaN由SQLite存为NULL
+        rows = list(zip(*(df_to_save[col].tolist() for col in existing_columns)))
         
-        conn.commit()
-        conn.close()
+        dates = set(df_to_save['date'].astype(str))
+        first_date, last_date = min(dates), max(dates)
+        
+        placeholders = ', '.join(['?' for _ in existing_columns])
+        columns_str = ', '.join(existing_columns)
+        
+        conn = self.get_connection()
+        try:
+            # 写入前统计已存在的日期，用于区分新增和更新
+            existing_dates = {
+                row[0] for row in conn.execute('''
+                    SELECT date FROM stock_history WHERE code = ? AND date >= ? AND date <= ?
+                ''', (stock_code, first_date, last_date))
+            }
+            updated = len(dates & existing_dates)
+            inserted = len(dates) - updated
+            
+            conn.executemany(f'''
+                INSERT OR REPLACE INTO stock_history ({columns_str})
+                VALUES ({placeholders})
+            ''', rows)
+            
+            self._invalidate_percentiles(conn, stock_code, first_date)
+            
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving {stock_code}: {e}")
+            raise
+        
+        return inserted, updated
+    
+    @staticmethod
+    def _invalidate_percentiles(conn: sqlite3.Connection, stock_code: str, first_date: str):
+        """写入了 first_date 及之后的数据，让该股票的百分位缓存失效（不提交事务）"""
+        # 有新数据写入，该股票已缓存的百分位结果全部失效
+        conn.execute('DELETE FROM percentile_cache WHERE code = ?', (stock_code,))
+        # 增量状态只能向后追加，改写了已处理日期的数据时需要重新计算，已输出的逐日百分位一并删除
+        conn.execute('DELETE FROM percentile_state WHERE code = ? AND last_date >= ?', (stock_code, first_date))
+        conn.execute('''
+            DELETE FROM percentile_rows WHERE code = ?
+                AND metric NOT IN (SELECT metric FROM percentile_state WHERE code = ?)
+        ''', (stock_code, stock_code))
     
     def get_stock_data(self, stock_code: str, start_date: str = None, end_date: str = None) -> pd.DataFrame:
         conn = self.get_connection()
@@ -106,7 +351,6 @@ class StockDatabase:
         query += " ORDER BY date ASC"
         
         df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
         
         return df
     
@@ -119,7 +363,6 @@ class StockDatabase:
         ''', (stock_code,))
         
         result = cursor.fetchone()
-        conn.close()
         
         return result[0] if result and result[0] else None
     
@@ -133,7 +376,6 @@ class StockDatabase:
         ''', (stock_code, stock_name, datetime.now().strftime('%Y-%m-%d')))
         
         conn.commit()
-        conn.close()
     
     def get_stock_memory(self) -> list:
         conn = self.get_connection()
@@ -144,16 +386,103 @@ class StockDatabase:
         ''')
         
         results = cursor.fetchall()
-        conn.close()
         
         return results
     
+    def save_securities(self, rows: list, verified_date: str = None):
+        """
+        批量写入证券主表
+        
+        Args:
+            rows: [(code, name, ipo_date, out_date, type, status), ...]，即 query_stock_basic 的返回字段
+            verified_date: 核对日期，默认为今天
+        """
+        verified_date = verified_date or datetime.now().strftime('%Y-%m-%d')
+        conn = self.get_connection()
+        conn.executemany('''
+            INSERT OR REPLACE INTO security_master
+                (code, symbol, market, name, ipo_date, out_date, type, status, verified_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(code, code.split('.')[-1], code.split('.')[0], name, ipo_date, out_date, sec_type, status,
+               verified_date)
+              for code, name, ipo_date, out_date, sec_type, status in rows])
+        conn.commit()
+    
+    def get_security(self, stock_code: str):
+        """
+        Returns:
+            (code, name, type, status)，不存在时返回None
+        """
+        return self.get_connection().execute('''
+            SELECT code, name, type, status FROM security_master WHERE code = ?
+        ''', (stock_code,)).fetchone()
+    
+    def find_securities(self, symbol: str) -> list:
+        """按不带市场前缀的代码查找，返回 [(code, name, type, status), ...]"""
+        return self.get_connection().execute('''
+            SELECT code, name, type, status FROM security_master WHERE symbol = ? ORDER BY code
+        ''', (symbol,)).fetchall()
+    
+    def get_security_master_date(self) -> str:
+        """证券主表最近一次核对日期，表为空时返回None"""
+        result = self.get_connection().execute('SELECT MAX(verified_date) FROM security_master').fetchone()
+        return result[0] if result else None
+    
+    def save_trade_dates(self, rows: list):
+        """批量写入交易日历，rows 为 [(date, is_trading), ...]"""
+        conn = self.get_connection()
+        conn.executemany('''
+            INSERT OR REPLACE INTO trade_calendar (date, is_trading) VALUES (?, ?)
+        ''', [(date, int(is_trading)) for date, is_trading in rows])
+        conn.commit()
+    
+    def get_trade_calendar_range(self) -> tuple:
+        """交易日历覆盖的 (最早日期, 最晚日期)，为空时返回 (None, None)"""
+        return self.get_connection().execute(
+            'SELECT MIN(date), MAX(date) FROM trade_calendar').fetchone()
+    
+    def is_trade_date(self, date: str):
+        """
+        Returns:
+            是否为交易日，日历中没有该日期时返回None
+        """
+        result = self.get_connection().execute(
+            'SELECT is_trading FROM trade_calendar WHERE date = ?', (date,)).fetchone()
+        return bool(result[0]) if result else None
+    
+    def get_last_trade_date(self, on_or_before: str) -> str:
+        """不晚于指定日期的最后一个交易日，日历中没有时返回None"""
+        result = self.get_connection().execute('''
+            SELECT MAX(date) FROM trade_calendar WHERE date <= ? AND is_trading = 1
+        ''', (on_or_before,)).fetchone()
+        return result[0] if result else None
+    
     def delete_stock_data(self, stock_code: str):
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM stock_history WHERE code = ?', (stock_code,))
         cursor.execute('DELETE FROM stock_memory WHERE code = ?', (stock_code,))
+        cursor.execute('DELETE FROM percentile_cache WHERE code = ?', (stock_code,))
+        cursor.execute('DELETE FROM percentile_state WHERE code = ?', (stock_code,))
+        cursor.execute('DELETE FROM percentile_rows WHERE code = ?', (stock_code,))
+        cursor.execute('DELETE FROM prefetch_status WHERE code = ?', (stock_code,))
         
         conn.commit()
-        conn.close()
\ No newline at end of file
+
+
+def open_database(db_path: str = None, backend: str = None) -> StockDatabase:
+    """
+    按配置创建日线存储
+
+    Args:
+        db_path: SQLite数据库路径（列式后端用于保存元数据）
+        backend: 'sqlite' 或 'columnar'，默认使用 config.STORAGE_BACKEND
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        return StockDatabase(db_path)
+    if backend == 'columnar':
+        from columnar_store import ColumnarStockStore
+        return ColumnarStockStore(db_path=db_path)
+    raise ValueError(f"不支持的存储后端: {backend}")
@@ -2,7 +2,7 @@
 中文字体配置模块
 解决matplotlib中文显示问题
 """
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.font_manager as fm
 import platform
 import os
@@ -12,7 +12,7 @@ def setup_chinese_font():
     system = platform.system()
     
     # 设置全局字体配置
-    plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+    matplotlib.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
     
     if system == 'Windows':
         # Windows系统常见中文字体
@@ -51,7 +51,7 @@ def setup_chinese_font():
             break
     
     if selected_font:
-        plt.rcParams['font.sans-serif'] = [selected_font] + plt.rcParams['font.sans-serif']
+        matplotlib.rcParams['font.sans-serif'] = [selected_font] + matplotlib.rcParams['font.sans-serif']
         print(f"已设置中文字体: {selected_font}")
     else:
         print("警告: 未找到合适的中文字体，中文可能显示为方框")
@@ -62,8 +62,8 @@ def setup_chinese_font():
 def get_font_info():
     """获取当前字体配置信息"""
     return {
-        'sans-serif': plt.rcParams['font.sans-serif'][:5],
-        'axes.unicode_minus': plt.rcParams['axes.unicode_minus']
+        'sans-serif': matplotlib.rcParams['font.sans-serif'][:5],
+        'axes.unicode_minus': matplotlib.rcParams['axes.unicode_minus']
     }
 
 # 自动配置字体
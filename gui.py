@@ -8,15 +8,26 @@ import pandas as pd
 import font_config
 
 from data_fetcher import DataFetcher
-from database import StockDatabase
+from database import open_database
 from valuation_calculator import ValuationCalculator
+from percentile_cache import PercentileCache
+from prefetch_scheduler import PrefetchScheduler
 from chart_view import ChartView
+from comparison import PercentileComparison
+from task_runner import TaskCancelled, TaskRunner
 from config import DEFAULT_YEARS, TIME_RANGES, VALUATION_TYPES
 
 
+# 滚动窗口下拉框中"不使用滚动窗口"的选项
+NO_ROLLING_WINDOW = '不滚动'
+
+# 取回后台任务结果的间隔（毫秒）
+TASK_POLL_MS = 50
+
+
 class ProgressDialog:
     """进度对话框"""
-    def __init__(self, parent, title="下载进度"):
+    def __init__(self, parent, title="下载进度", on_cancel=None):
         self.dialog = tk.Toplevel(parent)
         self.dialog.title(title)
         self.dialog.geometry("400x150")
@@ -50,6 +61,7 @@ class ProgressDialog:
         
         # 取消按钮
         self.cancelled = False
+        self._cancel_callback = on_cancel
         self.cancel_btn = ttk.Button(self.dialog, text="取消", command=self._on_cancel)
         self.cancel_btn.pack(pady=10)
         
@@ -58,6 +70,8 @@ class ProgressDialog:
     def _on_cancel(self):
         self.cancelled = True
         self.message_label.config(text="正在取消...")
+        if self._cancel_callback:
+            self._cancel_callback()
     
     def update_progress(self, message: str, percent: int = None):
         """更新进度"""
@@ -65,7 +79,6 @@ class ProgressDialog:
         if percent is not None:
             self.progress_var.set(percent)
             self.percent_label.config(text=f"{percent}%")
-        self.dialog.update()
     
     def close(self):
         """关闭对话框"""
@@ -83,22 +96,43 @@ class StockPEApp:
         self.root.title("个股PE百分位分析工具")
         self.root.geometry("1400x900")
 
-        self.data_fetcher = DataFetcher(progress_callback=self._on_progress)
-        self.db = StockDatabase()
+        self.db = open_database()
+        # 进度回调由后台任务在下载时设置（见 _fetch）
+        self.data_fetcher = DataFetcher(db=self.db)
+        self.percentile_cache = PercentileCache(self.db)
         self.current_df = None
         self.current_stock_code = None
         self.current_stock_name = None
         self.current_valuation_type = 'PE'  # 默认PE估值
         self.progress_dialog = None
+        self.raw_df = None
+        # 当前数据对应的估值计算器，缓存全部估值类型的结果，切换PE/PB/PS/PCF时直接查表
+        self.calculator = None
+        self._calculator_source = None
+        # 下载和计算在后台线程中进行，界面线程定期取回结果
+        self.task_runner = TaskRunner()
+        # 对比模式下的股票集合，None表示单只股票模式
+        self.comparison = None
 
         self._create_widgets()
         self._load_stock_memory()
 
         # 启动后自动加载上证指数
         self.root.after(100, self._load_default_index)
+
+        # 后台增量刷新全部自选股，之后打开自选股只读取本地数据
+        self.prefetch_scheduler = PrefetchScheduler(self.db)
+        self.root.after(3000, self.prefetch_scheduler.start)
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
+        self.root.after(TASK_POLL_MS, self._poll_tasks)
+
+    def _on_close(self):
+        self.task_runner.shutdown()
+        self.prefetch_scheduler.stop(timeout=1)
+        self.root.destroy()
     
     def _on_progress(self, message: str, percent: int = None):
-        """进度回调函数"""
+        """后台任务的进度（在界面线程中调用）"""
         if self.progress_dialog and self.progress_dialog.dialog.winfo_exists():
             self.progress_dialog.update_progress(message, percent)
     
@@ -124,9 +158,12 @@ class StockPEApp:
         ttk.Button(control_frame, text="查询", command=self._on_search).grid(row=0, column=2, padx=5)
         ttk.Button(control_frame, text="刷新数据", command=self._on_refresh).grid(row=0, column=3, padx=5)
         ttk.Button(control_frame, text="删除记忆", command=self._on_delete_memory).grid(row=0, column=4, padx=5)
+        ttk.Button(control_frame, text="加入对比", command=self._on_compare_add).grid(row=0, column=5, padx=5)
+        ttk.Button(control_frame, text="移出对比", command=self._on_compare_remove).grid(row=0, column=6, padx=5)
+        ttk.Button(control_frame, text="退出对比", command=self._on_compare_exit).grid(row=0, column=7, padx=5)
         
         date_frame = ttk.Frame(control_frame)
-        date_frame.grid(row=1, column=0, columnspan=5, sticky=(tk.W, tk.E), pady=10)
+        date_frame.grid(row=1, column=0, columnspan=8, sticky=(tk.W, tk.E), pady=10)
         
         ttk.Label(date_frame, text="开始日期:").grid(row=0, column=0, sticky=tk.W, padx=5)
         
@@ -162,6 +199,14 @@ class StockPEApp:
                                        values=list(VALUATION_TYPES.keys()), width=6, state='readonly')
         valuation_combo.grid(row=0, column=7, padx=5)
         valuation_combo.bind('<<ComboboxSelected>>', self._on_valuation_change)
+
+        # 滚动窗口选择：每个点只与其之前固定窗口内的数据比较
+        ttk.Label(date_frame, text="滚动窗口:").grid(row=0, column=8, sticky=tk.W, padx=5)
+        self.window_var = tk.StringVar(value=NO_ROLLING_WINDOW)
+        window_combo = ttk.Combobox(date_frame, textvariable=self.window_var,
+                                    values=[NO_ROLLING_WINDOW] + list(TIME_RANGES.keys()), width=8, state='readonly')
+        window_combo.grid(row=0, column=9, padx=5)
+        window_combo.bind('<<ComboboxSelected>>', self._on_date_change)
         
         slider_frame = ttk.LabelFrame(main_frame, text="起始日期选择", padding="10")
         slider_frame.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
@@ -216,111 +261,226 @@ class StockPEApp:
         new_type = self.valuation_var.get()
         if new_type != self.current_valuation_type:
             self.current_valuation_type = new_type
+            if self.comparison is not None:
+                # 对比数据已包含全部估值类型，直接切换
+                self._show_comparison()
+                return
             # 如果有当前数据，重新计算并显示
             if self.current_df is not None and not self.current_df.empty:
                 self._recalculate_and_display()
 
+    def _history_start(self, start: str, window: str):
+        """
+        滚动窗口模式下，计算百分位还需要开始日期之前一个窗口的历史数据
+
+        Returns:
+            需要加载数据的开始日期，None表示加载全部历史
+        """
+        if window not in TIME_RANGES:
+            return start
+
+        years = TIME_RANGES[window]
+        if years is None:
+            return None
+        history_start = datetime.strptime(start, '%Y-%m-%d') - timedelta(days=365 * years)
+        return history_start.strftime('%Y-%m-%d')
+
+    def _get_calculator(self, df, valuation_type: str):
+        """获取当前数据的估值计算器，数据未变化时复用已有结果（只在后台任务线程中调用）"""
+        if self.calculator is None or self._calculator_source is not df:
+            self.calculator = ValuationCalculator(df, valuation_type)
+            self._calculator_source = df
+        self.calculator.set_valuation_type(valuation_type)
+        return self.calculator
+
+    def _calculate_valuation(self, df, stock_code, start, end, valuation_type, window, checkpoint=None):
+        """
+        按估值类型和滚动窗口设置计算百分位（在后台任务线程中调用，参数在提交任务前从界面读取）
+        结果按 (股票, 估值类型, 窗口, 最新数据日期) 持久化缓存，重复查看时直接读取；
+        滚动窗口选"全部"时使用扩展窗口百分位的增量状态
+        """
+        rolling = window in TIME_RANGES
+        if rolling and TIME_RANGES[window] is None:
+            # 全部历史的扩展窗口：持久化的增量状态只计算新增交易日
+            return self.percentile_cache.get_expanding_percentiles(stock_code, valuation_type, start, end,
+                                                              checkpoint)
+        if rolling:
+            # 滚动窗口只计算当前估值类型
+            metric = valuation_type
+            cache_window = f"rolling:{window}:{start}~{end}"
+        else:
+            # 区间百分位一次算出全部估值类型，切换类型时共用同一条缓存
+            metric = 'ALL'
+            cache_window = f"range:{start}~{end}"
+
+        last_data_date = self.db.get_last_update_date(stock_code)
+        result = None
+        if last_data_date:
+            result = self.percentile_cache.get(stock_code, metric, cache_window, last_data_date)
+
+        if result is None:
+            calculator = self._get_calculator(df, valuation_type)
+            if rolling:
+                result = calculator.calculate_rolling_percentile(window, start, end, checkpoint)
+            else:
+                result = calculator.calculate_all_percentiles(start, end)
+            # 与读取缓存时的列类型一致
+            result = self.percentile_cache.normalize_frame(result)
+            if last_data_date:
+                self.percentile_cache.put(stock_code, metric, cache_window, last_data_date, result)
+
+        if rolling:
+            return result
+        return ValuationCalculator.select_valuation(result, valuation_type)
+
+    def _poll_tasks(self):
+        """定期取回后台任务的结果和进度"""
+        self.task_runner.poll()
+        self.root.after(TASK_POLL_MS, self._poll_tasks)
+
+    def _run_task(self, work, on_done, title=None, error_title="操作失败"):
+        """
+        在后台执行 work(token, progress)，完成后在界面线程调用 on_done(结果)
+        新任务提交时正在进行的任务被取消，其结果被丢弃
+
+        Args:
+            title: 进度对话框标题，None表示不显示对话框
+        """
+        self._close_progress_dialog()
+        if title:
+            self.progress_dialog = ProgressDialog(self.root, title=title, on_cancel=self._cancel_task)
+
+        def on_success(result):
+            self._close_progress_dialog()
+            on_done(result)
+
+        def on_error(error):
+            self._close_progress_dialog()
+            messagebox.showerror("错误", f"{error_title}: {error}")
+
+        self.task_runner.submit('view', work, on_success, on_error, self._on_progress)
+
+    def _cancel_task(self):
+        """取消当前后台任务（下载在下一个数据块、计算在下一个检查点停止）"""
+        self.task_runner.cancel('view')
+        self._close_progress_dialog()
+
+    def _close_progress_dialog(self):
+        if self.progress_dialog:
+            self.progress_dialog.close()
+            self.progress_dialog = None
+
+    def _fetch(self, progress, stock_code, start, end, force_update=False):
+        """在后台任务中下载数据，下载进度交给当前任务（同时作为取消检查点）"""
+        self.data_fetcher.progress_callback = progress
+        try:
+            return self.data_fetcher.fetch_stock_data(stock_code, start, end, force_update=force_update)
+        finally:
+            self.data_fetcher.progress_callback = None
+
+    def _show_result(self, stock_code, stock_name, raw_df, df_with_valuation, start, end, date_note=None):
+        """在界面线程中保存并显示计算结果（显示单只股票时退出对比模式）"""
+        self.comparison = None
+        self.current_stock_code = stock_code
+        self.current_stock_name = stock_name
+        self.current_start_date = start
+        self.current_end_date = end
+        # 保存原始数据（用于后续日期变化或估值类型切换时重新计算）
+        self.raw_df = raw_df
+        self.current_df = df_with_valuation
+
+        if date_note is None:
+            self._update_info(df_with_valuation, stock_code, stock_name)
+        else:
+            self._update_info_with_date_note(df_with_valuation, stock_code, stock_name, date_note)
+        self.chart_view.plot_data(df_with_valuation, stock_code, stock_name,
+                                  valuation_type=self.current_valuation_type)
+
     def _is_trading_day(self, date: datetime) -> bool:
-        """判断是否为交易日（非周末）"""
-        # 周六=5, 周日=6
-        return date.weekday() < 5
+        """判断是否为交易日（使用本地交易日历）"""
+        return self.data_fetcher.is_trading_day(date.strftime('%Y-%m-%d'))
 
     def _load_default_index(self):
         """加载默认上证指数数据"""
         DEFAULT_INDEX_CODE = 'sh.000001'
         DEFAULT_INDEX_NAME = '上证指数'
 
-        try:
-            # 设置日期范围（默认10年）
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=365 * DEFAULT_YEARS)
-            start = start_date.strftime('%Y-%m-%d')
-            end = end_date.strftime('%Y-%m-%d')
+        # 设置日期范围（默认10年）
+        end_date = datetime.now()
+        start_date = end_date - timedelta(days=365 * DEFAULT_YEARS)
+        start = start_date.strftime('%Y-%m-%d')
+        end = end_date.strftime('%Y-%m-%d')
+
+        # 更新日期选择器
+        self.start_date.set_date(start_date)
+        self.end_date.set_date(end_date)
+        self.stock_var.set(f"{DEFAULT_INDEX_CODE} - {DEFAULT_INDEX_NAME}")
+        self.info_text.delete(1.0, tk.END)
+        self.info_text.insert(tk.END, f"正在加载 {DEFAULT_INDEX_NAME} 数据...\n")
 
-            # 更新日期选择器
-            self.start_date.set_date(start_date)
-            self.end_date.set_date(end_date)
+        valuation_type = self.current_valuation_type
+        window = self.window_var.get()
 
+        def work(token, progress):
             # 检查数据库中是否有数据
             df = self.db.get_stock_data(DEFAULT_INDEX_CODE, start, end)
 
             # 检查是否需要获取最新数据
             today = datetime.now().date()
             is_trading_day = self._is_trading_day(end_date)
+            # 按交易日历和数据入库时间，服务器上可能存在的最新日期
+            latest_available = datetime.strptime(self.data_fetcher.latest_available_date(end), '%Y-%m-%d').date()
 
+            date_info = ""
             if not df.empty:
                 # 获取数据库中最新日期
                 db_latest_date = pd.to_datetime(df['date']).max().date()
 
-                # 如果是交易日且数据库数据不是最新的，尝试获取最新数据
-                if is_trading_day and db_latest_date < today:
-                    # 显示提示信息
-                    self.info_text.delete(1.0, tk.END)
-                    self.info_text.insert(tk.END, f"正在获取最新数据...\n")
-                    self.root.update()
-
+                # 服务器上有更新的交易日数据时才联网获取
+                if db_latest_date < latest_available:
                     try:
-                        # 尝试获取最新数据
-                        df_new, stock_name = self.data_fetcher.fetch_stock_data(
-                            DEFAULT_INDEX_CODE, start, end, force_update=False
-                        )
+                        df_new, _ = self._fetch(progress, DEFAULT_INDEX_CODE, start, end)
                         if not df_new.empty:
                             df = df_new
-                            # 再次检查最新日期
-                            db_latest_date = pd.to_datetime(df['date']).max().date()
+                    except TaskCancelled:
+                        raise
                     except Exception as e:
                         print(f"获取最新数据失败: {e}")
 
                 # 检查数据是否是最新的
                 latest_date = pd.to_datetime(df['date']).max().date()
-                date_info = ""
                 if latest_date < today:
-                    if is_trading_day:
+                    if latest_date < latest_available:
                         date_info = f"\n【注意】当前非最新数据，最新数据日期: {latest_date}"
+                    elif is_trading_day:
+                        date_info = f"\n【提示】今日数据尚未更新，最新数据日期: {latest_date}"
                     else:
                         date_info = f"\n【提示】今日非交易日，最新数据日期: {latest_date}"
 
             if df.empty:
                 # 数据库中没有数据，从网络获取
-                self.info_text.delete(1.0, tk.END)
-                self.info_text.insert(tk.END, f"正在下载 {DEFAULT_INDEX_NAME} 数据...\n")
-                self.root.update()
-
-                df, stock_name = self.data_fetcher.fetch_stock_data(DEFAULT_INDEX_CODE, start, end)
-
+                df, _ = self._fetch(progress, DEFAULT_INDEX_CODE, start, end)
                 if df.empty:
-                    self.info_text.delete(1.0, tk.END)
-                    self.info_text.insert(tk.END, "无法获取数据，请检查网络连接")
-                    return
-
-            # 保存数据
-            self.current_df = df
-            self.raw_df = df.copy()
-            self.current_stock_code = DEFAULT_INDEX_CODE
-            self.current_stock_name = DEFAULT_INDEX_NAME
-            self.current_start_date = start
-            self.current_end_date = end
-
-            # 设置股票代码输入框
-            self.stock_var.set(f"{DEFAULT_INDEX_CODE} - {DEFAULT_INDEX_NAME}")
-
-            # 计算估值
-            calculator = ValuationCalculator(df, self.current_valuation_type)
-            df_with_valuation = calculator.calculate_percentile_in_range(start, end)
-            self.current_df = df_with_valuation
-
-            # 更新显示
-            self._update_info_with_date_note(df_with_valuation, DEFAULT_INDEX_CODE, DEFAULT_INDEX_NAME, date_info)
-            self.chart_view.plot_data(df_with_valuation, DEFAULT_INDEX_CODE, DEFAULT_INDEX_NAME,
-                                      valuation_type=self.current_valuation_type)
+                    return None
+
+            token.check()
+            raw_df = df.copy()
+            df_with_valuation = self._calculate_valuation(raw_df, DEFAULT_INDEX_CODE, start, end,
+                                                          valuation_type, window, token.check)
+            return raw_df, df_with_valuation, date_info
 
+        def on_done(result):
+            if result is None:
+                self.info_text.delete(1.0, tk.END)
+                self.info_text.insert(tk.END, "无法获取数据，请检查网络连接")
+                return
+            raw_df, df_with_valuation, date_info = result
+            self._show_result(DEFAULT_INDEX_CODE, DEFAULT_INDEX_NAME, raw_df, df_with_valuation,
+                              start, end, date_info)
             # 加载到历史记录
             self._load_stock_memory()
 
-        except Exception as e:
-            print(f"加载默认指数失败: {e}")
-            import traceback
-            traceback.print_exc()
+        self._run_task(work, on_done, error_title="加载默认指数失败")
 
     def _update_info_with_date_note(self, df, stock_code, stock_name=None, date_note=""):
         """更新信息面板，支持添加日期提示"""
@@ -331,15 +491,11 @@ class StockPEApp:
         earliest = df.iloc[0]
 
         # 根据估值类型获取百分位
-        if self.current_valuation_type == 'PE':
-            percentile = latest.get('pe_percentile', 0)
-            valuation_label = "PE百分位"
-        else:
-            percentile = latest.get('pb_percentile', 0)
-            valuation_label = "PB百分位"
+        config = VALUATION_TYPES.get(self.current_valuation_type, {})
+        percentile = latest.get(f"{config.get('output', 'pe')}_percentile", 0)
+        valuation_label = f"{config.get('short_name', self.current_valuation_type)}百分位"
 
         # 获取阈值配置
-        config = VALUATION_TYPES.get(self.current_valuation_type, {})
         low_threshold = config.get('low_threshold', 30)
         high_threshold = config.get('high_threshold', 70)
 
@@ -372,66 +528,43 @@ class StockPEApp:
 
     def _on_date_change(self, event=None):
         """日期变化时从数据库重新读取数据并计算百分位"""
-        if self.current_stock_code:
-            try:
-                start = self.start_date.get_date().strftime('%Y-%m-%d')
-                end = self.end_date.get_date().strftime('%Y-%m-%d')
+        if not self.current_stock_code and self.comparison is None:
+            return
+        try:
+            start = self.start_date.get_date().strftime('%Y-%m-%d')
+            end = self.end_date.get_date().strftime('%Y-%m-%d')
+        except Exception:
+            return  # 日期格式不正确时忽略
 
-                print(f"\n{'='*60}")
-                print(f"日期变化: {start} 到 {end}")
-                print(f"当前股票: {self.current_stock_code}")
+        if self.comparison is not None:
+            self._update_comparison(start, end)
+            return
 
-                # 更新当前日期范围
-                self.current_start_date = start
-                self.current_end_date = end
+        stock_code, stock_name = self.current_stock_code, self.current_stock_name
+        valuation_type = self.current_valuation_type
+        window = self.window_var.get()
 
-                # 从数据库重新读取指定日期范围的数据
-                df = self.db.get_stock_data(self.current_stock_code, start, end)
-                print(f"从数据库读取数据条数: {len(df)}")
+        def work(token, progress):
+            # 从数据库重新读取指定日期范围的数据（滚动窗口模式下包含窗口期历史）
+            df = self.db.get_stock_data(stock_code, self._history_start(start, window), end)
+            if df.empty:
+                return None
+            token.check()
+            raw_df = df.copy()
+            return raw_df, self._calculate_valuation(raw_df, stock_code, start, end, valuation_type, window,
+                                                     token.check)
+
+        def on_done(result):
+            if result is None:
+                messagebox.showwarning("警告", "选定的日期范围内没有数据，请刷新数据")
+                return
+            raw_df, df_with_valuation = result
+            self._show_result(stock_code, stock_name, raw_df, df_with_valuation, start, end)
 
-                if df.empty:
-                    messagebox.showwarning("警告", "选定的日期范围内没有数据，请刷新数据")
-                    return
-
-                # 检查数据类型
-                if 'peTTM' in df.columns:
-                    print(f"peTTM数据类型: {df['peTTM'].dtype}")
-                    print(f"peTTM前5个值: {df['peTTM'].head().tolist()}")
-
-                # 保存原始数据
-                self.raw_df = df.copy()
-
-                # 使用估值计算器，在新的日期范围内计算百分位
-                calculator = ValuationCalculator(df, self.current_valuation_type)
-                df_with_valuation = calculator.calculate_percentile_in_range(start, end)
-
-                # 检查结果
-                if not df_with_valuation.empty and 'pe_percentile' in df_with_valuation.columns:
-                    print(f"计算后数据条数: {len(df_with_valuation)}")
-                    print(f"PE范围: {df_with_valuation['pe'].min():.2f} - {df_with_valuation['pe'].max():.2f}")
-                    print(f"百分位范围: {df_with_valuation['pe_percentile'].min():.2f}% - {df_with_valuation['pe_percentile'].max():.2f}%")
-
-                    # 找到最小和最大PE对应的百分位
-                    min_idx = df_with_valuation['pe'].idxmin()
-                    max_idx = df_with_valuation['pe'].idxmax()
-                    print(f"最小PE={df_with_valuation.loc[min_idx, 'pe']:.2f}, 百分位={df_with_valuation.loc[min_idx, 'pe_percentile']:.2f}%")
-                    print(f"最大PE={df_with_valuation.loc[max_idx, 'pe']:.2f}, 百分位={df_with_valuation.loc[max_idx, 'pe_percentile']:.2f}%")
-
-                self.current_df = df_with_valuation
-
-                self._update_info(df_with_valuation, self.current_stock_code, self.current_stock_name)
-                self.chart_view.plot_data(df_with_valuation, self.current_stock_code, self.current_stock_name,
-                                          valuation_type=self.current_valuation_type)
-
-                print(f"{'='*60}\n")
-            except Exception as e:
-                print(f"日期变化处理错误: {e}")
-                import traceback
-                traceback.print_exc()
-                pass  # 日期格式不正确时忽略
+        self._run_task(work, on_done, error_title="日期变化处理错误")
     
     def _on_slider_change(self, value):
-        if self.current_df is None or self.current_df.empty:
+        if self.current_df is None or self.current_df.empty or self.comparison is not None:
             return
         
         slider_val = int(float(value))
@@ -445,7 +578,8 @@ class StockPEApp:
             start_date = self.current_df.iloc[start_idx]['date']
             self.slider_label.config(text=f"从 {start_date.strftime('%Y-%m-%d')} 开始")
             
-            self.chart_view.plot_data(self.current_df, self.current_stock_code, self.current_stock_name, start_idx)
+            self.chart_view.plot_data(self.current_df, self.current_stock_code, self.current_stock_name, start_idx,
+                                      valuation_type=self.current_valuation_type)
     
     def _on_search(self):
         stock_input = self.stock_var.get().strip()
@@ -462,93 +596,67 @@ class StockPEApp:
             messagebox.showerror("错误", "日期格式不正确")
             return
 
-        # 显示进度对话框
-        self.progress_dialog = ProgressDialog(self.root, title="正在获取数据")
-        self.root.update()
+        valuation_type = self.current_valuation_type
+        window = self.window_var.get()
 
-        try:
+        def work(token, progress):
             # 获取用户选择的日期范围的数据
-            df, stock_name = self.data_fetcher.fetch_stock_data(stock_code, start, end)
-
-            # 关闭进度对话框
-            if self.progress_dialog:
-                self.progress_dialog.close()
-                self.progress_dialog = None
-
+            df, stock_name = self._fetch(progress, stock_code, self._history_start(start, window), end)
             if df.empty:
+                return None
+            # 保存标准化后的代码，后续按日期重新读取数据库时使用
+            normalized_code = self.data_fetcher.try_normalize_stock_code(stock_code)
+            progress("正在计算百分位...", 95)
+            raw_df = df.copy()
+            df_with_valuation = self._calculate_valuation(raw_df, normalized_code, start, end,
+                                                          valuation_type, window, token.check)
+            return normalized_code, stock_name, raw_df, df_with_valuation
+
+        def on_done(result):
+            if result is None:
                 messagebox.showwarning("警告", f"未找到股票 {stock_code} 的数据")
                 return
-
-            self.current_df = df
-            self.current_stock_code = stock_code
-            self.current_stock_name = stock_name
-            # 保存用户选择的日期范围
-            self.current_start_date = start
-            self.current_end_date = end
-            # 保存原始数据（用于后续日期变化时重新计算）
-            self.raw_df = df.copy()
-
-            # 使用估值计算器，在用户选择的日期范围内计算百分位
-            calculator = ValuationCalculator(df, self.current_valuation_type)
-            df_with_valuation = calculator.calculate_percentile_in_range(start, end)
-            self.current_df = df_with_valuation
-
-            self._update_info(df_with_valuation, stock_code, stock_name)
-            self.chart_view.plot_data(df_with_valuation, stock_code, stock_name,
-                                      valuation_type=self.current_valuation_type)
-
+            normalized_code, stock_name, raw_df, df_with_valuation = result
+            self._show_result(normalized_code, stock_name, raw_df, df_with_valuation, start, end)
             self._load_stock_memory()
 
-        except Exception as e:
-            if self.progress_dialog:
-                self.progress_dialog.close()
-                self.progress_dialog = None
-            messagebox.showerror("错误", f"查询失败: {str(e)}")
+        self._run_task(work, on_done, title="正在获取数据", error_title="查询失败")
 
     def _on_refresh(self):
         if not self.current_stock_code:
             messagebox.showwarning("警告", "请先查询股票")
             return
 
-        # 显示进度对话框
-        self.progress_dialog = ProgressDialog(self.root, title="正在刷新数据")
-        self.root.update()
-
         try:
             start = self.start_date.get_date().strftime('%Y-%m-%d')
             end = self.end_date.get_date().strftime('%Y-%m-%d')
+        except:
+            messagebox.showerror("错误", "日期格式不正确")
+            return
 
-            df, stock_name = self.data_fetcher.fetch_stock_data(self.current_stock_code, start, end, force_update=True)
+        stock_code = self.current_stock_code
+        valuation_type = self.current_valuation_type
+        window = self.window_var.get()
 
-            # 关闭进度对话框
-            if self.progress_dialog:
-                self.progress_dialog.close()
-                self.progress_dialog = None
+        def work(token, progress):
+            df, stock_name = self._fetch(progress, stock_code, self._history_start(start, window), end,
+                                         force_update=True)
+            if df.empty:
+                return None
+            progress("正在计算百分位...", 95)
+            raw_df = df.copy()
+            df_with_valuation = self._calculate_valuation(raw_df, stock_code, start, end,
+                                                          valuation_type, window, token.check)
+            return stock_name, raw_df, df_with_valuation
+
+        def on_done(result):
+            if result is None:
+                return
+            stock_name, raw_df, df_with_valuation = result
+            self._show_result(stock_code, stock_name, raw_df, df_with_valuation, start, end)
+            messagebox.showinfo("成功", "数据已更新")
 
-            if not df.empty:
-                self.current_df = df
-                self.current_stock_name = stock_name
-                # 保存用户选择的日期范围
-                self.current_start_date = start
-                self.current_end_date = end
-                # 保存原始数据
-                self.raw_df = df.copy()
-
-                # 使用估值计算器，在选定的日期范围内计算百分位
-                calculator = ValuationCalculator(df, self.current_valuation_type)
-                df_with_valuation = calculator.calculate_percentile_in_range(start, end)
-                self.current_df = df_with_valuation
-
-                self._update_info(df_with_valuation, self.current_stock_code, stock_name)
-                self.chart_view.plot_data(df_with_valuation, self.current_stock_code, stock_name,
-                                          valuation_type=self.current_valuation_type)
-
-                messagebox.showinfo("成功", "数据已更新")
-        except Exception as e:
-            if self.progress_dialog:
-                self.progress_dialog.close()
-                self.progress_dialog = None
-            messagebox.showerror("错误", f"刷新失败: {str(e)}")
+        self._run_task(work, on_done, title="正在刷新数据", error_title="刷新失败")
     
     def _on_delete_memory(self):
         stock_input = self.stock_var.get().strip()
@@ -559,7 +667,10 @@ class StockPEApp:
         stock_code = stock_input.split(' - ')[0].strip()
         
         if messagebox.askyesno("确认", f"确定要删除 {stock_code} 的数据吗？"):
+            # 正在进行的下载或计算的结果不再显示
+            self.task_runner.cancel('view')
             self.db.delete_stock_data(stock_code)
+            self.comparison = None
             self._load_stock_memory()
             self.stock_var.set("")
             self.current_df = None
@@ -569,6 +680,128 @@ class StockPEApp:
             self.info_text.delete(1.0, tk.END)
             messagebox.showinfo("成功", "数据已删除")
 
+    def _on_compare_add(self):
+        """把输入框中的股票加入对比，对比区间为当前选择的日期范围"""
+        stock_input = self.stock_var.get().strip()
+        if not stock_input:
+            messagebox.showwarning("警告", "请输入股票代码")
+            return
+
+        try:
+            start = self.start_date.get_date().strftime('%Y-%m-%d')
+            end = self.end_date.get_date().strftime('%Y-%m-%d')
+        except:
+            messagebox.showerror("错误", "日期格式不正确")
+            return
+
+        if self.comparison is None:
+            self.comparison = PercentileComparison(start, end, self.db, self.percentile_cache)
+            # 当前显示的股票作为第一只对比股票
+            if self.current_stock_code:
+                self.comparison.names[self.current_stock_code] = self.current_stock_name
+        self._update_comparison(start, end, stock_input.split(' - ')[0].strip())
+
+    def _update_comparison(self, start, end, stock_code=None):
+        """
+        在后台加载对比数据：区间变化时重新加载已加入的股票，stock_code 不为None时下载并加入该股票
+        加载完成后只重绘数据有变化的曲线
+        """
+        comparison = self.comparison
+        comparison.set_range(start, end)
+        reload = [(code, comparison.names[code]) for code in comparison.unloaded]
+
+        def work(token, progress):
+            new_stock = None
+            if stock_code:
+                df, stock_name = self._fetch(progress, stock_code, start, end)
+                if df.empty:
+                    return None
+                new_stock = (self.data_fetcher.try_normalize_stock_code(stock_code), stock_name)
+            progress("正在计算百分位...", 95)
+            frames = []
+            for code, name in reload + ([new_stock] if new_stock else []):
+                token.check()
+                frames.append((code, name, comparison.load(code, start, end)))
+            return new_stock, frames
+
+        def on_done(result):
+            if result is None:
+                messagebox.showwarning("警告", f"未找到股票 {stock_code} 的数据")
+                return
+            new_stock, frames = result
+            for code, name, frame in frames:
+                # 加载期间已被移除的股票不再加回对比
+                if code in comparison or (new_stock and code == new_stock[0]):
+                    comparison.add(code, name, frame)
+            self._show_comparison()
+            if stock_code:
+                self._load_stock_memory()
+
+        self._run_task(work, on_done, title="正在获取数据" if stock_code else None, error_title="加载对比数据失败")
+
+    def _on_compare_remove(self):
+        """从对比中移除输入框中的股票"""
+        if self.comparison is None:
+            return
+        stock_code = self.stock_var.get().strip().split(' - ')[0].strip()
+        # 只在已加入的代码中匹配，界面线程不访问证券主表和服务器
+        code = self.comparison.match(stock_code) if stock_code else None
+        if code is None:
+            messagebox.showwarning("警告", f"{stock_code or '该股票'} 不在对比中")
+            return
+        self.comparison.remove(code)
+        self._show_comparison()
+
+    def _on_compare_exit(self):
+        """退出对比模式，重新显示单只股票"""
+        if self.comparison is None:
+            return
+        self.task_runner.cancel('view')
+        self.comparison = None
+        if self.current_stock_code:
+            # 对比期间可能切换了日期或估值类型，按当前设置重新读取
+            self._on_date_change()
+        else:
+            self.chart_view.clear()
+            self.info_text.delete(1.0, tk.END)
+
+    def _show_comparison(self):
+        """显示对比图和各股票的最新百分位"""
+        comparison, valuation_type = self.comparison, self.current_valuation_type
+        series = comparison.series(valuation_type)
+        aligned = comparison.aligned(valuation_type)
+        self.chart_view.plot_comparison(series, aligned, comparison.names, valuation_type)
+
+        config = VALUATION_TYPES.get(valuation_type, {})
+        low_threshold = config.get('low_threshold', 30)
+        high_threshold = config.get('high_threshold', 70)
+        lines = [
+            f"估值类型: {valuation_type} ({config.get('name', '')})",
+            f"对比区间: {comparison.start_date} 至 {comparison.end_date}",
+            f"股票数量: {len(comparison)}",
+            "",
+            "=== 最新百分位 ===",
+        ]
+        for code, name in comparison.names.items():
+            values = series.get(code)
+            name_display = f" ({name})" if name and name != code else ""
+            if values is None or values.empty:
+                lines.append(f"{code}{name_display}: 无数据")
+                continue
+            percentile = values.iloc[-1]
+            if percentile < low_threshold:
+                status = "低估"
+            elif percentile > high_threshold:
+                status = "高估"
+            else:
+                status = "正常"
+            lines.append(f"{code}{name_display}: {percentile:.2f}% {status} ({values.index[-1].strftime('%Y-%m-%d')})")
+        if not aligned.empty:
+            lines += ["", f"交易日: {len(aligned)} 个，全部股票均有数据 {len(aligned.dropna())} 个"]
+
+        self.info_text.delete(1.0, tk.END)
+        self.info_text.insert(1.0, '\n'.join(lines))
+
     def _recalculate_and_display(self):
         """重新计算并显示当前数据（用于PE/PB切换）"""
         if self.raw_df is None or self.raw_df.empty:
@@ -577,29 +810,20 @@ class StockPEApp:
         # 获取当前日期范围
         start = getattr(self, 'current_start_date', None)
         end = getattr(self, 'current_end_date', None)
+        stock_code, stock_name, raw_df = self.current_stock_code, self.current_stock_name, self.raw_df
+        valuation_type = self.current_valuation_type
+        window = self.window_var.get()
 
-        # 从原始数据中过滤当前日期范围
-        import pandas as pd
-        df_filtered = self.raw_df.copy()
-        if start:
-            start_dt = pd.to_datetime(start)
-            df_filtered = df_filtered[df_filtered['date'] >= start_dt]
-        if end:
-            end_dt = pd.to_datetime(end)
-            df_filtered = df_filtered[df_filtered['date'] <= end_dt]
-        df_filtered = df_filtered.reset_index(drop=True)
-
-        if df_filtered.empty:
-            return
+        def work(token, progress):
+            # 使用新的估值类型在选定的日期范围内重新计算（计算器内部按日期范围过滤）
+            return self._calculate_valuation(raw_df, stock_code, start, end, valuation_type, window, token.check)
 
-        # 使用新的估值类型在选定的日期范围内重新计算
-        calculator = ValuationCalculator(df_filtered, self.current_valuation_type)
-        df_with_valuation = calculator.calculate_percentile_in_range(start, end)
-        self.current_df = df_with_valuation
+        def on_done(df_with_valuation):
+            if df_with_valuation.empty:
+                return
+            self._show_result(stock_code, stock_name, raw_df, df_with_valuation, start, end)
 
-        self._update_info(df_with_valuation, self.current_stock_code, self.current_stock_name)
-        self.chart_view.plot_data(df_with_valuation, self.current_stock_code, self.current_stock_name,
-                                  valuation_type=self.current_valuation_type)
+        self._run_task(work, on_done, error_title="计算失败")
 
     def _update_info(self, df, stock_code, stock_name=None):
         if df.empty:
@@ -609,15 +833,11 @@ class StockPEApp:
         earliest = df.iloc[0]
 
         # 根据估值类型获取百分位
-        if self.current_valuation_type == 'PE':
-            percentile = latest.get('pe_percentile', 0)
-            valuation_label = "PE百分位"
-        else:
-            percentile = latest.get('pb_percentile', 0)
-            valuation_label = "PB百分位"
+        config = VALUATION_TYPES.get(self.current_valuation_type, {})
+        percentile = latest.get(f"{config.get('output', 'pe')}_percentile", 0)
+        valuation_label = f"{config.get('short_name', self.current_valuation_type)}百分位"
 
         # 获取阈值配置
-        config = VALUATION_TYPES.get(self.current_valuation_type, {})
         low_threshold = config.get('low_threshold', 30)
         high_threshold = config.get('high_threshold', 70)
 
@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 
+from percentile_engine import expanding_percentile
+
 class PECalculator:
     def __init__(self, df: pd.DataFrame):
         self.df = df.copy()
@@ -30,16 +32,7 @@ class PECalculator:
             return df
         
         df['pe_percentile'] = np.nan
-        df['price_percentile'] = np.nan
-        
-        for i in range(len(df)):
-            current_price = df.loc[i, 'close']
-            
-            historical_prices = df.loc[:i, 'close'].values
-            
-            if len(historical_prices) > 1:
-                percentile = (historical_prices < current_price).sum() / (len(historical_prices) - 1) * 100
-                df.loc[i, 'price_percentile'] = percentile
+        df['price_percentile'] = expanding_percentile(df['close'].to_numpy(dtype=float), skipna=False)
         
         df['pe'] = df['close']
         df['pe_percentile'] = df['price_percentile']
@@ -75,15 +68,7 @@ class PECalculator:
             return pd.DataFrame()
         
         df['pe_percentile'] = np.nan
-        df['price_percentile'] = np.nan
-        
-        for i in range(len(df)):
-            current_price = df.loc[i, 'close']
-            historical_prices = df.loc[:i, 'close'].values
-            
-            if len(historical_prices) > 1:
-                percentile = (historical_prices < current_price).sum() / (len(historical_prices) - 1) * 100
-                df.loc[i, 'price_percentile'] = percentile
+        df['price_percentile'] = expanding_percentile(df['close'].to_numpy(dtype=float), skipna=False)
         
         df['pe'] = df['close']
         df['pe_percentile'] = df['price_percentile']
@@ -0,0 +1,258 @@
+"""
+百分位结果持久化缓存
+将计算好的百分位序列保存到数据库的 percentile_cache 表，数据未更新时直接读取
+"""
+import io
+import time
+
+import numpy as np
+import pandas as pd
+
+from columnar_store import FLAG_COLUMNS, FLAG_MISSING
+from config import PERCENTILE_CACHE_MAX_ENTRIES
+from database import StockDatabase, open_database
+from percentile_engine import ExpandingPercentileState
+from valuation_calculator import ValuationCalculator
+
+# 百分位结果中保存为字符串的列
+TEXT_COLUMNS = ['code']
+
+
+class PercentileCache:
+    """
+    百分位结果缓存
+    键为 (股票代码, 估值类型, 窗口, 最新数据日期)，最新数据日期变化后旧结果自动失效；
+    StockDatabase.save_stock_data 写入新数据时也会删除该股票的全部缓存
+    """
+
+    def __init__(self, db: StockDatabase = None, max_entries: int = PERCENTILE_CACHE_MAX_ENTRIES):
+        self.db = db or open_database()
+        self.max_entries = max_entries
+
+    @staticmethod
+    def normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        统一百分位结果的列类型，命中与未命中缓存时返回的DataFrame形状一致（与存储后端无关）：
+        date 为 datetime64[ns]，文本列（股票代码）为字符串，其余列（含标志列）均为float64；
+        列式存储中标志列的缺失值 FLAG_MISSING 转为NaN；不输出数据库内部的 id 列
+        """
+        df = df.drop(columns=['id'], errors='ignore').copy()
+        for col in df.columns:
+            if col == 'date':
+                df[col] = pd.to_datetime(df[col]).astype('datetime64[ns]')
+            elif col in TEXT_COLUMNS:
+                df[col] = df[col].astype(object)
+            elif df[col].dtype != np.float64:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+            if col in FLAG_COLUMNS:
+                df[col] = df[col].mask(df[col] == FLAG_MISSING)
+        return df
+
+    @classmethod
+    def _serialize(cls, df: pd.DataFrame) -> bytes:
+        """保存 normalize_frame 后的全部列，使用npz格式（不依赖pickle）"""
+        df = cls.normalize_frame(df)
+        arrays = {}
+        for col in df.columns:
+            if col in TEXT_COLUMNS:
+                arrays[col] = df[col].fillna('').to_numpy(dtype=str)
+            else:
+                arrays[col] = df[col].to_numpy()
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def _deserialize(cls, payload: bytes) -> pd.DataFrame:
+        with np.load(io.BytesIO(payload), allow_pickle=False) as data:
+            df = pd.DataFrame({name: data[name] for name in data.files})
+        for col in TEXT_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype(object).where(df[col] != '', np.nan)
+        return cls.normalize_frame(df)
+
+    def get(self, code: str, metric: str, window: str, last_data_date: str):
+        """
+        读取缓存
+
+        Returns:
+            缓存的DataFrame，未命中时返回None
+        """
+        with self.db.get_connection() as conn:
+            row = conn.execute('''
+                SELECT payload FROM percentile_cache
+                WHERE code = ? AND metric = ? AND window_key = ? AND last_data_date = ?
+            ''', (code, metric, window, last_data_date)).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute('''
+                UPDATE percentile_cache SET last_access = ?
+                WHERE code = ? AND metric = ? AND window_key = ? AND last_data_date = ?
+            ''', (time.time(), code, metric, window, last_data_date))
+
+        return self._deserialize(row[0])
+
+    def put(self, code: str, metric: str, window: str, last_data_date: str, df: pd.DataFrame):
+        """写入缓存，超过容量时淘汰最久未访问的条目"""
+        if df is None or df.empty:
+            return
+
+        payload = self._serialize(df)
+        with self.db.get_connection() as conn:
+            # 同一股票、估值类型、窗口只保留最新数据日期对应的结果
+            conn.execute('''
+                DELETE FROM percentile_cache WHERE code = ? AND metric = ? AND window_key = ?
+            ''', (code, metric, window))
+            conn.execute('''
+                INSERT INTO percentile_cache (code, metric, window_key, last_data_date, payload, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (code, metric, window, last_data_date, payload, time.time()))
+            conn.execute('''
+                DELETE FROM percentile_cache WHERE rowid IN (
+                    SELECT rowid FROM percentile_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+
+    def get_range_percentiles(self, code: str, start_date: str, end_date: str) -> pd.DataFrame:
+        """
+        区间内全部估值类型的百分位（calculate_all_percentiles 的结果），未命中缓存时计算并写入
+        与界面区间模式使用同一缓存条目 (股票, 'ALL', 'range:开始~结束')
+
+        Returns:
+            包含 pe_percentile、pb_percentile 等列的DataFrame，没有数据时为空
+        """
+        cache_window = f"range:{start_date}~{end_date}"
+        last_data_date = self.db.get_last_update_date(code)
+        if last_data_date:
+            result = self.get(code, 'ALL', cache_window, last_data_date)
+            if result is not None:
+                return result
+
+        df = self.db.get_stock_data(code, start_date, end_date)
+        if df.empty:
+            return df
+        result = self.normalize_frame(ValuationCalculator(df).calculate_all_percentiles(start_date, end_date))
+        if last_data_date:
+            self.put(code, 'ALL', cache_window, last_data_date, result)
+        return result
+
+    def get_state(self, code: str, metric: str):
+        """
+        读取扩展窗口百分位的增量状态
+
+        Returns:
+            ExpandingPercentileState，不存在或为旧格式时返回None
+        """
+        with self.db.get_connection() as conn:
+            row = conn.execute('''
+                SELECT payload FROM percentile_state WHERE code = ? AND metric = ?
+            ''', (code, metric)).fetchone()
+
+        return ExpandingPercentileState.from_bytes(row[0]) if row else None
+
+    def put_state(self, code: str, metric: str, state: ExpandingPercentileState):
+        """保存扩展窗口百分位的增量状态"""
+        with self.db.get_connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO percentile_state (code, metric, last_date, payload)
+                VALUES (?, ?, ?, ?)
+            ''', (code, metric, state.last_date, state.to_bytes()))
+
+    def get_expanding_rows(self, code: str, metric: str, start_date: str = None,
+                           end_date: str = None) -> pd.DataFrame:
+        """
+        读取增量状态已输出的逐日百分位
+
+        Returns:
+            按日期升序的 date、percentile 两列，日期为 YYYY-MM-DD 字符串
+        """
+        query = 'SELECT date, percentile FROM percentile_rows WHERE code = ? AND metric = ?'
+        params = [code, metric]
+        if start_date:
+            query += ' AND date >= ?'
+            params.append(start_date)
+        if end_date:
+            query += ' AND date <= ?'
+            params.append(end_date)
+        query += ' ORDER BY date'
+        return pd.read_sql_query(query, self.db.get_connection(), params=params)
+
+    def update_expanding(self, code: str, valuation_type: str = 'PE') -> tuple:
+        """
+        用数据库中新增的交易日增量更新扩展窗口百分位
+        只读取上次处理日期之后的数据，百分位计算为 O(k log n)；新行的百分位追加到 percentile_rows，
+        状态只包含有序值和最后一行的标量，读写它是一次 O(n) 的顺序拷贝
+
+        Args:
+            code: 股票代码
+            valuation_type: 估值类型
+
+        Returns:
+            (新增行的DataFrame, 更新后的状态)
+        """
+        metric = valuation_type.upper()
+        state = self.get_state(code, metric)
+        rebuild = state is None
+        df = self.db.get_stock_data(code, start_date=None if rebuild else state.last_date)
+
+        new_rows, state = ValuationCalculator(df, metric).calculate_percentile_incremental(state)
+        if new_rows.empty:
+            return new_rows, state
+
+        # NaN 由SQLite存为NULL
+        rows = zip(new_rows['date'].dt.strftime('%Y-%m-%d').tolist(), new_rows['percentile'].tolist())
+        with self.db.get_connection() as conn:
+            if rebuild:
+                conn.execute('DELETE FROM percentile_rows WHERE code = ? AND metric = ?', (code, metric))
+            conn.executemany('''
+                INSERT OR REPLACE INTO percentile_rows (code, metric, date, percentile) VALUES (?, ?, ?, ?)
+            ''', [(code, metric, date, percentile) for date, percentile in rows])
+            conn.execute('''
+                INSERT OR REPLACE INTO percentile_state (code, metric, last_date, payload)
+                VALUES (?, ?, ?, ?)
+            ''', (code, metric, state.last_date, state.to_bytes()))
+        return new_rows, state
+
+    def get_expanding_percentiles(self, code: str, valuation_type: str = 'PE', start_date: str = None,
+                                  end_date: str = None, checkpoint=None) -> pd.DataFrame:
+        """
+        全部历史的扩展窗口百分位（界面滚动窗口选"全部"时），与 calculate_rolling_percentile('全部') 一致
+        先用增量状态处理新增的交易日，再只读取 start_date ~ end_date 区间的日线和已保存的百分位
+
+        Args:
+            checkpoint: 各阶段之间调用的检查点，抛出异常即中止（用于取消）；
+                        增量更新在写入状态前完成，中止不会留下不完整的状态
+
+        Returns:
+            start_date ~ end_date 区间的结果
+        """
+        metric = valuation_type.upper()
+        self.update_expanding(code, metric)
+        if checkpoint is not None:
+            checkpoint()
+        df = self.db.get_stock_data(code, start_date, end_date)
+        saved = self.get_expanding_rows(code, metric, start_date, end_date)
+
+        if df.empty:
+            return pd.DataFrame()
+        calculator = ValuationCalculator(df, metric)
+        if not np.array_equal(calculator.df['date'].to_numpy(), pd.to_datetime(saved['date']).to_numpy()):
+            # 读取期间数据被改写，已保存的百分位与数据不再对应，本次全量计算
+            full = ValuationCalculator(self.db.get_stock_data(code, end_date=end_date), metric)
+            return full.calculate_rolling_percentile('全部', start_date, end_date, checkpoint)
+        return calculator.apply_expanding_percentiles(saved['percentile'].to_numpy(dtype=float))
+
+    def invalidate(self, code: str = None):
+        """删除指定股票（或全部）的缓存和增量状态"""
+        with self.db.get_connection() as conn:
+            if code:
+                conn.execute('DELETE FROM percentile_cache WHERE code = ?', (code,))
+                conn.execute('DELETE FROM percentile_state WHERE code = ?', (code,))
+                conn.execute('DELETE FROM percentile_rows WHERE code = ?', (code,))
+            else:
+                conn.execute('DELETE FROM percentile_cache')
+                conn.execute('DELETE FROM percentile_state')
+                conn.execute('DELETE FROM percentile_rows')
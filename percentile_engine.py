@@ -0,0 +1,393 @@
+"""
+百分位计算引擎
+基于增量有序数组的向量化百分位算法，替代逐行切片的 O(n²) 循环
+
+百分位公式与原实现保持一致：
+    百分位 = (比当前值小的数量) / (样本总数 - 1) * 100
+"""
+import io
+from bisect import bisect_left, insort
+
+import numpy as np
+
+
+# 每个分块的最小行数，块内比较为 O(B²)，块间合并为 O(n)
+MIN_BLOCK_SIZE = 64
+
+# 滚动窗口百分位每处理多少行调用一次检查点
+CHECKPOINT_ROWS = 4096
+
+# ExpandingPercentileState 序列化格式的版本，格式变化后旧状态作废、重新全量计算
+STATE_FORMAT = 2
+
+
+def _block_size(n: int) -> int:
+    """根据数据量选择分块大小（约为 sqrt(n)）"""
+    return max(MIN_BLOCK_SIZE, int(np.sqrt(n)))
+
+
+def _count_less_expanding(sorted_prefix: np.ndarray, values: np.ndarray):
+    """
+    对 values 中的每个元素，统计"已有有序数组 + values 中它之前的元素"里严格小于它的数量
+
+    Args:
+        sorted_prefix: 已有的有序数组（不含NaN）
+        values: 按时间顺序追加的新值（不含NaN）
+
+    Returns:
+        (count_less, 合并后的有序数组)
+    """
+    counts = np.empty(len(values), dtype=np.int64)
+    block = _block_size(len(sorted_prefix) + len(values))
+
+    for begin in range(0, len(values), block):
+        chunk = values[begin:begin + block]
+
+        # 与之前所有块比较：有序数组上二分查找
+        chunk_counts = np.searchsorted(sorted_prefix, chunk, side='left')
+
+        # 块内比较：只统计位于自己之前且严格更小的值
+        less = chunk[np.newaxis, :] < chunk[:, np.newaxis]
+        chunk_counts += np.tril(less, k=-1).sum(axis=1)
+        counts[begin:begin + len(chunk)] = chunk_counts
+
+        # 将本块合并进有序数组
+        sorted_chunk = np.sort(chunk)
+        positions = np.searchsorted(sorted_prefix, sorted_chunk, side='left')
+        sorted_prefix = np.insert(sorted_prefix, positions, sorted_chunk)
+
+    return counts, sorted_prefix
+
+
+def expanding_percentile(values, skipna: bool = True) -> np.ndarray:
+    """
+    计算扩展窗口百分位：每个点相对于"从第一行到当前行"的历史数据的百分位
+
+    Args:
+        values: 按日期升序排列的数值序列
+        skipna: 参见 ExpandingPercentileState
+
+    Returns:
+        与 values 等长的百分位数组，无法计算的位置为NaN
+    """
+    return ExpandingPercentileState(skipna).extend(values)
+
+
+def range_percentile(values) -> np.ndarray:
+    """
+    计算区间百分位：每个点相对于整个区间内全部有效数据的百分位
+    排序一次后用二分查找得到每个点的"严格小于"数量
+
+    Args:
+        values: 区间内的数值序列
+
+    Returns:
+        与 values 等长的百分位数组，NaN位置或有效值不足2个时为NaN
+    """
+    values = np.asarray(values, dtype=float)
+    result = np.full(len(values), np.nan)
+
+    valid = ~np.isnan(values)
+    sorted_values = np.sort(values[valid])
+    total = len(sorted_values)
+    if total < 2:
+        return result
+
+    count_less = np.searchsorted(sorted_values, values[valid], side='left')
+    result[valid] = count_less / (total - 1) * 100
+    return result
+
+
+def range_percentile_2d(matrix) -> np.ndarray:
+    """
+    批量计算多列的区间百分位（每列独立统计）
+    对二维数组按列一次排序，用并列组的首位置作为"严格小于"的数量
+
+    Args:
+        matrix: 形状为 (行数, 列数) 的数值数组
+
+    Returns:
+        同形状的百分位数组，NaN位置或该列有效值不足2个时为NaN
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    rows = matrix.shape[0]
+    valid = ~np.isnan(matrix)
+    totals = valid.sum(axis=0)
+
+    # NaN 会被排到每列末尾，不影响有效值的位置
+    order = np.argsort(matrix, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(matrix, order, axis=0)
+
+    # 每个排序位置所在并列组的起始下标 = 严格小于它的数量
+    group_start = np.ones(matrix.shape, dtype=bool)
+    group_start[1:] = sorted_values[1:] != sorted_values[:-1]
+    first_index = np.where(group_start, np.arange(rows)[:, np.newaxis], 0)
+    first_index = np.maximum.accumulate(first_index, axis=0)
+
+    count_less = np.empty(matrix.shape, dtype=np.int64)
+    np.put_along_axis(count_less, order, first_index, axis=0)
+
+    result = np.full(matrix.shape, np.nan)
+    usable = valid & (totals > 1)
+    denominators = np.broadcast_to(totals - 1, matrix.shape)
+    result[usable] = count_less[usable] / denominators[usable] * 100
+    return result
+
+
+class SortedBlockList:
+    """
+    分块有序列表（顺序统计结构）
+    数据分散在若干个有序小块中，插入、删除、排名查询均为对数级二分加块内移动；
+    各块长度的前缀和保存在树状数组中，排名查询不需要逐块累加
+    """
+
+    def __init__(self, load: int = 256):
+        self._load = load
+        self._blocks = []   # 每个元素是一个有序list
+        self._maxes = []    # 每个块的最大值，用于定位块
+        self._tree = []     # 块长度的树状数组（Fenwick tree）
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @classmethod
+    def from_sorted(cls, values, load: int = 256) -> 'SortedBlockList':
+        """由已排序的数据直接分块构建，O(n)"""
+        lst = cls(load)
+        values = np.asarray(values, dtype=float).tolist()
+        lst._blocks = [values[i:i + load] for i in range(0, len(values), load)]
+        lst._maxes = [block[-1] for block in lst._blocks]
+        lst._len = len(values)
+        lst._rebuild_tree()
+        return lst
+
+    def to_array(self) -> np.ndarray:
+        """全部元素（升序）"""
+        return np.array([value for block in self._blocks for value in block], dtype=float)
+
+    def _rebuild_tree(self):
+        """块的数量变化（分裂、删除）后重建树状数组，O(块数)"""
+        tree = [len(block) for block in self._blocks]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, k: int, delta: int):
+        """第 k 个块的长度变化 delta"""
+        tree = self._tree
+        while k < len(tree):
+            tree[k] += delta
+            k |= k + 1
+
+    def _prefix_count(self, k: int) -> int:
+        """前 k 个块的元素总数"""
+        tree = self._tree
+        total = 0
+        k -= 1
+        while k >= 0:
+            total += tree[k]
+            k = (k & (k + 1)) - 1
+        return total
+
+    def add(self, value):
+        """插入一个值"""
+        if not self._blocks:
+            self._blocks.append([value])
+            self._maxes.append(value)
+            self._tree = [1]
+        else:
+            k = bisect_left(self._maxes, value)
+            if k == len(self._maxes):
+                k -= 1
+            block = self._blocks[k]
+            insort(block, value)
+            self._maxes[k] = block[-1]
+
+            # 块过大时一分为二
+            if len(block) > 2 * self._load:
+                half = block[self._load:]
+                del block[self._load:]
+                self._maxes[k] = block[-1]
+                self._blocks.insert(k + 1, half)
+                self._maxes.insert(k + 1, half[-1])
+                self._rebuild_tree()
+            else:
+                self._tree_add(k, 1)
+        self._len += 1
+
+    def remove(self, value):
+        """删除一个值（必须存在）"""
+        k = bisect_left(self._maxes, value)
+        if k == len(self._maxes):
+            raise ValueError(f"{value} not in list")
+        block = self._blocks[k]
+        i = bisect_left(block, value)
+        if i == len(block) or block[i] != value:
+            raise ValueError(f"{value} not in list")
+
+        del block[i]
+        if block:
+            self._maxes[k] = block[-1]
+            self._tree_add(k, -1)
+        else:
+            del self._blocks[k]
+            del self._maxes[k]
+            self._rebuild_tree()
+        self._len -= 1
+
+    def bisect_left(self, value) -> int:
+        """返回严格小于 value 的元素数量"""
+        k = bisect_left(self._maxes, value)
+        count = self._prefix_count(k)
+        if k < len(self._blocks):
+            count += bisect_left(self._blocks[k], value)
+        return count
+
+
+class ExpandingPercentileState:
+    """
+    扩展窗口百分位的增量状态
+    历史有效值保存在 SortedBlockList 中，追加少量新数据时每行一次 O(log n) 的排名查询和插入；
+    只保存有序值和最后一行的标量，已输出的百分位由调用方按行保存
+    """
+
+    def __init__(self, skipna: bool = True):
+        """
+        Args:
+            skipna: True 时NaN既不参与统计也不输出百分位（ValuationCalculator 口径）；
+                    False 时NaN仍计入样本总数，NaN行的百分位为0（PECalculator 口径）
+        """
+        self.skipna = skipna
+        self.values = SortedBlockList()
+        self.row_count = 0          # 已处理的总行数（含NaN）
+        self.last_date = None       # 最后处理的日期 (YYYY-MM-DD)
+        self.last_percentile = np.nan
+
+    def _count_less(self, values: np.ndarray) -> np.ndarray:
+        """逐个插入新值，返回插入前已有值中严格小于它的数量"""
+        existing = len(self.values)
+        if len(values) > _block_size(existing + len(values)):
+            # 大批量（如首次计算）按块向量化合并，再整体重建有序结构
+            counts, merged = _count_less_expanding(self.values.to_array(), values)
+            self.values = SortedBlockList.from_sorted(merged)
+            return counts
+
+        counts = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values.tolist()):
+            counts[i] = self.values.bisect_left(value)
+            self.values.add(value)
+        return counts
+
+    def extend(self, values) -> np.ndarray:
+        """
+        追加按时间顺序排列的新数据，返回这些行的百分位
+
+        Args:
+            values: 新增行的数值序列
+
+        Returns:
+            与 values 等长的百分位数组，无法计算的位置为NaN
+        """
+        values = np.asarray(values, dtype=float)
+        result = np.full(len(values), np.nan)
+        if len(values) == 0:
+            return result
+
+        valid = ~np.isnan(values)
+        counts = self._count_less(values[valid])
+        valid_before = len(self.values) - len(counts)
+
+        if self.skipna:
+            # 样本总数 = 截至当前行的有效值数量
+            totals = np.arange(valid_before + 1, valid_before + len(counts) + 1)
+            positions = np.flatnonzero(valid)
+        else:
+            # 样本总数 = 截至当前行的全部行数（含NaN）
+            counts_all = np.zeros(len(values), dtype=np.int64)
+            counts_all[valid] = counts
+            counts = counts_all
+            totals = np.arange(self.row_count + 1, self.row_count + len(values) + 1)
+            positions = np.arange(len(values))
+
+        enough = totals > 1
+        result[positions[enough]] = counts[enough] / (totals[enough] - 1) * 100
+
+        self.row_count += len(values)
+        self.last_percentile = result[-1]
+        return result
+
+    def to_bytes(self) -> bytes:
+        """序列化为npz格式，用于持久化"""
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 sorted_values=self.values.to_array(),
+                 meta=np.array([self.row_count, self.last_percentile, float(self.skipna), STATE_FORMAT]),
+                 last_date=np.array(self.last_date or ''))
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, payload: bytes) -> 'ExpandingPercentileState':
+        """从 to_bytes 的结果恢复，旧格式返回None"""
+        with np.load(io.BytesIO(payload), allow_pickle=False) as data:
+            meta = data['meta']
+            if len(meta) < 4 or int(meta[3]) != STATE_FORMAT:
+                return None
+            row_count, last_percentile, skipna, _ = meta
+            state = cls(skipna=bool(skipna))
+            state.values = SortedBlockList.from_sorted(data['sorted_values'])
+            state.row_count = int(row_count)
+            state.last_percentile = float(last_percentile)
+            state.last_date = str(data['last_date']) or None
+        return state
+
+
+def rolling_percentile(dates, values, window_days: int, checkpoint=None) -> np.ndarray:
+    """
+    计算滚动窗口百分位：每个点相对于"当前日期往前 window_days 天内"数据的百分位
+
+    Args:
+        dates: 按升序排列的日期序列
+        values: 对应的数值序列，NaN（含需要排除的停牌日）不参与统计
+        window_days: 窗口天数，窗口包含 [当前日期 - window_days, 当前日期]
+        checkpoint: 每处理 CHECKPOINT_ROWS 行调用一次的无参函数，抛出异常即中止计算（用于取消）
+
+    Returns:
+        与 values 等长的百分位数组
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=float)
+    result = np.full(len(values), np.nan)
+
+    # 每行窗口左边界在数组中的位置
+    cutoffs = dates - np.timedelta64(window_days, 'D')
+    lefts = np.searchsorted(dates, cutoffs, side='left')
+
+    # 转为Python float列表，避免逐元素访问numpy标量的开销
+    value_list = values.tolist()
+    valid = (~np.isnan(values)).tolist()
+    lefts = lefts.tolist()
+
+    window = SortedBlockList()
+    left = 0
+    for i, current in enumerate(value_list):
+        if checkpoint is not None and i % CHECKPOINT_ROWS == 0:
+            checkpoint()
+
+        # 移出已离开窗口的值
+        while left < lefts[i]:
+            if valid[left]:
+                window.remove(value_list[left])
+            left += 1
+
+        if not valid[i]:
+            continue
+
+        window.add(current)
+        total = len(window)
+        if total > 1:
+            result[i] = window.bisect_left(current) / (total - 1) * 100
+
+    return result
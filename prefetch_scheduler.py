@@ -0,0 +1,142 @@
+"""
+自选股后台预取
+应用启动时以及每天收盘数据入库后，在后台增量刷新 stock_memory 中的全部股票，
+之后在界面中打开这些股票只需读取本地数据
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import DATA_READY_TIME, PREFETCH_WORKERS, PREFETCH_RETRY_BASE_SECONDS, PREFETCH_RETRY_MAX_SECONDS
+from data_fetcher import DataFetcher
+from database import StockDatabase, open_database
+
+
+class PrefetchScheduler:
+    """
+    自选股预取调度器
+    每只股票的刷新结果记录在 prefetch_status 表中：成功时间、连续失败次数和下次重试时间，
+    失败后按指数退避重试
+    """
+
+    def __init__(self, db: StockDatabase = None, max_workers: int = PREFETCH_WORKERS,
+                 use_processes: bool = True, progress_callback=None, provider=None):
+        """
+        Args:
+            db: 数据库
+            max_workers: 同时下载的股票数上限
+            use_processes: 是否在进程池中下载；调度线程运行在界面进程中，baostock会话是进程全局的，
+                           只有在工作进程中访问行情接口才不会与界面的任务线程互相影响（线程池仅用于测试）
+            progress_callback: 进度回调 (message, percent)，在后台线程中调用
+            provider: 行情数据源，默认按配置创建
+        """
+        self.db = db or open_database()
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        # 只用于写库和汇总进度，证券主表、交易日历和日线都在 fetch_many 的工作进程中获取，本线程不登录
+        self.fetcher = DataFetcher(progress_callback=progress_callback, db=self.db, provider=provider)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def due_codes(self, now: float = None) -> list:
+        """需要刷新的自选股（从未失败或已到重试时间）"""
+        now = now if now is not None else time.time()
+        rows = self.db.get_connection().execute('''
+            SELECT m.code FROM stock_memory m
+            LEFT JOIN prefetch_status s ON s.code = m.code
+            WHERE s.next_retry IS NULL OR s.next_retry <= ?
+            ORDER BY m.last_updated DESC
+        ''', (now,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_status(self, code: str):
+        """
+        Returns:
+            (last_success, last_attempt, failures, next_retry, last_error)，没有记录时返回None
+        """
+        return self.db.get_connection().execute('''
+            SELECT last_success, last_attempt, failures, next_retry, last_error
+            FROM prefetch_status WHERE code = ?
+        ''', (code,)).fetchone()
+
+    def _record(self, results: list, now: float):
+        """写入每只股票的刷新结果，失败的按连续失败次数计算下次重试时间"""
+        with self.db.get_connection() as conn:
+            for code, _, _, _, error in results:
+                if error is None:
+                    conn.execute('''
+                        INSERT INTO prefetch_status (code, last_success, last_attempt, failures, next_retry, last_error)
+                        VALUES (?, ?, ?, 0, NULL, NULL)
+                        ON CONFLICT(code) DO UPDATE SET
+                            last_success = excluded.last_success, last_attempt = excluded.last_attempt,
+                            failures = 0, next_retry = NULL, last_error = NULL
+                    ''', (code, now, now))
+                    continue
+
+                row = conn.execute('SELECT failures FROM prefetch_status WHERE code = ?', (code,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                delay = min(PREFETCH_RETRY_BASE_SECONDS * 2 ** (failures - 1), PREFETCH_RETRY_MAX_SECONDS)
+                conn.execute('''
+                    INSERT INTO prefetch_status (code, last_success, last_attempt, failures, next_retry, last_error)
+                    VALUES (?, NULL, ?, ?, ?, ?)
+                    ON CONFLICT(code) DO UPDATE SET
+                        last_attempt = excluded.last_attempt, failures = excluded.failures,
+                        next_retry = excluded.next_retry, last_error = excluded.last_error
+                ''', (code, now, failures, now + delay, error))
+
+    def run_once(self, now: float = None) -> list:
+        """
+        刷新一轮到期的自选股
+
+        Returns:
+            DataFetcher.fetch_many 的结果
+        """
+        now = now if now is not None else time.time()
+        codes = self.due_codes(now)
+        if not codes:
+            return []
+
+        # 预取的就是自选股本身，不更新"最近使用"的顺序
+        results = self.fetcher.fetch_many(codes, max_workers=self.max_workers, use_processes=self.use_processes,
+                                          remember=False)
+        self._record(results, now)
+        return results
+
+    def seconds_until_next_run(self, now: datetime = None) -> float:
+        """距离下一次运行的秒数：下一个收盘数据入库时间，或更早的失败重试时间"""
+        now = now or datetime.now()
+        hour, minute = map(int, DATA_READY_TIME.split(':'))
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        wait = (next_run - now).total_seconds()
+
+        row = self.db.get_connection().execute(
+            'SELECT MIN(next_retry) FROM prefetch_status WHERE next_retry IS NOT NULL').fetchone()
+        if row and row[0] is not None:
+            wait = min(wait, max(row[0] - now.timestamp(), 0))
+        return wait
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"后台预取失败: {e}")
+            if self._stop_event.wait(max(self.seconds_until_next_run(), 1)):
+                break
+        self.fetcher.logout()
+
+    def start(self):
+        """启动后台线程：立即运行一轮，之后在每天数据入库后和重试到期时运行"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name='prefetch-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """请求停止（当前这一轮结束后退出）"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
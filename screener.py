@@ -0,0 +1,247 @@
+"""
+全市场估值百分位筛选
+对本地缓存的全部股票批量计算当前估值百分位，按低估程度排序
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from columnar_store import ColumnarStockStore, load_stock_columns
+from config import TIME_RANGES, VALUATION_TYPES
+from database import StockDatabase, open_database
+
+
+# 用递归CTE模拟索引跳跃扫描：每只股票只做两次索引查找即可得到代码和最新日期
+LATEST_DATES_QUERY = '''
+    WITH RECURSIVE codes(code) AS (
+        SELECT MIN(code) FROM stock_history
+        UNION ALL
+        SELECT (SELECT MIN(code) FROM stock_history WHERE code > codes.code)
+        FROM codes WHERE codes.code IS NOT NULL
+    )
+    SELECT code, (SELECT MAX(date) FROM stock_history h WHERE h.code = codes.code)
+    FROM codes WHERE code IS NOT NULL
+'''
+
+
+def _build_stock_query() -> str:
+    """
+    构造单只股票的统计SQL
+    以最新一行作为当前值，在窗口内统计比它小的数量和有效值数量，四种估值类型在同一次索引范围扫描中完成
+    """
+    current_columns = ', '.join(f"l.{config['column']}" for config in VALUATION_TYPES.values())
+    aggregates = ', '.join(
+        f"SUM(h.{config['column']} < l.{config['column']}), COUNT(h.{config['column']})"
+        for config in VALUATION_TYPES.values()
+    )
+    return f'''
+        SELECT COUNT(*), {current_columns}, {aggregates}
+        FROM stock_history l
+        JOIN stock_history h ON h.code = l.code AND h.date >= ?
+        WHERE l.code = ? AND l.date = ?
+    '''
+
+
+def _scan_stocks(db_path: str, stocks: list, window_days: int = None) -> list:
+    """
+    统计一批股票（可在子进程中运行）
+
+    Args:
+        db_path: 数据库路径
+        stocks: [(code, 最新日期), ...]
+        window_days: 窗口天数，None表示全部历史
+
+    Returns:
+        [(code, 最新日期, 交易日数, 各估值当前值..., 各估值(小于数, 有效数)...), ...]
+    """
+    query = _build_stock_query()
+    conn = StockDatabase(db_path).get_connection()
+    rows = []
+    for code, last_date in stocks:
+        if window_days:
+            cutoff = (datetime.strptime(last_date, '%Y-%m-%d') - timedelta(days=window_days)).strftime('%Y-%m-%d')
+        else:
+            cutoff = ''
+        rows.append((code, last_date) + tuple(conn.execute(query, (cutoff, code, last_date)).fetchone()))
+    return rows
+
+
+def _scan_columnar(data_dir: str, stocks: list, window_days: int = None) -> list:
+    """
+    统计一批股票（列式存储），返回格式与 _scan_stocks 相同
+    列数组按日期有序，窗口起点用二分查找定位
+    """
+    columns = [config['column'] for config in VALUATION_TYPES.values()]
+    rows = []
+    for code, last_date in stocks:
+        arrays = load_stock_columns(data_dir, code, columns, mmap_mode='r')
+        dates = arrays['date']
+        start = 0
+        if window_days:
+            start = int(np.searchsorted(dates, np.datetime64(last_date, 'D') - np.timedelta64(window_days, 'D')))
+
+        currents, counts = [], []
+        for column in columns:
+            values = arrays[column][start:] if column in arrays else np.full(len(dates) - start, np.nan)
+            current = values[-1] if len(values) else np.nan
+            currents.append(current)
+            counts.extend([int((values < current).sum()), int((~np.isnan(values)).sum())])
+        rows.append((code, last_date, len(dates) - start, *currents, *counts))
+    return rows
+
+
+class ValuationScreener:
+    """估值筛选器 - 批量计算所有已缓存股票的当前百分位"""
+
+    def __init__(self, db: StockDatabase = None, workers: int = 1):
+        """
+        Args:
+            db: 数据库，默认使用全局数据库
+            workers: 并行进程数，大于1时按股票分片到进程池并行统计
+        """
+        self.db = db or open_database()
+        self.workers = workers
+        # 当前百分位结果缓存，键为窗口
+        self._cache = {}
+
+    def _latest_dates(self) -> list:
+        """[(股票代码, 最新日期), ...]"""
+        if isinstance(self.db, ColumnarStockStore):
+            return [(code, self.db.get_last_update_date(code)) for code in self.db.list_codes()]
+        return self.db.get_connection().execute(LATEST_DATES_QUERY).fetchall()
+
+    def _scan(self, stocks: list, window_days: int = None) -> list:
+        """按配置的并行度统计全部股票"""
+        if isinstance(self.db, ColumnarStockStore):
+            scan, source = _scan_columnar, self.db.data_dir
+        else:
+            scan, source = _scan_stocks, self.db.db_path
+
+        if self.workers <= 1 or len(stocks) < self.workers * 2:
+            return scan(source, stocks, window_days)
+
+        chunk_size = -(-len(stocks) // self.workers)
+        chunks = [stocks[i:i + chunk_size] for i in range(0, len(stocks), chunk_size)]
+        rows = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(scan, source, chunk, window_days) for chunk in chunks]
+            for future in futures:
+                rows.extend(future.result())
+        return rows
+
+    def calculate_current_percentiles(self, window: str = '5年') -> pd.DataFrame:
+        """
+        计算全部股票在窗口内的当前估值百分位
+
+        Args:
+            window: 窗口，取值为 TIME_RANGES 的键，窗口以每只股票自己的最新日期为终点
+
+        Returns:
+            每只股票一行，包含 code、name、date、days 以及各估值类型的当前值和百分位
+        """
+        if window not in TIME_RANGES:
+            raise ValueError(f"不支持的时间窗口: {window}")
+
+        if window in self._cache:
+            return self._cache[window]
+
+        stocks = self._latest_dates()
+        names = dict(self.db.get_connection().execute('SELECT code, name FROM stock_memory').fetchall())
+
+        years = TIME_RANGES[window]
+        outputs = [config['output'] for config in VALUATION_TYPES.values()]
+        columns = (['code', 'date', 'days'] + [f'cur_{output}' for output in outputs] +
+                   [f'{kind}_{output}' for output in outputs for kind in ('less', 'total')])
+        raw = pd.DataFrame(self._scan(stocks, years * 365 if years else None), columns=columns)
+
+        result = raw[['code', 'date', 'days']].copy()
+        result.insert(1, 'name', result['code'].map(names))
+        for output in outputs:
+            current = raw[f'cur_{output}'].to_numpy(dtype=float)
+            less = raw[f'less_{output}'].to_numpy(dtype=float)
+            total = raw[f'total_{output}'].to_numpy(dtype=float)
+
+            # 百分位 = 比当前值小的数量 / (有效值数量 - 1) * 100，与 ValuationCalculator 一致
+            usable = ~np.isnan(current) & (total > 1)
+            percentile = np.full(len(raw), np.nan)
+            percentile[usable] = less[usable] / (total[usable] - 1) * 100
+
+            result[output] = current
+            result[f'{output}_percentile'] = percentile
+
+        self._cache[window] = result
+        return result
+
+    def screen(self, valuation_type: str = 'PE', window: str = '5年', max_percentile: float = None,
+               min_days: int = 250, positive_only: bool = True) -> pd.DataFrame:
+        """
+        按估值百分位筛选并排序，最低估的排在最前
+
+        Args:
+            valuation_type: 估值类型，VALUATION_TYPES 的键
+            window: 统计窗口，TIME_RANGES 的键
+            max_percentile: 百分位上限，None 表示不过滤；可传入 VALUATION_TYPES 中的 low_threshold 只看低估股票
+            min_days: 窗口内最少交易日数，数据太短的股票百分位没有参考意义
+            positive_only: 是否排除当前估值为负（亏损）的股票
+
+        Returns:
+            排序后的DataFrame，包含 code、name、date、value、percentile、level、days
+        """
+        valuation_type = valuation_type.upper()
+        if valuation_type not in VALUATION_TYPES:
+            raise ValueError(f"不支持的估值类型: {valuation_type}")
+
+        config = VALUATION_TYPES[valuation_type]
+        output = config['output']
+        current = self.calculate_current_percentiles(window)
+
+        table = pd.DataFrame({
+            'code': current['code'],
+            'name': current['name'],
+            'date': current['date'],
+            'value': current[output],
+            'percentile': current[f'{output}_percentile'],
+            'days': current['days'],
+        })
+
+        mask = table['percentile'].notna() & (table['days'] >= min_days)
+        if positive_only:
+            mask &= table['value'] > 0
+        if max_percentile is not None:
+            mask &= table['percentile'] <= max_percentile
+        table = table[mask].copy()
+
+        table['level'] = np.select(
+            [table['percentile'] < config['low_threshold'], table['percentile'] > config['high_threshold']],
+            ['低估', '高估'],
+            default='正常'
+        )
+
+        return table.sort_values(['percentile', 'code']).reset_index(drop=True)
+
+    def clear_cache(self):
+        """清除结果缓存（数据更新后调用）"""
+        self._cache.clear()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='全市场估值百分位筛选')
+    parser.add_argument('--type', default='PE', choices=list(VALUATION_TYPES.keys()), help='估值类型')
+    parser.add_argument('--window', default='5年', choices=list(TIME_RANGES.keys()), help='统计窗口')
+    parser.add_argument('--undervalued', action='store_true', help='只显示低于低估阈值的股票')
+    parser.add_argument('--top', type=int, default=50, help='显示前N只')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行进程数')
+    args = parser.parse_args()
+
+    max_percentile = VALUATION_TYPES[args.type]['low_threshold'] if args.undervalued else None
+    table = ValuationScreener(workers=args.workers).screen(args.type, args.window, max_percentile=max_percentile)
+    print(table.head(args.top).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
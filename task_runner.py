@@ -0,0 +1,128 @@
+"""
+界面后台任务
+耗时的下载和计算在工作线程中执行，结果和进度放入队列，由界面线程通过 root.after 定期调用 poll() 取回，
+Tk 控件只在界面线程中访问
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskCancelled(Exception):
+    """任务已取消（用户取消或被同类的新任务取代）"""
+
+
+class CancelToken:
+    """取消标记，工作线程在检查点调用 check()"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        """已取消时抛出 TaskCancelled"""
+        if self._event.is_set():
+            raise TaskCancelled()
+
+
+class TaskRunner:
+    """
+    后台任务执行器
+    每个任务属于一个 key，同一 key 提交新任务时旧任务被取消，旧任务的进度和结果不再交回界面
+    """
+
+    def __init__(self, max_workers: int = 1):
+        """
+        Args:
+            max_workers: 工作线程数（baostock会话是全局的，默认单线程依次执行）
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gui-task')
+        self._callbacks = queue.SimpleQueue()
+        self._current = {}  # key -> (序号, CancelToken)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, func, on_success=None, on_error=None, on_progress=None) -> CancelToken:
+        """
+        提交任务
+
+        Args:
+            key: 任务类别
+            func: 在工作线程中执行的 func(token, progress)；progress(message, percent) 报告进度，
+                  任务已取消时抛出 TaskCancelled，因此也是取消检查点
+            on_success: 界面线程中的成功回调 on_success(结果)
+            on_error: 界面线程中的失败回调 on_error(异常)
+            on_progress: 界面线程中的进度回调 on_progress(message, percent)
+
+        Returns:
+            该任务的取消标记
+        """
+        token = CancelToken()
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            previous = self._current.get(key)
+            self._current[key] = (generation, token)
+        if previous:
+            previous[1].cancel()
+
+        def is_current():
+            return not token.cancelled and self._current.get(key, (None,))[0] == generation
+
+        def deliver(callback, *args):
+            if callback is not None and is_current():
+                self._callbacks.put((is_current, callback, args))
+
+        def progress(message: str, percent: int = None):
+            token.check()
+            deliver(on_progress, message, percent)
+
+        def run():
+            try:
+                token.check()
+                result = func(token, progress)
+            except TaskCancelled:
+                return
+            except Exception as e:
+                deliver(on_error, e)
+            else:
+                deliver(on_success, result)
+
+        self._executor.submit(run)
+        return token
+
+    def cancel(self, key: str):
+        """取消该类别当前的任务"""
+        current = self._current.get(key)
+        if current:
+            current[1].cancel()
+
+    def poll(self) -> int:
+        """
+        在界面线程中执行已完成任务的回调，过期任务的回调被丢弃
+
+        Returns:
+            执行的回调数
+        """
+        count = 0
+        while True:
+            try:
+                is_current, callback, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                return count
+            # 结果入队后用户可能又提交了新任务，交回前再检查一次
+            if is_current():
+                callback(*args)
+                count += 1
+
+    def shutdown(self):
+        """取消全部任务，不等待工作线程结束"""
+        for _, token in list(self._current.values()):
+            token.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
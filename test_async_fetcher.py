@@ -0,0 +1,88 @@
+"""
+测试 asyncio 数据获取接口
+"""
+import asyncio
+import os
+import threading
+import time
+
+from async_fetcher import AsyncDataFetcher
+from database import StockDatabase
+from test_prefetch_scheduler import FlakyBaostock
+
+
+class SlowBaostock(FlakyBaostock):
+    """日线查询有延迟，记录同时进行的查询数"""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self._active_lock = threading.Lock()
+
+    def query_history_k_data_plus(self, *args, **kwargs):
+        with self._active_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self._active_lock:
+            self.active -= 1
+        return super().query_history_k_data_plus(*args, **kwargs)
+
+
+def test_fetch_many_yields_as_completed(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = SlowBaostock(delay=0.05)
+
+    async def main():
+        async with AsyncDataFetcher(db, provider, max_concurrency=2, use_processes=False) as fetcher:
+            messages = []
+
+            async def watch():
+                async for message, percent in fetcher.progress():
+                    messages.append((message, percent))
+
+            watcher = asyncio.ensure_future(watch())
+            await asyncio.sleep(0)
+
+            # 事件循环在下载期间保持响应
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.ensure_future(tick())
+            results = {code: df async for code, df in fetcher.fetch_many(
+                ['600000', '000001', '600519', 'sh.600000'], '2024-01-01', '2024-03-29')}
+            ticker.cancel()
+        await watcher
+        return results, messages, ticks
+
+    results, messages, ticks = asyncio.run(main())
+    assert set(results) == {'sh.600000', 'sz.000001', 'sh.600519'}
+    assert all(len(df) == 65 for df in results.values())
+    assert provider.max_active <= 2
+    assert ticks >= 5
+    assert messages[0][0] == '开始批量获取 4 只股票...'
+    assert messages[-1][1] == 100
+
+
+def test_concurrent_requests_share_downloads(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = SlowBaostock(delay=0.05)
+    provider.failing.add('sz.000001')
+
+    async def main():
+        async with AsyncDataFetcher(db, provider, max_concurrency=4, use_processes=False) as fetcher:
+            return await asyncio.gather(*[fetcher.fetch_stock('600519', '2024-01-01', '2024-03-29')
+                                          for _ in range(3)],
+                                        fetcher.fetch_stock('000001', '2024-01-01', '2024-03-29'))
+
+    *same, failed = asyncio.run(main())
+    assert [query[0] for query in provider.history_queries].count('sh.600519') == 1
+    assert all(result[0] == 'sh.600519' and len(result[2]) == 65 for result in same)
+    assert failed[0] == '000001' and failed[2] is None and '网络中断' in failed[5]
@@ -0,0 +1,95 @@
+"""
+测试可断点续传的全市场回填
+"""
+import os
+
+import pandas as pd
+
+from backfill import BackfillJob, split_range
+from database import StockDatabase
+from test_prefetch_scheduler import FlakyBaostock
+
+
+def make_job(db, provider, **kwargs):
+    return BackfillJob('2021-06-01', '2023-12-31', job='test', db=db, provider=provider, workers=2,
+                       use_processes=False, progress_callback=lambda message, percent: None, **kwargs)
+
+
+def test_split_range_by_calendar_year():
+    assert split_range('2021-06-01', '2023-03-31') == [
+        ('2021-06-01', '2021-12-31'), ('2022-01-01', '2022-12-31'), ('2023-01-01', '2023-03-31')]
+    assert split_range('2021-06-01', '2024-12-31', years=2) == [
+        ('2021-06-01', '2022-12-31'), ('2023-01-01', '2024-12-31')]
+
+
+def test_backfill_resumes_without_repeating_units(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = FlakyBaostock()
+
+    # 证券主表中的3只A股，每只3个年度单元；指数不回填
+    assert make_job(db, provider).plan() == 9
+    make_job(db, provider).run(max_units=4)
+    assert len(provider.history_queries) == 4
+    assert make_job(db, provider).status()['done'][0] == 4
+
+    # 重新规划不会重置已完成的单元，继续运行只下载剩余的单元
+    resumed = make_job(db, provider)
+    assert resumed.plan() == 9
+    summary = resumed.run()
+    assert set(summary) == {'done'}
+    assert len(provider.history_queries) == 9
+    assert len(set(provider.history_queries)) == 9
+    assert db.get_stock_data('sh.600519')['date'].iloc[0] == '2021-06-01'
+    assert db.get_stock_data('sh.600519')['date'].iloc[-1] == '2023-12-29'
+    # 回填不修改自选股
+    assert db.get_stock_memory() == []
+
+
+def test_backfill_retries_and_gives_up(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = FlakyBaostock()
+    provider.failing.add('sz.000001')
+
+    job = make_job(db, provider, max_attempts=3, retry_base=0.01)
+    job.plan(['sz.000001', 'sh.600000'])
+    summary = job.run()
+
+    assert summary['done'][0] == 3
+    assert summary['failed'][0] == 3
+    # 每个失败单元尝试了 max_attempts 次
+    attempts, last_error = db.get_connection().execute(
+        "SELECT SUM(attempts), MAX(last_error) FROM backfill_units WHERE code = 'sz.000001'").fetchone()
+    assert attempts == 9 and '网络中断' in last_error
+
+
+def test_backfill_recovers_after_transient_failure(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = FlakyBaostock()
+    provider.failing.add('sz.000001')
+
+    job = make_job(db, provider, retry_base=0.01)
+    job.plan(['sz.000001'])
+    # 第一轮失败后网络恢复，等待重试时间到期后完成
+    job.run(max_units=3)
+    assert job.status() == {'pending': (3, 0)}
+    provider.failing.clear()
+    assert job.run()['done'][0] == 3
+
+
+def test_backfill_retries_truncated_download(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    provider = FlakyBaostock()
+    # 第一次下载在接收50行后会话中断，该单元不能标记为完成
+    provider.truncating['sz.000001'] = 50
+
+    job = make_job(db, provider, retry_base=0.01)
+    job.plan(['sz.000001'])
+    job.run(max_units=3)
+    status = job.status()
+    assert status['done'][0] == 2 and status['pending'][0] == 1
+    last_error = db.get_connection().execute(
+        "SELECT MAX(last_error) FROM backfill_units WHERE code = 'sz.000001'").fetchone()[0]
+    assert '接收数据中断' in last_error
+
+    assert job.run()['done'][0] == 3
+    assert len(db.get_stock_data('sz.000001')) == len(pd.bdate_range('2021-06-01', '2023-12-31'))
@@ -0,0 +1,56 @@
+"""
+测试无界面批量渲染
+"""
+import os
+import subprocess
+import sys
+
+from batch_render import ChartRenderer, render_charts
+from data_fetcher import DataFetcher
+from database import StockDatabase
+from test_data_fetcher import FakeBaostock
+
+
+def test_batch_render_does_not_import_tkinter():
+    # tkinter 被屏蔽时仍能导入并渲染
+    code = ("import sys; sys.modules['tkinter'] = None; "
+            "import batch_render; batch_render.ChartRenderer(); "
+            "assert 'matplotlib.backends.backend_tkagg' not in sys.modules")
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_render_watchlist(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=FakeBaostock())
+    for code in ['sh.600000', 'sh.600519']:
+        fetcher.fetch_stock_data(code, '2022-01-01', '2024-03-29')
+    db.save_stock_memory('sz.000001', '平安银行')  # 没有本地数据
+
+    output_dir = os.path.join(tmp_path, 'reports')
+    results = render_charts(output_dir=output_dir, start='2022-01-01', end='2024-03-29',
+                            valuation_types=['PE', 'PB'], formats=['png', 'svg'], workers=2,
+                            use_processes=False, db=db, progress=None)
+
+    by_code = {code: (written, error) for code, written, error in results}
+    assert by_code['sz.000001'] == ([], "本地没有数据")
+    assert sorted(os.listdir(output_dir)) == sorted(
+        f'{code}_{valuation_type}.{fmt}' for code in ['sh.600000', 'sh.600519']
+        for valuation_type in ['PE', 'PB'] for fmt in ['png', 'svg'])
+    with open(os.path.join(output_dir, 'sh.600000_PE.png'), 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+def test_renderer_reuses_figure(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    DataFetcher(db=db, provider=FakeBaostock()).fetch_stock_data('sh.600000', '2023-01-01', '2023-12-31')
+    df = db.get_stock_data('sh.600000')
+    df['pe'] = df['peTTM']
+    df['pe_percentile'] = 50.0
+
+    renderer = ChartRenderer()
+    fig, axes = renderer.fig, list(renderer.axes)
+    for i in range(3):
+        renderer.render(df, 'sh.600000', '浦发银行', 'PE', [os.path.join(tmp_path, f'{i}.png')])
+    assert renderer.fig is fig and renderer.axes == axes
+    # 每次渲染前清空子图，图元不会累积
+    assert len(axes[0].lines) == 1
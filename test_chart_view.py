@@ -0,0 +1,121 @@
+"""
+测试图表悬停十字线
+"""
+import matplotlib.dates as mdates
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from chart_layout import DecimatedLine, fill_verts, minmax_decimate
+from chart_view import HoverCrosshair, nearest_index
+
+
+def test_nearest_index():
+    dates = np.array([10.0, 11.0, 14.0, 15.0])
+    assert [nearest_index(dates, x) for x in [0, 10.4, 10.6, 12.4, 12.6, 14.9, 99]] == [0, 0, 1, 1, 2, 3, 3]
+
+
+def test_crosshair_blits_without_full_redraw():
+    fig = Figure(figsize=(8, 6), dpi=100)
+    axes = [fig.add_subplot(311), fig.add_subplot(312), fig.add_subplot(313)]
+    canvas = FigureCanvasAgg(fig)
+    dates = pd.date_range('2015-01-01', periods=2500)
+    for ax in axes:
+        ax.plot(dates, np.arange(len(dates)))
+    xlim = axes[0].get_xlim()
+
+    crosshair = HoverCrosshair(canvas, axes)
+    crosshair.create_artists(mdates.date2num(dates[0]))
+    # 十字线不改变坐标轴范围
+    assert axes[0].get_xlim() == xlim
+
+    draws = []
+    canvas.mpl_connect('draw_event', lambda event: draws.append(1))
+    canvas.draw()
+    assert crosshair.background is not None
+    clean = np.asarray(canvas.buffer_rgba()).copy()
+
+    x = mdates.date2num(dates[1000])
+    crosshair.show(x, [1000, 1000, 1000], '日期: 2017-09-27')
+    assert crosshair.visible and all(line.get_xdata()[0] == x for line in crosshair.lines)
+    assert not np.array_equal(np.asarray(canvas.buffer_rgba()), clean)
+
+    crosshair.hide()
+    np.testing.assert_array_equal(np.asarray(canvas.buffer_rgba()), clean)
+    # 显示和隐藏只恢复背景并重绘十字线，没有整图重绘
+    assert len(draws) == 1
+
+
+def test_minmax_decimate_keeps_envelope():
+    x = np.arange(100000, dtype=float)
+    y = np.sin(x / 50) + np.random.default_rng(0).normal(0, 0.1, len(x))
+    y[5000:5100] = np.nan
+    y[77777] = 10
+
+    indices = minmax_decimate(x, y, x[0], x[-1], buckets=1000)
+    assert len(indices) <= 2 * 1000 + 3
+    assert np.all(np.diff(indices) > 0)
+    # 极值和缺失段在抽稀后仍然可见
+    assert 77777 in indices
+    assert np.nanmax(y[indices]) == np.nanmax(y) and np.nanmin(y[indices]) == np.nanmin(y)
+    assert np.isnan(y[indices]).any()
+
+    # 放大到少量点时全部显示，并包含两侧各一个点
+    assert list(minmax_decimate(x, y, 200.5, 210, buckets=1000)) == list(range(200, 212))
+
+
+def test_decimated_line_follows_zoom():
+    fig = Figure(figsize=(8, 3), dpi=100)
+    ax = fig.add_subplot(111)
+    FigureCanvasAgg(fig)
+    dates = pd.date_range('1990-01-01', periods=12000)
+    values = np.random.default_rng(1).uniform(0, 100, len(dates))
+    line = DecimatedLine(ax, dates, values, fill_kwargs=dict(alpha=0.3))
+    assert len(line.line.get_xdata()) < len(dates) / 4
+
+    ax.set_xlim(mdates.date2num(dates[100]), mdates.date2num(dates[300]))
+    assert line.update()
+    assert len(line.line.get_xdata()) == 203
+    assert len(ax.collections) == 1
+    assert not line.update()
+
+
+def test_decimated_line_updates_fill_in_place():
+    fig = Figure(figsize=(8, 3), dpi=100)
+    ax = fig.add_subplot(111)
+    FigureCanvasAgg(fig)
+    dates = pd.date_range('2020-01-01', periods=12000)
+    values = np.random.default_rng(2).uniform(0, 100, len(dates))
+    line = DecimatedLine(ax, dates, values, fill_kwargs=dict(alpha=0.3))
+    fill = line.fill
+
+    ax.set_xlim(mdates.date2num(dates[100]), mdates.date2num(dates[300]))
+    assert line.update() and line.fill is fill and list(ax.collections) == [fill]
+
+    # 点数不需要抽稀时平移缩放不改变显示的点
+    small = DecimatedLine(ax, dates[:500], values[:500], fill_kwargs=dict(alpha=0.3))
+    for day in (10, 200, 400):
+        ax.set_xlim(mdates.date2num(dates[day]), mdates.date2num(dates[day + 50]))
+        assert not small.update()
+    assert len(small.line.get_xdata()) == 500
+
+    # 旧版matplotlib的顶点计算：NaN处断开为多个多边形
+    y = np.array([1.0, 2.0, np.nan, 3.0, 4.0, 5.0])
+    verts = fill_verts(np.arange(6.0), y)
+    assert len(verts) == 2
+    assert verts[1].tolist() == [[3, 0], [3, 3], [4, 4], [5, 5], [5, 0]]
+
+
+def test_decimated_line_set_series_keeps_artists():
+    fig = Figure(figsize=(8, 3), dpi=100)
+    ax = fig.add_subplot(111)
+    FigureCanvasAgg(fig)
+    dates = pd.date_range('2020-01-01', periods=100)
+    line = DecimatedLine(ax, dates, np.arange(100), fill_kwargs=dict(alpha=0.3))
+    artist = line.line
+
+    line.set_series(dates[50:], np.arange(50) * 2.0)
+    assert line.line is artist
+    assert list(line.line.get_ydata()) == list(np.arange(50) * 2.0)
+    assert len(ax.collections) == 1
@@ -0,0 +1,83 @@
+"""
+测试列式存储与SQLite存储读写结果一致
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from columnar_store import ColumnarStockStore, migrate_from_sqlite
+from database import StockDatabase
+from test_database import make_rows
+
+
+def test_columnar_matches_sqlite(tmp_path):
+    sqlite_db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    store = ColumnarStockStore(os.path.join(tmp_path, 'columns'), db_path=os.path.join(tmp_path, 'meta.db'))
+
+    first, second = make_rows('2024-01-01', 100), make_rows('2024-03-11', 80)
+    for df in [first, second]:
+        assert store.save_stock_data(df, 'sh.600000') == sqlite_db.save_stock_data(df, 'sh.600000')
+
+    expected = sqlite_db.get_stock_data('sh.600000', '2024-02-01', '2024-05-31')
+    result = store.get_stock_data('sh.600000', '2024-02-01', '2024-05-31')
+    # 列与SQLite后端相同，但保持列文件的类型：日期为datetime64，标志列为int8，按数值使用时结果一致
+    assert list(result.columns) == [col for col in expected.columns if col != 'id']
+    assert result['date'].dtype.kind == 'M' and result['date'].iloc[0] == pd.Timestamp('2024-02-01')
+    assert (result['date'] == pd.to_datetime(expected['date'])).all()
+    for col in ['open', 'close', 'volume', 'peTTM']:
+        np.testing.assert_array_equal(result[col].to_numpy(), expected[col].to_numpy(dtype=float))
+    for col in ['adjustflag', 'tradestatus', 'isST']:
+        assert result[col].dtype == np.int8
+        np.testing.assert_array_equal(result[col].to_numpy(), pd.to_numeric(expected[col]).to_numpy())
+    assert (result['tradestatus'] == 1).all()
+    assert (result['code'] == 'sh.600000').all()
+
+    assert store.get_last_update_date('sh.600000') == sqlite_db.get_last_update_date('sh.600000')
+    assert store.list_codes() == ['sh.600000']
+
+    store.delete_stock_data('sh.600000')
+    assert store.get_stock_data('sh.600000').empty
+    assert store.get_last_update_date('sh.600000') is None
+
+
+def test_migrate_from_sqlite(tmp_path):
+    db_path = os.path.join(tmp_path, 'stock.db')
+    sqlite_db = StockDatabase(db_path)
+    for i, code in enumerate(['sh.600000', 'sz.000001']):
+        sqlite_db.save_stock_data(make_rows('2023-01-02', 50 + i * 30), code)
+
+    data_dir = os.path.join(tmp_path, 'columns')
+    assert migrate_from_sqlite(db_path, data_dir, progress=None) == 2
+
+    store = ColumnarStockStore(data_dir, db_path=db_path)
+    for code in ['sh.600000', 'sz.000001']:
+        expected = sqlite_db.get_stock_data(code)
+        result = store.get_stock_data(code)
+        assert len(result) == len(expected)
+        np.testing.assert_array_equal(result['peTTM'].to_numpy(), expected['peTTM'].to_numpy(dtype=float))
+
+
+def test_write_switches_versions_atomically(tmp_path):
+    data_dir = os.path.join(tmp_path, 'columns')
+    store = ColumnarStockStore(data_dir, db_path=os.path.join(tmp_path, 'meta.db'))
+    stock_dir = os.path.join(data_dir, 'sh.600000')
+
+    # 旧的平铺格式仍可读取，第一次写入后转为版本目录
+    store._write_columns('sh.600000', store._to_columns(make_rows('2024-01-01', 30)))
+    os.replace(os.path.join(stock_dir, 'CURRENT'), os.path.join(tmp_path, 'CURRENT'))
+    for name in os.listdir(os.path.join(stock_dir, 'v1')):
+        os.replace(os.path.join(stock_dir, 'v1', name), os.path.join(stock_dir, name))
+    os.rmdir(os.path.join(stock_dir, 'v1'))
+    assert len(store.get_stock_data('sh.600000')) == 30
+
+    for i in range(3):
+        store.save_stock_data(make_rows('2024-03-01', 10 + i), 'sh.600000')
+        # 当前版本和上一个版本之外的目录、平铺文件都被清理
+        assert sorted(os.listdir(stock_dir)) == sorted(['CURRENT'] + [f'v{n}' for n in range(max(i, 1), i + 2)])
+    assert len(store.get_stock_data('sh.600000')) == 30 + 12
+
+    # 替换 CURRENT 之前中断（新版本目录写了一半）时读取的仍是当前版本
+    os.makedirs(os.path.join(stock_dir, 'v9'))
+    assert len(store.get_stock_data('sh.600000')) == 42
+    assert store.list_codes() == ['sh.600000']
@@ -0,0 +1,101 @@
+"""
+测试多股估值百分位对比
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from chart_layout import ComparisonOverlay
+from comparison import PercentileComparison, align_series
+from data_fetcher import DataFetcher
+from database import StockDatabase
+from test_data_fetcher import FakeBaostock
+
+
+def make_frame(dates, pe_percentile):
+    return pd.DataFrame({'date': pd.to_datetime(dates), 'pe_percentile': pe_percentile,
+                         'pb_percentile': np.full(len(dates), 50.0)})
+
+
+def test_incremental_alignment_matches_rebuild(tmp_path):
+    comparison = PercentileComparison('2024-01-01', '2024-01-31', db=StockDatabase(os.path.join(tmp_path, 'stock.db')))
+    a = make_frame(['2024-01-02', '2024-01-03', '2024-01-04'], [10.0, 20.0, 30.0])
+    # b 在 01-03 停牌，多一个 01-05
+    b = make_frame(['2024-01-02', '2024-01-04', '2024-01-05'], [90.0, np.nan, 70.0])
+    c = make_frame(['2024-01-08'], [50.0])
+
+    comparison.add('sh.600000', '浦发银行', a)
+    before = comparison.series('PE')
+    comparison.aligned('PE')
+    comparison.add('sh.600519', '贵州茅台', b)
+    comparison.add('sz.000001', '平安银行', c)
+
+    aligned = comparison.aligned('PE')
+    assert list(aligned.columns) == ['sh.600000', 'sh.600519', 'sz.000001']
+    assert [d.strftime('%m-%d') for d in aligned.index] == ['01-02', '01-03', '01-04', '01-05', '01-08']
+    assert np.isnan(aligned.loc['2024-01-03', 'sh.600519']) and aligned.loc['2024-01-05', 'sh.600519'] == 70
+    pd.testing.assert_frame_equal(aligned, align_series(comparison.series('PE')), check_freq=False)
+    # 已有股票的序列对象不变
+    assert comparison.series('PE')['sh.600000'] is before['sh.600000']
+
+    # 移除时只在已加入的代码中匹配，裸代码按后缀匹配
+    assert comparison.match('000001') == 'sz.000001' and comparison.match(' SH.600519') == 'sh.600519'
+    assert comparison.match('600036') is None
+
+    comparison.remove('sz.000001')
+    aligned = comparison.aligned('PE')
+    assert list(aligned.columns) == ['sh.600000', 'sh.600519']
+    assert aligned.index[-1] == pd.Timestamp('2024-01-05')
+    pd.testing.assert_frame_equal(aligned, align_series(comparison.series('PE')), check_freq=False)
+
+    assert comparison.set_range('2023-01-01', '2024-01-31')
+    assert comparison.unloaded == ['sh.600000', 'sh.600519'] and comparison.aligned('PE').empty
+
+
+def test_load_uses_percentile_cache(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=FakeBaostock())
+    for code in ['sh.600000', 'sh.600519']:
+        fetcher.fetch_stock_data(code, '2023-01-01', '2023-12-31')
+
+    comparison = PercentileComparison('2023-01-01', '2023-12-31', db=db)
+    for code in ['sh.600000', 'sh.600519']:
+        comparison.add(code, None, comparison.load(code))
+    cached = db.get_connection().execute(
+        "SELECT COUNT(*) FROM percentile_cache WHERE metric = 'ALL' AND window_key = 'range:2023-01-01~2023-12-31'"
+    ).fetchone()[0]
+    assert cached == 2
+
+    aligned = comparison.aligned('PB')
+    assert aligned.shape[1] == 2 and aligned.notna().all().all()
+    # 第二次读取命中缓存，结果相同
+    np.testing.assert_allclose(comparison.load('sh.600000')['pb_percentile'], aligned['sh.600000'])
+
+
+def test_overlay_redraws_only_changed_series():
+    fig = Figure(figsize=(8, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    FigureCanvasAgg(fig)
+    dates = pd.bdate_range('2020-01-01', periods=500)
+    series = {
+        'sh.600000': pd.Series(np.linspace(0, 100, 500), index=dates),
+        'sh.600519': pd.Series(np.linspace(100, 0, 250), index=dates[::2]),
+    }
+    names = {'sh.600000': '浦发银行', 'sh.600519': '贵州茅台'}
+    overlay = ComparisonOverlay(ax, 'PE')
+    assert overlay.sync(series, names) == {'sh.600000', 'sh.600519'}
+    first = overlay.lines['sh.600000'].line
+
+    assert overlay.sync(dict(series), names) == set()
+    series['sz.000001'] = pd.Series(np.full(100, 40.0), index=dates[-100:])
+    assert overlay.sync(series, names) == {'sz.000001'}
+    del series['sh.600519']
+    assert overlay.sync(series, names) == {'sh.600519'}
+
+    assert overlay.lines['sh.600000'].line is first
+    assert [text.get_text() for text in ax.get_legend().get_texts()] == ['sh.600000 (浦发银行)', 'sz.000001']
+    # 2条阈值线 + 2条曲线
+    assert len(ax.lines) == 4
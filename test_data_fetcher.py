@@ -0,0 +1,214 @@
+"""
+使用模拟的baostock模块测试批量下载
+"""
+import multiprocessing
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+from data_fetcher import DataFetcher
+from database import StockDatabase
+
+
+class FakeResultSet:
+    def __init__(self, rows, fields=None, error_code='0', error_msg='', fail_after=None):
+        """fail_after: 返回这么多行后模拟分页获取失败（网络错误），next() 返回False"""
+        self._rows = rows
+        self._index = -1
+        self.fields = fields or []
+        self.error_code = error_code
+        self.error_msg = error_msg
+        self.fail_after = fail_after
+
+    def next(self):
+        self._index += 1
+        if self.fail_after is not None and self._index >= self.fail_after:
+            self.error_code, self.error_msg = '10002007', '网络接收错误'
+            return False
+        return self._index < len(self._rows)
+
+    def get_row_data(self):
+        return self._rows[self._index]
+
+
+class FakeBaostock:
+    """模拟baostock：已知股票返回工作日日线，记录下载请求"""
+    STOCKS = {'sh.600000': ('浦发银行', '1'), 'sz.000001': ('平安银行', '1'), 'sh.600519': ('贵州茅台', '1'),
+              'sh.000001': ('上证综合指数', '2')}
+
+    # 2024年春节休市
+    HOLIDAYS = set(pd.date_range('2024-02-09', '2024-02-17').strftime('%Y-%m-%d'))
+
+    def __init__(self):
+        self.history_queries = []
+        self.basic_queries = []
+        self.logins = 0
+        self._lock = threading.Lock()
+
+    def login(self):
+        with self._lock:
+            self.logins += 1
+        return FakeResultSet([])
+
+    def query_trade_dates(self, start_date=None, end_date=None):
+        dates = pd.date_range(start_date, end_date)
+        return FakeResultSet([[date.strftime('%Y-%m-%d'),
+                               '1' if date.weekday() < 5 and date.strftime('%Y-%m-%d') not in self.HOLIDAYS else '0']
+                              for date in dates], ['calendar_date', 'is_trading_day'])
+
+    def logout(self):
+        pass
+
+    def query_stock_basic(self, code=None):
+        with self._lock:
+            self.basic_queries.append(code)
+        rows = [[stock, name, '1990-12-19', '', sec_type, '1'] for stock, (name, sec_type) in self.STOCKS.items()
+                if not code or stock == code]
+        return FakeResultSet(rows)
+
+    def query_history_k_data_plus(self, code, fields, start_date, end_date, frequency='d', adjustflag='3'):
+        with self._lock:
+            self.history_queries.append((code, start_date, end_date))
+        fields = fields.split(',')
+        rows = []
+        for i, date in enumerate(pd.bdate_range(start_date, end_date).strftime('%Y-%m-%d')):
+            values = {'date': date, 'code': code, 'adjustflag': '3', 'tradestatus': '1', 'isST': '0'}
+            rows.append([values.get(field, str(10 + i % 7)) for field in fields])
+        return FakeResultSet(rows, fields)
+
+
+@pytest.fixture
+def fake_bs():
+    return FakeBaostock()
+
+
+def test_fetch_many_saves_and_reports(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    progress = []
+    fetcher = DataFetcher(progress_callback=lambda message, percent: progress.append(percent), db=db, provider=fake_bs)
+
+    results = fetcher.fetch_many(['600000', 'sz.000001', '600519'], '2024-01-01', '2024-01-31',
+                                 max_workers=3, use_processes=False)
+
+    assert sorted(code for code, *_ in results) == ['sh.600000', 'sh.600519', 'sz.000001']
+    assert all(error is None and inserted == 23 for _, _, inserted, _, error in results)
+    assert len(db.get_stock_data('sh.600519')) == 23
+    assert dict(db.get_stock_memory())['sz.000001'] == '平安银行'
+    assert progress[-1] == 100
+
+    # 本地数据已覆盖请求区间时不再下载，追加区间只下载缺少的部分
+    fake_bs.history_queries.clear()
+    fetcher.fetch_many(['sh.600000'], '2024-01-01', '2024-01-31', use_processes=False)
+    assert fake_bs.history_queries == []
+    results = fetcher.fetch_many(['sh.600000'], '2024-01-01', '2024-02-09', use_processes=False)
+    assert fake_bs.history_queries == [('sh.600000', '2024-02-01', '2024-02-09')]
+    assert results[0][2:4] == (7, 0)
+
+
+def test_concurrent_thread_pools_keep_separate_fetchers(tmp_path):
+    # 两个线程池同时下载，各工作线程使用自己所属线程池的数据源和数据库，互不覆盖
+    providers = [FakeBaostock(), FakeBaostock()]
+    fetchers = [DataFetcher(db=StockDatabase(os.path.join(tmp_path, f'stock{i}.db')), provider=provider)
+                for i, provider in enumerate(providers)]
+    codes = [['sh.600000', 'sz.000001', 'sh.600519', 'sh.600036'], ['sz.000002', 'sh.601318', 'sh.600030']]
+    start = threading.Barrier(2)
+
+    def run(fetcher, stock_codes):
+        start.wait()
+        for _ in range(5):
+            fetcher.fetch_many(stock_codes, '2024-01-01', '2024-01-31', max_workers=3, use_processes=False,
+                               force_update=True)
+
+    threads = [threading.Thread(target=run, args=args) for args in zip(fetchers, codes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for provider, stock_codes in zip(providers, codes):
+        assert {code for code, _, _ in provider.history_queries} == set(stock_codes)
+    for fetcher, stock_codes in zip(fetchers, codes):
+        assert all(len(fetcher.db.get_stock_data(code)) == 23 for code in stock_codes)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='子进程需要通过fork继承模拟数据源')
+def test_fetch_many_with_processes(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+
+    results = fetcher.fetch_many(['sh.600000', 'sz.000001'], '2024-01-01', '2024-01-31', max_workers=2)
+    assert {code for code, *_ in results} == {'sh.600000', 'sz.000001'}
+    assert len(db.get_stock_data('sz.000001')) == 23
+
+
+def test_security_master_avoids_metadata_queries(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+
+    # 首次使用时全量加载一次证券列表
+    assert fetcher.try_normalize_stock_code('600519') == 'sh.600519'
+    assert fake_bs.basic_queries == [None]
+    # 000001 同时是上证指数和平安银行，按规则优先深市股票
+    assert fetcher.try_normalize_stock_code('000001') == 'sz.000001'
+    assert fetcher.get_stock_name('000001') == '平安银行'
+    assert fetcher.get_stock_name('sh.000001') == '上证综合指数'
+
+    # 新的会话直接使用本地证券主表，一次获取不产生任何元数据查询
+    fake_bs.basic_queries.clear()
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+    df, name = fetcher.fetch_stock_data('600000', '2024-01-01', '2024-01-31')
+    assert (len(df), name) == (23, '浦发银行')
+    assert fake_bs.basic_queries == []
+
+    # 证券主表中没有的代码才单独向服务器核实
+    assert fetcher.try_normalize_stock_code('688999') == 'sh.688999'
+    assert fake_bs.basic_queries == ['sh.688999', 'sz.688999']
+
+    # 确认不存在的代码在本次会话中不再查询：取名称、重试获取都不联网
+    assert fetcher.get_stock_name('688999') == '688999'
+    for _ in range(2):
+        fetcher.fetch_stock_data('688999', '2024-01-01', '2024-01-31', force_update=True)
+    assert fake_bs.basic_queries == ['sh.688999', 'sz.688999']
+
+
+def test_fetch_streams_chunks_and_returns_requested_range(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+    fetcher.chunk_rows = 40
+
+    saved_chunks = []
+    save = db.save_stock_data
+    db.save_stock_data = lambda df, code: saved_chunks.append(len(df)) or save(df, code)
+
+    df, _ = fetcher.fetch_stock_data('sh.600000', '2024-01-01', '2024-06-28')
+    assert saved_chunks == [40, 40, 40, 10]
+    assert len(df) == 130
+    assert df['close'].dtype == float
+
+    # 增量下载后仍只返回请求的区间，而不是全部历史
+    saved_chunks.clear()
+    df, _ = fetcher.fetch_stock_data('sh.600000', '2024-06-01', '2024-07-31')
+    assert saved_chunks == [23]
+    assert (df['date'].min(), df['date'].max()) == ('2024-06-03', '2024-07-31')
+
+
+def test_trade_calendar_skips_network_when_no_new_bar(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+    fetcher.fetch_stock_data('sh.600000', '2024-01-01', '2024-02-08')
+    assert fetcher.is_trading_day('2024-02-08') and not fetcher.is_trading_day('2024-02-12')
+    assert fetcher.latest_available_date('2024-02-18') == '2024-02-08'
+
+    # 新会话：日历和证券主表都在本地，节假日期间请求不登录、不下载
+    fake_bs.logins = 0
+    fake_bs.history_queries.clear()
+    fetcher = DataFetcher(db=db, provider=fake_bs)
+    df, _ = fetcher.fetch_stock_data('sh.600000', '2024-01-01', '2024-02-18')
+    assert fake_bs.logins == 0 and fake_bs.history_queries == []
+    assert df['date'].max() == '2024-02-08'
+
+    # 节后有新交易日时才下载
+    fetcher.fetch_stock_data('sh.600000', '2024-01-01', '2024-02-19')
+    assert fake_bs.history_queries == [('sh.600000', '2024-02-09', '2024-02-19')]
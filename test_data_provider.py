@@ -0,0 +1,137 @@
+"""
+测试数据源录制与离线回放
+"""
+import os
+import time
+
+import pandas as pd
+
+from data_fetcher import DataFetcher
+from data_provider import RecordingProvider, ReplayProvider, ResilientProvider, TokenBucket
+from database import StockDatabase
+from test_data_fetcher import FakeBaostock, FakeResultSet
+from test_prefetch_scheduler import FlakyBaostock
+
+
+def test_record_then_replay(tmp_path):
+    record_dir = os.path.join(tmp_path, 'replay')
+    live = FakeBaostock()
+    recorder = DataFetcher(db=StockDatabase(os.path.join(tmp_path, 'live.db')),
+                           provider=RecordingProvider(live, record_dir))
+    # 分两次下载，录制文件按日期合并
+    recorder.fetch_stock_data('sh.600000', '2024-01-01', '2024-02-29')
+    expected, _ = recorder.fetch_stock_data('sh.600000', '2024-01-01', '2024-03-29')
+    recorder.fetch_stock_data('sz.000001', '2024-01-01', '2024-03-29')
+    assert len(live.history_queries) == 3
+
+    replay = ReplayProvider(record_dir, latency=0.02)
+    fetcher = DataFetcher(db=StockDatabase(os.path.join(tmp_path, 'replay.db')), provider=replay)
+    start = time.perf_counter()
+    df, name = fetcher.fetch_stock_data('600000', '2024-01-01', '2024-03-29')
+    # 证券列表、日线两次查询，每次都有模拟延迟
+    assert time.perf_counter() - start >= 0.04
+
+    assert name == '浦发银行'
+    assert df['date'].tolist() == expected['date'].tolist()
+    assert df['close'].tolist() == expected['close'].tolist()
+
+    # 回放按请求区间截取日线
+    rs = replay.query_history_k_data_plus('sz.000001', 'date,close', '2024-03-01', '2024-03-08')
+    rows = []
+    while rs.next():
+        rows.append(rs.get_row_data())
+    assert rs.fields == ['date', 'close'] and [row[0] for row in rows][::5] == ['2024-03-01', '2024-03-08']
+    assert replay.query_history_k_data_plus('sh.688999', 'date').error_code != '0'
+
+    results = fetcher.fetch_many(['sz.000001', 'sh.688999'], '2024-01-01', '2024-03-29', use_processes=False)
+    assert {code: error is None for code, *_, error in results} == {'sz.000001': True, 'sh.688999': False}
+    assert len(fetcher.db.get_stock_data('sz.000001')) == len(expected)
+
+
+class ExpiringBaostock(FakeBaostock):
+    """每登录一次只能查询 session_queries 次，之后返回"未登录"；network_errors 次查询抛出网络异常"""
+
+    def __init__(self, session_queries, network_errors=0):
+        super().__init__()
+        self.session_queries = session_queries
+        self.network_errors = network_errors
+        self._remaining = 0
+
+    def login(self):
+        self._remaining = self.session_queries
+        return super().login()
+
+    def query_history_k_data_plus(self, code, *args, **kwargs):
+        if self.network_errors:
+            self.network_errors -= 1
+            raise ConnectionResetError('连接被重置')
+        if self._remaining <= 0:
+            return FakeResultSet([], error_code='10001001', error_msg='用户未登录')
+        self._remaining -= 1
+        return super().query_history_k_data_plus(code, *args, **kwargs)
+
+
+def test_resilient_provider_relogins_and_retries(tmp_path):
+    live = ExpiringBaostock(session_queries=2, network_errors=1)
+    sleeps = []
+    provider = ResilientProvider(live, rate=0, sleep=sleeps.append, retry_base=0.1)
+    fetcher = DataFetcher(db=StockDatabase(os.path.join(tmp_path, 'stock.db')), provider=provider)
+
+    for code in ['sh.600000', 'sz.000001', 'sh.600519']:
+        fetcher.fetch_stock_data(code, '2024-01-01', '2024-03-29')
+    for code in ['sh.600000', 'sz.000001', 'sh.600519']:
+        assert len(fetcher.db.get_stock_data(code)) == 65
+
+    # 首次查询的网络异常和第三次查询的会话失效各重试一次并重新登录
+    assert provider.retries == 2 and provider.relogins == 2
+    assert live.logins == 3
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.1
+
+
+def test_resilient_provider_gives_up_and_passes_through_other_errors():
+    live = ExpiringBaostock(session_queries=0)
+    provider = ResilientProvider(live, rate=0, max_retries=3, sleep=lambda seconds: None)
+    rs = provider.query_history_k_data_plus('sh.600000', 'date', '2024-01-01', '2024-01-31')
+    assert rs.error_code == '10001001'
+    assert provider.retries == 3
+
+    # 与会话和网络无关的错误不重试
+    missing = ResilientProvider(ReplayProvider('/nonexistent'), rate=0, sleep=lambda seconds: None)
+    assert missing.query_history_k_data_plus('sh.600000', 'date').error_code == '10004011'
+    assert missing.retries == 0
+
+
+def test_token_bucket_limits_sustained_rate():
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    bucket = TokenBucket(rate=10, capacity=5, clock=lambda: clock[0], sleep=sleep)
+    for _ in range(25):
+        bucket.acquire()
+    # 前5个请求立即通过，其余按每秒10个
+    assert abs(clock[0] - 2.0) < 1e-9
+
+
+def test_resilient_provider_resumes_broken_pages(tmp_path):
+    live = FlakyBaostock()
+    live.truncating['sh.600000'] = 20
+    provider = ResilientProvider(live, rate=0, sleep=lambda seconds: None)
+    fetcher = DataFetcher(db=StockDatabase(os.path.join(tmp_path, 'stock.db')), provider=provider)
+
+    # 第21行所在的分页获取失败：重新登录后从第20行的日期继续，不重复也不遗漏
+    fetcher.fetch_stock_data('sh.600000', '2024-01-01', '2024-03-29')
+    dates = fetcher.db.get_stock_data('sh.600000')['date'].tolist()
+    assert dates == list(pd.bdate_range('2024-01-01', '2024-03-29').strftime('%Y-%m-%d'))
+    assert provider.retries == 1 and provider.relogins == 1
+    assert [query[1] for query in live.history_queries] == ['2024-01-01', dates[19]]
+
+    # 重试次数用完后错误码留给调用方
+    live.truncating['sz.000001'] = 5
+    rs = ResilientProvider(live, rate=0, max_retries=0, sleep=lambda seconds: None).query_history_k_data_plus(
+        'sz.000001', 'date', '2024-01-01', '2024-01-31')
+    rows = []
+    while (rs.error_code == '0') & rs.next():
+        rows.append(rs.get_row_data())
+    assert len(rows) == 5 and rs.error_code == '10002007'
@@ -0,0 +1,109 @@
+"""
+测试数据库批量写入
+"""
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import StockDatabase
+
+
+def make_rows(start, periods):
+    rng = np.random.default_rng(periods)
+    pe = rng.uniform(5, 40, periods)
+    pe[::7] = np.nan
+    return pd.DataFrame({
+        'date': pd.bdate_range(start, periods=periods).strftime('%Y-%m-%d'),
+        'open': rng.uniform(5, 50, periods),
+        'close': rng.uniform(5, 50, periods),
+        'volume': rng.integers(1000, 100000, periods),
+        'adjustflag': '3',
+        'tradestatus': '1',
+        'isST': '0',
+        'peTTM': pe,
+    })
+
+
+def test_save_stock_data_counts_and_replace(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+
+    first = make_rows('2024-01-01', 100)
+    assert db.save_stock_data(first, 'sh.600000') == (100, 0)
+
+    # 后50行与已有数据重叠，应替换而不是重复插入
+    second = make_rows('2024-03-11', 80)
+    overlap = len(set(first['date']) & set(second['date']))
+    assert db.save_stock_data(second, 'sh.600000') == (80 - overlap, overlap)
+
+    saved = db.get_stock_data('sh.600000')
+    assert len(saved) == len(set(first['date']) | set(second['date']))
+
+    latest = saved.set_index('date').loc[second['date']]
+    np.testing.assert_allclose(latest['close'].to_numpy(), second['close'].to_numpy())
+    # NaN 以 NULL 保存
+    assert latest['peTTM'].isna().sum() == second['peTTM'].isna().sum()
+    assert db.save_stock_data(pd.DataFrame(), 'sh.600000') == (0, 0)
+
+
+def test_connection_reuse_and_concurrent_read(tmp_path):
+    path = os.path.join(tmp_path, 'stock.db')
+    db = StockDatabase(path)
+    conn = db.get_connection()
+    assert conn is StockDatabase(path).get_connection()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    db.save_stock_data(make_rows('2024-01-01', 20), 'sh.600000')
+
+    # 写事务未提交时，其他线程仍可读到已提交的数据
+    conn.execute("INSERT INTO stock_history (date, code, close) VALUES ('2030-01-01', 'sh.600000', 1)")
+    result = {}
+    reader = threading.Thread(target=lambda: result.update(
+        rows=len(db.get_stock_data('sh.600000')), conn=db.get_connection()))
+    reader.start()
+    reader.join(timeout=10)
+    conn.rollback()
+
+    assert result['rows'] == 20
+    assert result['conn'] is not conn
+
+
+def test_thread_connections_closed_on_exit(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    manager = db._manager
+    db.get_connection()
+    baseline = manager.open_connections
+
+    connections = []
+    for _ in range(50):
+        worker = threading.Thread(target=lambda: connections.append(db.get_connection()))
+        worker.start()
+        worker.join(timeout=10)
+
+    # 线程结束后其连接被关闭，不再被管理器持有
+    assert manager.open_connections == baseline
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+    # 退出时在主线程中关闭仍存活线程的连接
+    ready, done = threading.Event(), threading.Event()
+    alive = {}
+
+    def hold():
+        alive['conn'] = db.get_connection()
+        ready.set()
+        done.wait(10)
+
+    worker = threading.Thread(target=hold)
+    worker.start()
+    ready.wait(10)
+    manager.close_all()
+    done.set()
+    worker.join(timeout=10)
+    with pytest.raises(sqlite3.ProgrammingError):
+        alive['conn'].execute('SELECT 1')
+    assert manager.open_connections == 0
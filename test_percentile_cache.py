@@ -0,0 +1,138 @@
+"""
+测试百分位结果缓存
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import StockDatabase
+from percentile_cache import PercentileCache
+from task_runner import TaskCancelled
+from valuation_calculator import ValuationCalculator
+
+
+def make_stock(periods=300):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'date': pd.bdate_range('2023-01-02', periods=periods).strftime('%Y-%m-%d'),
+        'close': rng.uniform(5, 50, periods),
+        'peTTM': rng.uniform(5, 40, periods),
+        'pbMRQ': rng.uniform(0.5, 5, periods),
+        'tradestatus': '1',
+    })
+
+
+def test_cache_roundtrip_and_invalidation(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db)
+    df = make_stock()
+    db.save_stock_data(df, 'sh.600000')
+    last_date = db.get_last_update_date('sh.600000')
+
+    result = ValuationCalculator(df).calculate_all_percentiles('2023-03-01', None)
+    cache.put('sh.600000', 'ALL', 'range:2023-03-01~', last_date, result)
+
+    cached = cache.get('sh.600000', 'ALL', 'range:2023-03-01~', last_date)
+    pd.testing.assert_series_equal(cached['pe_percentile'], result['pe_percentile'])
+    assert (cached['date'] == result['date']).all()
+    # 全部列都保存，标志列统一为数值
+    pd.testing.assert_frame_equal(cached, PercentileCache.normalize_frame(result))
+    assert (cached['tradestatus'] == 1).all()
+
+    # 键的任一部分不同都不命中
+    assert cache.get('sh.600000', 'ALL', 'range:2023-03-01~', '2099-01-01') is None
+    assert cache.get('sh.600000', 'PE', 'range:2023-03-01~', last_date) is None
+
+    # 写入新数据后自动失效
+    db.save_stock_data(make_stock(periods=301).tail(1), 'sh.600000')
+    assert cache.get('sh.600000', 'ALL', 'range:2023-03-01~', last_date) is None
+
+
+def test_range_percentiles_same_shape_on_hit_and_miss(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db)
+    db.save_stock_data(make_stock(), 'sh.600000')
+
+    missed = cache.get_range_percentiles('sh.600000', '2023-03-01', '2023-12-29')
+    hit = cache.get_range_percentiles('sh.600000', '2023-03-01', '2023-12-29')
+    pd.testing.assert_frame_equal(hit, missed)
+    assert 'id' not in hit.columns and (hit['code'] == 'sh.600000').all()
+    assert hit['date'].dtype == 'datetime64[ns]'
+
+
+def test_cache_lru_cap(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db, max_entries=3)
+    result = ValuationCalculator(make_stock(50)).calculate_all_percentiles()
+
+    for i in range(3):
+        cache.put(f'sz.00000{i}', 'ALL', 'range', '2023-03-10', result)
+    # 访问最早的条目，使其成为最近使用
+    assert cache.get('sz.000000', 'ALL', 'range', '2023-03-10') is not None
+    cache.put('sz.000009', 'ALL', 'range', '2023-03-10', result)
+
+    assert cache.get('sz.000000', 'ALL', 'range', '2023-03-10') is not None
+    assert cache.get('sz.000001', 'ALL', 'range', '2023-03-10') is None
+    assert cache.get('sz.000009', 'ALL', 'range', '2023-03-10') is not None
+
+
+def test_update_expanding_appends_new_days(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db)
+    df = make_stock(300)
+
+    db.save_stock_data(df.iloc[:290], 'sh.600000')
+    first, state = cache.update_expanding('sh.600000', 'PE')
+    assert len(first) == 290
+
+    db.save_stock_data(df.iloc[290:], 'sh.600000')
+    second, state = cache.update_expanding('sh.600000', 'PE')
+    assert len(second) == 10
+
+    full = ValuationCalculator(df, 'PE').calculate_percentile()
+    np.testing.assert_array_equal(second['pe_percentile'].to_numpy(), full['pe_percentile'].to_numpy()[-10:])
+
+    # 改写已处理日期的数据后状态失效，重新全量计算
+    assert len(cache.get_expanding_rows('sh.600000', 'PE')) == 300
+    db.save_stock_data(df.iloc[100:101], 'sh.600000')
+    assert cache.get_state('sh.600000', 'PE') is None
+    assert cache.get_expanding_rows('sh.600000', 'PE').empty
+    again, _ = cache.update_expanding('sh.600000', 'PE')
+    assert len(again) == 300
+
+
+def test_expanding_percentiles_use_saved_state(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db)
+    df = make_stock(300)
+    df.loc[50:55, 'tradestatus'] = '0'
+
+    db.save_stock_data(df.iloc[:299], 'sh.600000')
+    cache.get_expanding_percentiles('sh.600000', 'PE')
+    db.save_stock_data(df.iloc[299:], 'sh.600000')
+    result = cache.get_expanding_percentiles('sh.600000', 'PE', '2023-03-01', '2023-12-29')
+
+    expected = ValuationCalculator(db.get_stock_data('sh.600000'), 'PE').calculate_rolling_percentile(
+        '全部', '2023-03-01', '2023-12-29')
+    np.testing.assert_array_equal(result['pe_percentile'].to_numpy(), expected['pe_percentile'].to_numpy())
+    assert list(result['date']) == list(expected['date'])
+    assert cache.get_state('sh.600000', 'PE').row_count == 300
+    # 区间结果来自逐日保存的百分位，状态本身不含百分位序列
+    saved = cache.get_expanding_rows('sh.600000', 'PE', '2023-03-01', '2023-12-29')
+    assert saved['date'].tolist() == expected['date'].dt.strftime('%Y-%m-%d').tolist()
+
+
+def test_expanding_percentiles_cancel_keeps_state(tmp_path):
+    db = StockDatabase(os.path.join(tmp_path, 'cache.db'))
+    cache = PercentileCache(db)
+    db.save_stock_data(make_stock(), 'sh.600000')
+
+    def cancel():
+        raise TaskCancelled()
+
+    with pytest.raises(TaskCancelled):
+        cache.get_expanding_percentiles('sh.600000', 'PE', checkpoint=cancel)
+    # 取消发生在增量更新写入之后，下次无需重新计算
+    assert cache.get_state('sh.600000', 'PE').row_count == 300
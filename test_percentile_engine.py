@@ -0,0 +1,227 @@
+"""
+测试百分位计算引擎与原逐行算法结果一致
+"""
+import numpy as np
+import pandas as pd
+
+from percentile_engine import ExpandingPercentileState, SortedBlockList, expanding_percentile, range_percentile, rolling_percentile
+from valuation_calculator import ValuationCalculator
+from pe_calculator import PECalculator
+
+
+def naive_expanding(values, skipna=True):
+    """原逐行实现（作为对照）"""
+    result = np.full(len(values), np.nan)
+    for i in range(len(values)):
+        current = values[i]
+        history = values[:i + 1]
+        if skipna:
+            if np.isnan(current):
+                continue
+            history = history[~np.isnan(history)]
+        if len(history) > 1:
+            result[i] = (history < current).sum() / (len(history) - 1) * 100
+    return result
+
+
+def naive_range(values):
+    """原区间逐行实现（作为对照）"""
+    result = np.full(len(values), np.nan)
+    all_values = values[~np.isnan(values)]
+    if len(all_values) < 2:
+        return result
+    for i, current in enumerate(values):
+        if not np.isnan(current):
+            result[i] = (all_values < current).sum() / (len(all_values) - 1) * 100
+    return result
+
+
+def make_values(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # 取整制造大量重复值，再随机插入NaN
+    values = np.round(rng.uniform(5, 40, n), 1)
+    values[rng.random(n) < 0.1] = np.nan
+    return values
+
+
+def test_expanding_matches_naive():
+    for n in [0, 1, 2, 3, 65, 500, 3000]:
+        values = make_values(n, seed=n)
+        np.testing.assert_array_equal(expanding_percentile(values), naive_expanding(values))
+        np.testing.assert_array_equal(expanding_percentile(values, skipna=False),
+                                      naive_expanding(values, skipna=False))
+
+
+def test_valuation_calculator_expanding():
+    values = make_values(800, seed=1)
+    df = pd.DataFrame({
+        'date': pd.date_range('2015-01-01', periods=len(values), freq='D'),
+        'close': np.arange(len(values), dtype=float),
+        'peTTM': values,
+    })
+    result = ValuationCalculator(df, 'PE').calculate_percentile()
+    np.testing.assert_array_equal(result['pe_percentile'].to_numpy(), naive_expanding(values))
+
+
+def test_pe_calculator_expanding():
+    closes = make_values(300, seed=2)
+    df = pd.DataFrame({
+        'date': pd.date_range('2015-01-01', periods=len(closes), freq='D'),
+        'close': closes,
+    })
+    calc = PECalculator(df)
+    expected = naive_expanding(closes, skipna=False)
+    np.testing.assert_array_equal(calc.calculate_pe_percentile()['pe_percentile'].to_numpy(), expected)
+    ranged = calc.get_percentile_for_date_range('2015-01-01', '2030-01-01')
+    np.testing.assert_array_equal(ranged['price_percentile'].to_numpy(), expected)
+
+
+def test_range_matches_naive():
+    for n in [0, 1, 2, 3, 500]:
+        values = make_values(n, seed=n)
+        np.testing.assert_array_equal(range_percentile(values), naive_range(values))
+
+
+def test_valuation_calculator_in_range():
+    values = make_values(400, seed=3)
+    df = pd.DataFrame({
+        'date': pd.date_range('2020-01-01', periods=len(values), freq='D'),
+        'close': np.arange(len(values), dtype=float),
+        'peTTM': values,
+        'pbMRQ': values[::-1],
+    })
+    calculator = ValuationCalculator(df, 'PB')
+    result = calculator.calculate_percentile_in_range('2020-03-01', '2020-10-01')
+    in_range = df[(df['date'] >= '2020-03-01') & (df['date'] <= '2020-10-01')]
+    expected = naive_range(in_range['pbMRQ'].to_numpy())
+    np.testing.assert_array_equal(result['pb_percentile'].to_numpy(), expected)
+    np.testing.assert_array_equal(result['percentile'].to_numpy(), expected)
+    np.testing.assert_array_equal(result['valuation_value'].to_numpy(), in_range['pbMRQ'].to_numpy())
+
+
+def naive_rolling(dates, values, window_days):
+    """逐行重新统计窗口（作为对照）"""
+    result = np.full(len(values), np.nan)
+    for i in range(len(values)):
+        if np.isnan(values[i]):
+            continue
+        in_window = (dates >= dates[i] - pd.Timedelta(days=window_days)) & (dates <= dates[i])
+        history = values[:i + 1][in_window[:i + 1]]
+        history = history[~np.isnan(history)]
+        if len(history) > 1:
+            result[i] = (history < values[i]).sum() / (len(history) - 1) * 100
+    return result
+
+
+def test_sorted_block_list():
+    rng = np.random.default_rng(4)
+    lst = SortedBlockList(load=4)
+    reference = []
+    for value in rng.integers(0, 20, 300).tolist():
+        lst.add(value)
+        reference.append(value)
+    for value in rng.permutation(reference)[:200].tolist():
+        lst.remove(value)
+        reference.remove(value)
+        probe = int(rng.integers(0, 21))
+        assert lst.bisect_left(probe) == sum(1 for v in reference if v < probe)
+    assert len(lst) == len(reference)
+
+
+def test_rolling_matches_naive():
+    values = make_values(1500, seed=5)
+    # 工作日序列，包含周末空档
+    dates = pd.bdate_range('2015-01-01', periods=len(values)).to_numpy()
+    np.testing.assert_array_equal(rolling_percentile(dates, values, 365),
+                                  naive_rolling(pd.DatetimeIndex(dates), values, 365))
+
+
+def test_rolling_skips_suspended_days():
+    values = make_values(900, seed=6)
+    status = np.where(np.random.default_rng(6).random(len(values)) < 0.05, '0', '1')
+    df = pd.DataFrame({
+        'date': pd.bdate_range('2016-01-01', periods=len(values)),
+        'close': np.arange(len(values), dtype=float),
+        'peTTM': values,
+        'tradestatus': status,
+    })
+    result = ValuationCalculator(df, 'PE').calculate_rolling_percentile('1年', start_date='2017-01-01')
+
+    expected = naive_rolling(df['date'], np.where(status == '0', np.nan, values), 365)
+    expected = expected[(df['date'] >= '2017-01-01').to_numpy()]
+    np.testing.assert_array_equal(result['pe_percentile'].to_numpy(), expected)
+    assert result['date'].min() >= pd.Timestamp('2017-01-01')
+
+    # '全部' 退化为扩展窗口
+    full = ValuationCalculator(df, 'PE').calculate_rolling_percentile('全部')
+    np.testing.assert_array_equal(full['pe_percentile'].to_numpy(),
+                                  naive_expanding(np.where(status == '0', np.nan, values)))
+
+
+def test_all_percentiles_match_single_metric():
+    rng = np.random.default_rng(7)
+    n = 600
+    df = pd.DataFrame({
+        'date': pd.date_range('2019-01-01', periods=n, freq='D').strftime('%Y-%m-%d'),
+        'close': rng.uniform(5, 50, n),
+        'peTTM': make_values(n, seed=8),
+        'pbMRQ': make_values(n, seed=9),
+        'psTTM': make_values(n, seed=10),
+        'pcfNcfTTM': make_values(n, seed=11),
+    })
+    calculator = ValuationCalculator(df)
+    all_result = calculator.calculate_all_percentiles('2019-03-01', '2020-06-30')
+    assert calculator.calculate_all_percentiles('2019-03-01', '2020-06-30') is all_result
+
+    for valuation_type in ['PE', 'PB', 'PS', 'PCF']:
+        single = ValuationCalculator(df, valuation_type).calculate_percentile_in_range('2019-03-01', '2020-06-30')
+        frame = calculator.get_valuation_frame(valuation_type, '2019-03-01', '2020-06-30')
+        output = valuation_type.lower()
+        np.testing.assert_array_equal(frame[f'{output}_percentile'].to_numpy(),
+                                      single[f'{output}_percentile'].to_numpy())
+        np.testing.assert_array_equal(frame['percentile'].to_numpy(), single['percentile'].to_numpy())
+
+
+def test_incremental_matches_full():
+    values = make_values(1000, seed=12)
+    df = pd.DataFrame({
+        'date': pd.bdate_range('2018-01-01', periods=len(values)),
+        'close': np.arange(len(values), dtype=float),
+        'peTTM': values,
+    })
+    full = ValuationCalculator(df, 'PE').calculate_percentile()
+
+    # 先算前700行，再分两次追加，并经过一次序列化
+    first, state = ValuationCalculator(df.iloc[:700], 'PE').calculate_percentile_incremental()
+    state = ExpandingPercentileState.from_bytes(state.to_bytes())
+    second, state = ValuationCalculator(df.iloc[:950], 'PE').calculate_percentile_incremental(state)
+    third, state = ValuationCalculator(df, 'PE').calculate_percentile_incremental(state)
+
+    assert (len(first), len(second), len(third)) == (700, 250, 50)
+    combined = np.concatenate([first['pe_percentile'], second['pe_percentile'], third['pe_percentile']])
+    np.testing.assert_array_equal(combined, full['pe_percentile'].to_numpy())
+    assert state.last_date == df['date'].iloc[-1].strftime('%Y-%m-%d')
+
+    # 没有新数据时不改变状态
+    empty, state = ValuationCalculator(df, 'PE').calculate_percentile_incremental(state)
+    assert empty.empty and state.row_count == len(df)
+
+
+def test_incremental_state_keeps_nan_counting_mode():
+    closes = make_values(400, seed=13)
+    state = ExpandingPercentileState(skipna=False)
+    head = state.extend(closes[:123])
+    state = ExpandingPercentileState.from_bytes(state.to_bytes())
+    tail = state.extend(closes[123:])
+    np.testing.assert_array_equal(np.concatenate([head, tail]), naive_expanding(closes, skipna=False))
+
+
+def test_incremental_state_daily_appends():
+    values = make_values(600, seed=14)
+    state = ExpandingPercentileState()
+    head = state.extend(values[:500])
+    # 每次追加一个交易日：在有序结构中插入，不重建整个数组
+    tail = [state.extend(values[i:i + 1])[0] for i in range(500, 600)]
+    np.testing.assert_array_equal(np.concatenate([head, tail]), naive_expanding(values))
+    assert isinstance(state.values, SortedBlockList)
+    np.testing.assert_array_equal(state.values.to_array(), np.sort(values[~np.isnan(values)]))
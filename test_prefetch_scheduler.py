@@ -0,0 +1,68 @@
+"""
+测试自选股后台预取调度
+"""
+import os
+from datetime import datetime
+
+import pytest
+
+from database import StockDatabase
+from prefetch_scheduler import PrefetchScheduler
+from test_data_fetcher import FakeBaostock
+
+
+class FlakyBaostock(FakeBaostock):
+    """指定股票下载时抛出异常；truncating 中的股票下一次下载在返回指定行数后中断"""
+
+    def __init__(self):
+        super().__init__()
+        self.failing = set()
+        self.truncating = {}
+
+    def query_history_k_data_plus(self, code, *args, **kwargs):
+        if code in self.failing:
+            raise ConnectionError('网络中断')
+        rs = super().query_history_k_data_plus(code, *args, **kwargs)
+        with self._lock:
+            rs.fail_after = self.truncating.pop(code, None)
+        return rs
+
+
+@pytest.fixture
+def fake_bs():
+    return FlakyBaostock()
+
+
+def test_prefetch_records_success_and_backs_off(tmp_path, fake_bs):
+    db = StockDatabase(os.path.join(tmp_path, 'stock.db'))
+    for code in ['sh.600000', 'sz.000001', 'sh.600519']:
+        db.save_stock_memory(code)
+    fake_bs.failing.add('sz.000001')
+
+    memory = db.get_connection().execute('SELECT code, id, created_at FROM stock_memory').fetchall()
+
+    scheduler = PrefetchScheduler(db, max_workers=2, use_processes=False, provider=fake_bs)
+    results = scheduler.run_once(now=1000.0)
+    # 预取不改写"最近使用"列表（INSERT OR REPLACE 会生成新的 id 和 created_at）
+    assert db.get_connection().execute('SELECT code, id, created_at FROM stock_memory').fetchall() == memory
+
+    assert {code: error is None for code, *_, error in results} == {
+        'sh.600000': True, 'sz.000001': False, 'sh.600519': True}
+    assert len(db.get_stock_data('sh.600519')) > 2000
+    assert scheduler.get_status('sh.600000')[:3] == (1000.0, 1000.0, 0)
+    # 调度线程自身不登录，行情接口只在工作线程（进程）中访问
+    assert not scheduler.fetcher._logged_in
+
+    failed = scheduler.get_status('sz.000001')
+    assert failed[2] == 1 and failed[3] == 1300.0 and '网络中断' in failed[4]
+
+    # 重试时间未到时只刷新其他股票；再次失败后退避时间翻倍
+    assert 'sz.000001' not in scheduler.due_codes(now=1200.0)
+    scheduler.run_once(now=1300.0)
+    assert scheduler.get_status('sz.000001')[2:4] == (2, 1900.0)
+
+    # 恢复后清除失败记录
+    fake_bs.failing.clear()
+    scheduler.run_once(now=1900.0)
+    assert scheduler.get_status('sz.000001')[:4] == (1900.0, 1900.0, 0, None)
+    assert scheduler.seconds_until_next_run(datetime(2024, 1, 2, 17, 0)) == 30 * 60
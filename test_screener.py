@@ -0,0 +1,62 @@
+"""
+测试全市场估值筛选与单只股票计算结果一致
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from columnar_store import ColumnarStockStore
+from database import StockDatabase
+from screener import ValuationScreener
+from valuation_calculator import ValuationCalculator
+
+
+def make_stock(seed, periods=800, end='2024-06-28'):
+    rng = np.random.default_rng(seed)
+    pe = np.round(rng.uniform(-5, 40, periods), 1)
+    pe[rng.random(periods) < 0.1] = np.nan
+    return pd.DataFrame({
+        'date': pd.bdate_range(end=end, periods=periods).strftime('%Y-%m-%d'),
+        'close': rng.uniform(5, 50, periods),
+        'peTTM': pe,
+        'pbMRQ': np.round(rng.uniform(0.5, 5, periods), 2),
+        'psTTM': np.round(rng.uniform(0.5, 10, periods), 2),
+        'pcfNcfTTM': np.round(rng.uniform(-20, 60, periods), 1),
+        'tradestatus': '1',
+    })
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'columnar'])
+def test_screener_matches_calculator(tmp_path, backend):
+    if backend == 'columnar':
+        db = ColumnarStockStore(os.path.join(tmp_path, 'columns'), db_path=os.path.join(tmp_path, 'screen.db'))
+    else:
+        db = StockDatabase(os.path.join(tmp_path, 'screen.db'))
+    frames = {}
+    for i, code in enumerate(['sh.600000', 'sz.000001', 'sz.300750']):
+        frames[code] = make_stock(i, end=f'2024-06-{26 + i}')
+        if i == 2:
+            frames[code].loc[frames[code].index[-1], 'peTTM'] = np.nan
+        db.save_stock_data(frames[code], code)
+    db.save_stock_memory('sh.600000', '浦发银行')
+
+    screener = ValuationScreener(db)
+    current = screener.calculate_current_percentiles('1年').set_index('code')
+
+    for code, df in frames.items():
+        last_date = pd.to_datetime(df['date'].iloc[-1])
+        start = (last_date - pd.Timedelta(days=365)).strftime('%Y-%m-%d')
+        for valuation_type in ['PE', 'PB', 'PS', 'PCF']:
+            expected = ValuationCalculator(df, valuation_type).calculate_percentile_in_range(start, None)
+            output = valuation_type.lower()
+            np.testing.assert_allclose(current.loc[code, f'{output}_percentile'],
+                                       expected['percentile'].iloc[-1], equal_nan=True)
+    assert current.loc['sh.600000', 'name'] == '浦发银行'
+
+    table = screener.screen('PB', '1年', min_days=0)
+    assert list(table['percentile']) == sorted(table['percentile'])
+    assert set(table['level']) <= {'低估', '正常', '高估'}
+    assert screener.screen('PB', '1年', max_percentile=-1, min_days=0).empty
+    assert np.isnan(current.loc['sz.300750', 'pe_percentile'])
@@ -0,0 +1,90 @@
+"""
+测试界面后台任务执行器
+"""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from percentile_engine import rolling_percentile
+from task_runner import TaskCancelled, TaskRunner
+
+
+def poll_until(runner, condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        runner.poll()
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_newer_task_supersedes_older():
+    runner = TaskRunner()
+    started = threading.Event()
+    results, progress = [], []
+
+    def slow(token, report):
+        started.set()
+        for i in range(200):
+            report(f'第{i}块', i)
+            time.sleep(0.005)
+        return 'old'
+
+    old = runner.submit('view', slow, results.append, on_progress=lambda message, percent: progress.append(message))
+    started.wait(1)
+    runner.submit('view', lambda token, report: 'new', results.append)
+
+    poll_until(runner, lambda: results)
+    # 旧任务在下一个检查点停止，它的进度和结果都不会交回
+    assert old.cancelled
+    assert results == ['new']
+    runner.poll()
+    assert all(message.startswith('第') for message in progress)
+    runner.shutdown()
+
+
+def test_cancel_and_errors():
+    runner = TaskRunner()
+    results, errors = [], []
+
+    def failing(token, report):
+        raise ValueError('坏数据')
+
+    runner.submit('view', failing, results.append, errors.append)
+    poll_until(runner, lambda: errors)
+    assert isinstance(errors[0], ValueError) and results == []
+
+    gate = threading.Event()
+
+    def waiting(token, report):
+        gate.wait(1)
+        report('继续', 50)
+        return 'done'
+
+    runner.submit('view', waiting, results.append, errors.append)
+    runner.cancel('view')
+    gate.set()
+    time.sleep(0.05)
+    runner.poll()
+    assert results == [] and len(errors) == 1
+    runner.shutdown()
+
+
+def test_rolling_percentile_checkpoint_can_abort():
+    dates = pd.date_range('2000-01-01', periods=10000).to_numpy()
+    values = np.random.default_rng(0).normal(size=10000)
+    calls = []
+
+    def checkpoint():
+        calls.append(1)
+        if len(calls) == 2:
+            raise TaskCancelled()
+
+    with pytest.raises(TaskCancelled):
+        rolling_percentile(dates, values, 365, checkpoint)
+    assert len(calls) == 2
+    # 不传检查点时结果不变
+    np.testing.assert_allclose(rolling_percentile(dates, values, 365, lambda: None),
+                               rolling_percentile(dates, values, 365), equal_nan=True)
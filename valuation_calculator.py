@@ -2,9 +2,12 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 
+from config import TIME_RANGES, VALUATION_TYPES
+from percentile_engine import ExpandingPercentileState, expanding_percentile, range_percentile, range_percentile_2d, rolling_percentile
+
 
 class ValuationCalculator:
-    """估值计算器 - 支持PE和PB百分位计算"""
+    """估值计算器 - 支持PE、PB、PS、PCF百分位计算"""
 
     def __init__(self, df: pd.DataFrame, valuation_type: str = 'PE'):
         """
@@ -12,10 +15,12 @@ class ValuationCalculator:
 
         Args:
             df: 股票数据DataFrame
-            valuation_type: 估值类型，'PE' 或 'PB'
+            valuation_type: 估值类型，VALUATION_TYPES 的键（'PE'、'PB'、'PS'、'PCF'）
         """
         self.df = df.copy()
         self.valuation_type = valuation_type.upper()
+        # 全部估值类型的百分位结果缓存，键为 (开始日期, 结束日期)
+        self._all_percentiles_cache = {}
         self._prepare_data()
 
     def _prepare_data(self):
@@ -27,16 +32,51 @@ class ValuationCalculator:
         self.df = self.df.sort_values('date').reset_index(drop=True)
         self.df['close'] = pd.to_numeric(self.df['close'], errors='coerce')
 
-        # 确保PE和PB列也是数值类型
-        if 'peTTM' in self.df.columns:
-            self.df['peTTM'] = pd.to_numeric(self.df['peTTM'], errors='coerce')
-        if 'pbMRQ' in self.df.columns:
-            self.df['pbMRQ'] = pd.to_numeric(self.df['pbMRQ'], errors='coerce')
+        # 确保各估值列也是数值类型
+        for config in VALUATION_TYPES.values():
+            if config['column'] in self.df.columns:
+                self.df[config['column']] = pd.to_numeric(self.df[config['column']], errors='coerce')
 
     def set_valuation_type(self, valuation_type: str):
         """设置估值类型"""
         self.valuation_type = valuation_type.upper()
 
+    @staticmethod
+    def _columns_for(valuation_type: str, df: pd.DataFrame) -> tuple:
+        """
+        根据估值类型选择对应的列
+
+        Returns:
+            (数据列, 输出值列, 输出百分位列)
+        """
+        config = VALUATION_TYPES.get(valuation_type, VALUATION_TYPES['PB'])
+        value_col = config['column']
+        output_col = config['output']
+        percentile_col = f"{output_col}_percentile"
+
+        # 检查是否有该列，如果没有则使用close作为回退
+        if value_col not in df.columns:
+            value_col = 'close'
+
+        return value_col, output_col, percentile_col
+
+    def _get_columns(self, df: pd.DataFrame) -> tuple:
+        """当前估值类型对应的列"""
+        return self._columns_for(self.valuation_type, df)
+
+    def _filter_range(self, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """按日期范围过滤数据"""
+        df = self.df.copy()
+
+        if start_date:
+            start = pd.to_datetime(start_date)
+            df = df[df['date'] >= start]
+        if end_date:
+            end = pd.to_datetime(end_date)
+            df = df[df['date'] <= end]
+
+        return df.reset_index(drop=True)
+
     def calculate_percentile_in_range(self, start_date: str = None, end_date: str = None) -> pd.DataFrame:
         """
         在指定日期范围内计算估值百分位
@@ -52,34 +92,13 @@ class ValuationCalculator:
         if self.df.empty:
             return pd.DataFrame()
 
-        df = self.df.copy()
-
         # 过滤日期范围
-        if start_date:
-            start = pd.to_datetime(start_date)
-            df = df[df['date'] >= start]
-        if end_date:
-            end = pd.to_datetime(end_date)
-            df = df[df['date'] <= end]
-
-        df = df.reset_index(drop=True)
+        df = self._filter_range(start_date, end_date)
 
         if len(df) < 2:
             return df
 
-        # 根据估值类型选择对应的值列
-        if self.valuation_type == 'PE':
-            value_col = 'peTTM'
-            output_col = 'pe'
-            percentile_col = 'pe_percentile'
-        else:  # PB
-            value_col = 'pbMRQ'
-            output_col = 'pb'
-            percentile_col = 'pb_percentile'
-
-        # 检查是否有该列，如果没有则使用close作为回退
-        if value_col not in df.columns:
-            value_col = 'close'
+        value_col, output_col, percentile_col = self._get_columns(df)
 
         # 在选定的范围内计算百分位
         # 每个点的百分位 = (范围内比它小的值的数量) / (范围内总数量 - 1) * 100
@@ -95,19 +114,8 @@ class ValuationCalculator:
             df[percentile_col] = df['percentile']
             return df
 
-        for i in range(len(df)):
-            current_value = df.loc[i, value_col]
-            if pd.isna(current_value):
-                continue
-
-            # 计算当前值在范围内的百分位
-            # 使用严格小于的数量
-            count_less = (all_values < current_value).sum()
-            total = len(all_values)
-
-            if total > 1:
-                percentile = count_less / (total - 1) * 100
-                df.loc[i, 'percentile'] = percentile
+        # 排序一次，二分查找得到每个点严格小于它的数量
+        df['percentile'] = range_percentile(pd.to_numeric(df[value_col], errors='coerce').to_numpy(dtype=float))
 
         # 设置输出列
         df[output_col] = df['valuation_value']
@@ -115,6 +123,76 @@ class ValuationCalculator:
 
         return df
 
+    def calculate_all_percentiles(self, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        在指定日期范围内一次性计算全部估值类型（PE/PB/PS/PCF）的百分位
+        各估值列组成二维数组批量排序，结果按日期范围缓存，切换估值类型时无需重新计算
+
+        Args:
+            start_date: 开始日期 (YYYY-MM-DD)
+            end_date: 结束日期 (YYYY-MM-DD)
+
+        Returns:
+            包含 pe/pe_percentile、pb/pb_percentile 等全部输出列的DataFrame
+        """
+        key = (start_date, end_date)
+        if key in self._all_percentiles_cache:
+            return self._all_percentiles_cache[key]
+
+        if self.df.empty:
+            return pd.DataFrame()
+
+        df = self._filter_range(start_date, end_date)
+
+        if len(df) >= 2:
+            columns = [self._columns_for(valuation_type, df) for valuation_type in VALUATION_TYPES]
+            matrix = np.column_stack([df[value_col].to_numpy(dtype=float) for value_col, _, _ in columns])
+            percentiles = range_percentile_2d(matrix)
+
+            for i, (value_col, output_col, percentile_col) in enumerate(columns):
+                df[output_col] = df[value_col]
+                df[percentile_col] = percentiles[:, i]
+
+        self._all_percentiles_cache[key] = df
+        return df
+
+    def get_valuation_frame(self, valuation_type: str = None, start_date: str = None,
+                            end_date: str = None) -> pd.DataFrame:
+        """
+        从批量结果中取出指定估值类型的数据，列格式与 calculate_percentile_in_range 一致
+
+        Args:
+            valuation_type: 估值类型，None表示使用当前估值类型
+            start_date: 开始日期 (YYYY-MM-DD)
+            end_date: 结束日期 (YYYY-MM-DD)
+
+        Returns:
+            包含 valuation_value、percentile 及对应输出列的DataFrame
+        """
+        df = self.calculate_all_percentiles(start_date, end_date)
+        return self.select_valuation(df, valuation_type or self.valuation_type)
+
+    @classmethod
+    def select_valuation(cls, df: pd.DataFrame, valuation_type: str) -> pd.DataFrame:
+        """
+        从 calculate_all_percentiles 的结果中选出一种估值类型，填充 valuation_value 和 percentile 列
+
+        Args:
+            df: 包含全部估值输出列的DataFrame
+            valuation_type: 估值类型
+
+        Returns:
+            新的DataFrame
+        """
+        _, output_col, percentile_col = cls._columns_for(valuation_type.upper(), df)
+        df = df.copy()
+        if percentile_col not in df.columns:
+            return df
+
+        df['valuation_value'] = df[output_col]
+        df['percentile'] = df[percentile_col]
+        return df
+
     def calculate_percentile(self, window_days: int = None) -> pd.DataFrame:
         """
         计算估值百分位（基于最近N天的历史数据）
@@ -137,39 +215,126 @@ class ValuationCalculator:
         if len(df) < 2:
             return df
 
-        # 根据估值类型选择对应的值列
-        if self.valuation_type == 'PE':
-            value_col = 'peTTM'
-            output_col = 'pe'
-            percentile_col = 'pe_percentile'
-        else:  # PB
-            value_col = 'pbMRQ'
-            output_col = 'pb'
-            percentile_col = 'pb_percentile'
+        value_col, output_col, percentile_col = self._get_columns(df)
 
-        # 检查是否有该列，如果没有则使用close作为回退
-        if value_col not in df.columns:
-            value_col = 'close'
+        # 计算估值百分位（基于历史数据的扩展窗口百分位）
+        df['valuation_value'] = df[value_col]
+        values = pd.to_numeric(df[value_col], errors='coerce').to_numpy(dtype=float)
+        df['percentile'] = expanding_percentile(values)
+
+        # 设置输出列
+        df[output_col] = df['valuation_value']
+        df[percentile_col] = df['percentile']
+
+        return df
+
+    @staticmethod
+    def _traded_values(df: pd.DataFrame, value_col: str) -> np.ndarray:
+        """估值数值，停牌日的估值不是成交形成的，与NaN一样不参与统计"""
+        values = pd.to_numeric(df[value_col], errors='coerce').to_numpy(dtype=float)
+        if 'tradestatus' in df.columns:
+            suspended = (pd.to_numeric(df['tradestatus'], errors='coerce') == 0).to_numpy()
+            values = np.where(suspended, np.nan, values)
+        return values
 
-        # 计算估值百分位（基于历史数据的滚动百分位）
+    def calculate_percentile_incremental(self, state: ExpandingPercentileState = None) -> tuple:
+        """
+        增量计算扩展窗口百分位，结果与 calculate_rolling_percentile('全部') 的全量计算一致
+        只处理日期晚于 state.last_date 的新行，已处理的历史保存在状态的有序结构中
+
+        Args:
+            state: 上次计算保存的状态，None表示从第一行开始计算
+
+        Returns:
+            (新增行的DataFrame, 更新后的状态)
+        """
+        if state is None:
+            state = ExpandingPercentileState()
+
+        if self.df.empty:
+            return pd.DataFrame(), state
+
+        df = self.df
+        if state.last_date:
+            df = df[df['date'] > pd.to_datetime(state.last_date)]
+        df = df.reset_index(drop=True)
+
+        if df.empty:
+            return df, state
+
+        value_col, output_col, percentile_col = self._get_columns(df)
         df['valuation_value'] = df[value_col]
-        df['percentile'] = np.nan
+        df['percentile'] = state.extend(self._traded_values(df, value_col))
+        df[output_col] = df['valuation_value']
+        df[percentile_col] = df['percentile']
 
-        for i in range(len(df)):
-            current_value = df.loc[i, value_col]
-            if pd.isna(current_value):
-                continue
+        state.last_date = df['date'].iloc[-1].strftime('%Y-%m-%d')
+        return df, state
 
-            historical_values = df.loc[:i, value_col].dropna().values
+    def calculate_rolling_percentile(self, window: str = '5年', start_date: str = None,
+                                     end_date: str = None, checkpoint=None) -> pd.DataFrame:
+        """
+        计算滚动窗口估值百分位
+        每个点的百分位基于其之前固定时间窗口（如近5年）内的数据，窗口外的历史不参与统计
 
-            if len(historical_values) > 1:
-                percentile = (historical_values < current_value).sum() / (len(historical_values) - 1) * 100
-                df.loc[i, 'percentile'] = percentile
+        Args:
+            window: 窗口，取值为 TIME_RANGES 的键（如 '3年'、'5年'），'全部' 表示扩展窗口
+            start_date: 输出的开始日期 (YYYY-MM-DD)，早于该日期的数据仅作为窗口历史
+            end_date: 输出的结束日期 (YYYY-MM-DD)
+            checkpoint: 计算过程中定期调用的检查点，见 rolling_percentile
+
+        Returns:
+            包含估值百分位的DataFrame
+        """
+        if window not in TIME_RANGES:
+            raise ValueError(f"不支持的滚动窗口: {window}")
+
+        if self.df.empty:
+            return pd.DataFrame()
+
+        df = self.df.copy()
+        if end_date:
+            df = df[df['date'] <= pd.to_datetime(end_date)].reset_index(drop=True)
+
+        value_col, output_col, percentile_col = self._get_columns(df)
+
+        values = self._traded_values(df, value_col)
+
+        years = TIME_RANGES[window]
+        df['valuation_value'] = df[value_col]
+        if years:
+            df['percentile'] = rolling_percentile(df['date'].to_numpy(), values, years * 365, checkpoint)
+        else:
+            df['percentile'] = expanding_percentile(values)
 
-        # 设置输出列
         df[output_col] = df['valuation_value']
         df[percentile_col] = df['percentile']
 
+        if start_date:
+            df = df[df['date'] >= pd.to_datetime(start_date)].reset_index(drop=True)
+
+        return df
+
+    def apply_expanding_percentiles(self, percentiles) -> pd.DataFrame:
+        """
+        用已保存的扩展窗口百分位生成结果，列格式与 calculate_rolling_percentile('全部', ...) 一致
+        扩展窗口的百分位只取决于之前的数据，self.df 只需包含要输出的区间
+
+        Args:
+            percentiles: 与 self.df 逐行对应的百分位
+        """
+        percentiles = np.asarray(percentiles, dtype=float)
+        if len(self.df) != len(percentiles):
+            raise ValueError(f"百分位有 {len(percentiles)} 行，数据有 {len(self.df)} 行")
+        if self.df.empty:
+            return pd.DataFrame()
+
+        df = self.df.copy()
+        value_col, output_col, percentile_col = self._get_columns(df)
+        df['valuation_value'] = df[value_col]
+        df['percentile'] = percentiles
+        df[output_col] = df['valuation_value']
+        df[percentile_col] = df['percentile']
         return df
 
     def get_current_percentile(self, years: int = None) -> dict:
@@ -188,12 +353,9 @@ class ValuationCalculator:
             'total_days': len(df)
         }
 
-        if self.valuation_type == 'PE':
-            result['pe'] = latest.get('pe', latest['close'])
-            result['pe_percentile'] = latest.get('percentile', 0)
-        else:
-            result['pb'] = latest.get('pb', latest['close'])
-            result['pb_percentile'] = latest.get('percentile', 0)
+        _, output_col, percentile_col = self._get_columns(df)
+        result[output_col] = latest.get(output_col, latest['close'])
+        result[percentile_col] = latest.get('percentile', 0)
 
         result['percentile'] = latest.get('percentile', 0)
 